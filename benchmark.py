@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+"""
+Benchmark pymemc, and any other memcached clients that are installed,
+against local memcached processes or a built-in fake server.
+
+Every combination of client, operation, server count, thread count, key
+count and value size is run for a fixed number of calls per thread, and
+its throughput and p50/p99 call latency are printed and, with -o, saved
+as JSON. Comparing a run against a saved one with -b reports (and exits
+non-zero on) throughput regressions.
+
+    ./benchmark.py --start --servers 1,4 -o before.json
+    ./benchmark.py --start --servers 1,4 -b before.json
+
+For get and set, the key count is the number of distinct keys cycled
+through; for get_multi and set_multi it is the number of keys per call.
+"""
+import SocketServer
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import struct
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+import pymemc
+import startmcs
+
+OPS = ('get', 'set', 'get_multi', 'set_multi')
+
+class PymemcAdapter(object):
+    name = 'pymemc'
+    module = 'pymemc'
+    binary = True   # speaks the binary protocol, so it can use the fake server
+    shared = True   # one client is shared by all threads
+
+    def __init__(self, hosts):
+        self.client = pymemc.Client(hosts, max_threads=max(4, len(hosts)))
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value):
+        return self.client.set(key, value)
+
+    def get_multi(self, keys):
+        return self.client.get_multi(keys)
+
+    def set_multi(self, mapping):
+        return self.client.set_multi(mapping)
+
+    def close(self):
+        self.client.close()
+
+class PylibmcAdapter(PymemcAdapter):
+    name = 'pylibmc'
+    module = 'pylibmc'
+    shared = False
+
+    def __init__(self, hosts):
+        import pylibmc
+        self.client = pylibmc.Client(hosts, binary=True)
+
+    def close(self):
+        self.client.disconnect_all()
+
+class PymemcacheAdapter(PymemcAdapter):
+    name = 'pymemcache'
+    module = 'pymemcache.client.hash'
+    binary = False
+    shared = False
+
+    def __init__(self, hosts):
+        from pymemcache.client.hash import HashClient
+        servers = [(host, int(port)) for host, port in (h.split(':') for h in hosts)]
+        self.client = HashClient(servers)
+
+    def get_multi(self, keys):
+        return self.client.get_many(keys)
+
+    def set_multi(self, mapping):
+        return self.client.set_many(mapping)
+
+class PythonMemcachedAdapter(PymemcAdapter):
+    name = 'python-memcached'
+    module = 'memcache'
+    binary = False
+    shared = False
+
+    def __init__(self, hosts):
+        import memcache
+        self.client = memcache.Client(hosts)
+
+    def close(self):
+        self.client.disconnect_all()
+
+ADAPTERS = (PymemcAdapter, PylibmcAdapter, PymemcacheAdapter, PythonMemcachedAdapter)
+
+def available_adapters(names):
+    """The adapters among `names` ('all' for every one) whose clients import"""
+    found = []
+    for adapter in ADAPTERS:
+        if names != ['all'] and adapter.name not in names:
+            continue
+        try:
+            __import__(adapter.module)
+        except ImportError:
+            print >>sys.stderr, "skipping %s: not installed" % adapter.name
+            continue
+        found.append(adapter)
+    return found
+
+# the fake server
+
+HEADER = struct.Struct('!BBHBBHLLQ')
+FLAGS = struct.Struct('!L')
+
+class FakeHandler(SocketServer.BaseRequestHandler):
+    """
+    Just enough of the binary protocol for the benchmarks: get, getk,
+    set, add, replace, delete and their quiet variants, noop, version,
+    flush and quit. Expiration times are ignored.
+    """
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buf = ''
+        while True:
+            data = sock.recv(262144)
+            if not data:
+                return
+            buf += data
+            out = []
+            offset = 0
+            while len(buf) - offset >= HEADER.size:
+                _, opcode, keylen, extlen, _, _, bodylen, opaque, cas = HEADER.unpack_from(buf, offset)
+                if len(buf) - offset < HEADER.size + bodylen:
+                    break
+                start = offset + HEADER.size
+                offset = start + bodylen
+                extras = buf[start:start+extlen]
+                key = buf[start+extlen:start+extlen+keylen]
+                value = buf[start+extlen+keylen:offset]
+                if not self.process(opcode, key, extras, value, opaque, cas, out):
+                    sock.sendall(''.join(out))
+                    return
+            buf = buf[offset:]
+            if out:
+                sock.sendall(''.join(out))
+
+    def respond(self, out, opcode, status, opaque, cas=0, extras='', key='', value=''):
+        out.append(HEADER.pack(0x81, opcode, len(key), len(extras), 0, status,
+                               len(extras) + len(key) + len(value), opaque, cas))
+        out.append(extras + key + value)
+
+    def process(self, opcode, key, extras, value, opaque, cas, out):
+        store = self.server.store
+        quiet = opcode in (0x09, 0x0D, 0x11, 0x12, 0x13, 0x14, 0x17, 0x18)
+        base = {0x09: 0x00, 0x0D: 0x0C, 0x11: 0x01, 0x12: 0x02, 0x13: 0x03,
+                0x14: 0x04, 0x17: 0x07, 0x18: 0x08}.get(opcode, opcode)
+        if base in (0x00, 0x0C):
+            item = store.get(key)
+            if item is None:
+                if not quiet:
+                    self.respond(out, opcode, 0x01, opaque, value='Not found')
+            else:
+                self.respond(out, opcode, 0, opaque, item[2], FLAGS.pack(item[0]),
+                             key if base == 0x0C else '', item[1])
+        elif base in (0x01, 0x02, 0x03):
+            item = store.get(key)
+            if (base == 0x02 and item is not None) or (base == 0x03 and item is None):
+                self.respond(out, opcode, 0x05 if base == 0x03 else 0x02, opaque, value='Not stored')
+            elif cas and (item is None or item[2] != cas):
+                self.respond(out, opcode, 0x02 if item else 0x01, opaque, value='Exists')
+            else:
+                new_cas = self.server.next_cas()
+                store[key] = (FLAGS.unpack_from(extras)[0], value, new_cas)
+                if not quiet:
+                    self.respond(out, opcode, 0, opaque, new_cas)
+        elif base == 0x04:
+            if store.pop(key, None) is None:
+                self.respond(out, opcode, 0x01, opaque, value='Not found')
+            elif not quiet:
+                self.respond(out, opcode, 0, opaque)
+        elif base == 0x08:
+            store.clear()
+            if not quiet:
+                self.respond(out, opcode, 0, opaque)
+        elif base == 0x0B:
+            self.respond(out, opcode, 0, opaque, value='fake')
+        elif base == 0x07:
+            if not quiet:
+                self.respond(out, opcode, 0, opaque)
+            return False
+        else: # noop, and anything we don't know
+            self.respond(out, opcode, 0 if opcode == 0x0A else 0x81, opaque)
+        return True
+
+class FakeServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address):
+        SocketServer.ThreadingTCPServer.__init__(self, address, FakeHandler)
+        self.store = {}
+        self.next_cas = itertools.count(1).next
+
+def _serve_fake(server):
+    server.serve_forever()
+
+def start_fake_servers(num_servers):
+    """
+    Start `num_servers` fake servers, each in a process of its own so
+    that they don't compete with the client for the GIL. Returns the
+    processes and the servers' host strings.
+    """
+    procs, hosts = [], []
+    for i in xrange(num_servers):
+        server = FakeServer(('localhost', 0))
+        hosts.append('localhost:%d' % server.server_address[1])
+        proc = multiprocessing.Process(target=_serve_fake, args=(server,))
+        proc.daemon = True
+        proc.start()
+        server.server_close()
+        procs.append(proc)
+    return procs, hosts
+
+def wait_for_servers(hosts, timeout=5):
+    deadline = time.time() + timeout
+    for host in hosts:
+        address = host.split(':')
+        while True:
+            try:
+                socket.create_connection((address[0], int(address[1])), 1).close()
+                break
+            except socket.error:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+# the benchmarks
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+def run_case(adapter, op, hosts, threads, num_keys, value_size, requests):
+    """Run one benchmark case and return its result as a dict"""
+    value = os.urandom(value_size)
+    keys = ['bench:%d:%d' % (value_size, i) for i in xrange(num_keys)]
+    mapping = dict.fromkeys(keys, value)
+    setup = adapter(hosts)
+    setup.set_multi(mapping)
+
+    clients = [setup] * threads if adapter.shared else [adapter(hosts) for i in xrange(threads)]
+    latencies = [[] for i in xrange(threads)]
+    errors = []
+
+    def worker(client, times):
+        try:
+            call = getattr(client, op)
+            if op == 'get':
+                args = [(key,) for key in keys]
+            elif op == 'set':
+                args = [(key, value) for key in keys]
+            elif op == 'get_multi':
+                args = [(keys,)]
+            else:
+                args = [(mapping,)]
+            args = itertools.islice(itertools.cycle(args), requests)
+            timer = time.time
+            for a in args:
+                start = timer()
+                call(*a)
+                times.append(timer() - start)
+        except Exception, e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=worker, args=(clients[i], latencies[i]))
+               for i in xrange(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - start
+    for client in set(clients):
+        client.close()
+    if errors:
+        raise errors[0]
+
+    ordered = sorted(itertools.chain(*latencies))
+    keys_per_call = num_keys if op.endswith('_multi') else 1
+    return {
+        'client': adapter.name,
+        'op': op,
+        'servers': len(hosts),
+        'threads': threads,
+        'keys': num_keys,
+        'value_size': value_size,
+        'calls': len(ordered),
+        'seconds': elapsed,
+        'calls_per_second': len(ordered) / elapsed,
+        'keys_per_second': len(ordered) * keys_per_call / elapsed,
+        'p50': percentile(ordered, 50),
+        'p99': percentile(ordered, 99),
+    }
+
+def case_key(result):
+    return tuple(result[k] for k in ('client', 'op', 'servers', 'threads', 'keys', 'value_size'))
+
+def compare(results, baseline, tolerance):
+    """Print throughput changes against `baseline`, returning the regressions"""
+    before = dict((case_key(r), r) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        old = before.get(case_key(result))
+        if old is None:
+            continue
+        change = result['calls_per_second'] / old['calls_per_second'] - 1
+        marker = ''
+        if change < -tolerance:
+            marker = '  REGRESSION'
+            regressions.append(result)
+        print "%-60s %+7.1f%% throughput, p99 %.3fms -> %.3fms%s" % (
+            format_case(result), change * 100, old['p99'] * 1000, result['p99'] * 1000, marker)
+    return regressions
+
+def format_case(result):
+    return "%(client)s %(op)s servers=%(servers)d threads=%(threads)d keys=%(keys)d size=%(value_size)d" % result
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--fake", action="store_true", default=False,
+                      help="run against built-in fake servers instead of memcached")
+    parser.add_option("--start", action="store_true", default=False,
+                      help="start memcached processes (see startmcs.py) instead of "
+                           "using ones already running on ports from 11211")
+    parser.add_option("--servers", default="1", help="server counts to run with [%default]")
+    parser.add_option("--ops", default=",".join(OPS), help="operations to run [%default]")
+    parser.add_option("--keys", default="1000", help="key counts [%default]")
+    parser.add_option("--sizes", default="100,10000", help="value sizes in bytes [%default]")
+    parser.add_option("--threads", default="1,4", help="thread counts [%default]")
+    parser.add_option("--requests", type="int", default=1000,
+                      help="calls per thread for get and set, a tenth of that for multis [%default]")
+    parser.add_option("--clients", default="pymemc",
+                      help="clients to run: pymemc, pylibmc, pymemcache, python-memcached or all [%default]")
+    parser.add_option("-o", "--output", help="write the results to this JSON file")
+    parser.add_option("-b", "--baseline", help="compare throughput with this earlier JSON output")
+    parser.add_option("--tolerance", type="float", default=0.1,
+                      help="throughput drop counted as a regression [%default]")
+    (options, args) = parser.parse_args()
+
+    server_counts = int_list(options.servers)
+    adapters = available_adapters(options.clients.split(','))
+    if options.fake:
+        for adapter in [a for a in adapters if not a.binary]:
+            print >>sys.stderr, "skipping %s: the fake server only speaks the binary protocol" % adapter.name
+        adapters = [a for a in adapters if a.binary]
+
+    procs = []
+    if options.fake:
+        procs, all_hosts = start_fake_servers(max(server_counts))
+    else:
+        all_hosts = ['localhost:%d' % (startmcs.start_port + i) for i in xrange(max(server_counts))]
+        if options.start:
+            procs = startmcs.start_servers(max(server_counts), quiet=True)
+    results = []
+    try:
+        wait_for_servers(all_hosts)
+        for adapter, servers, op, threads, num_keys, size in itertools.product(
+                adapters, server_counts, options.ops.split(','), int_list(options.threads),
+                int_list(options.keys), int_list(options.sizes)):
+            requests = options.requests
+            if op.endswith('_multi'):
+                requests = max(1, requests // 10)
+            result = run_case(adapter, op, all_hosts[:servers], threads, num_keys, size, requests)
+            results.append(result)
+            print "%-60s %10.0f calls/s %12.0f keys/s  p50 %.3fms  p99 %.3fms" % (
+                format_case(result), result['calls_per_second'], result['keys_per_second'],
+                result['p50'] * 1000, result['p99'] * 1000)
+    finally:
+        for proc in procs:
+            proc.terminate()
+
+    output = {
+        'meta': {
+            'time': time.time(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'pymemc': pymemc.__version__,
+            'server': 'fake' if options.fake else 'memcached',
+            'argv': sys.argv[1:],
+        },
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, options.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import exc
+
+DEFAULT_BUFSIZE = 65536
+
+class BufferedSocket(object):
+    """
+    A socket wrapper that owns a reusable read buffer.
+
+    Reads go through recv_into() on a preallocated bytearray, so many
+    small responses can be parsed out of a single large read and big
+    values are not assembled out of string concatenations. Anything
+    not handled here is delegated to the wrapped socket.
+
+    bytes_sent and bytes_received count the traffic so far.
+    """
+    def __init__(self, sock, bufsize=DEFAULT_BUFSIZE):
+        self.sock = sock
+        self._bufsize = bufsize
+        self._alloc(bufsize)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def _alloc(self, size):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0 # first unread byte
+        self._end = 0   # end of the buffered data
+
+    def send(self, data):
+        n = self.sock.send(data)
+        self.bytes_sent += n
+        return n
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.bytes_sent += len(data)
+
+    def buffered(self):
+        """Number of bytes received but not yet consumed"""
+        return self._end - self._start
+
+    def reserve(self, num_bytes):
+        """
+        Make room for `num_bytes` contiguous bytes starting at the
+        first unread byte, moving or growing the buffer as needed.
+        """
+        pending = self._end - self._start
+        if pending == 0:
+            if len(self._buf) != max(num_bytes, self._bufsize):
+                # grow for an oversized response, or shrink back once
+                # one has been consumed
+                self._alloc(max(num_bytes, self._bufsize))
+            else:
+                self._start = self._end = 0
+            return
+        if self._start + num_bytes <= len(self._buf) and \
+                len(self._buf) - self._end >= len(self._buf) // 4:
+            return
+        if num_bytes > len(self._buf):
+            # grow to fit the rest of an oversized response
+            old, start, end = self._view, self._start, self._end
+            self._alloc(num_bytes)
+            self._view[:pending] = old[start:end]
+        elif pending:
+            self._buf[:pending] = self._buf[self._start:self._end]
+        self._start, self._end = 0, pending
+
+    def fill(self):
+        """
+        Read whatever the socket has (blocking as the socket is
+        configured to) into the free end of the buffer.
+        """
+        if len(self._buf) - self._end < len(self._buf) // 4 or \
+                self._start == self._end:
+            self.reserve(self._end - self._start)
+        n = self.sock.recv_into(self._view[self._end:])
+        if not n:
+            raise exc.MemcachedConnectionClosedError('Connection closed')
+        self._end += n
+        self.bytes_received += n
+        return n
+
+    def peek(self, num_bytes):
+        """
+        Block until `num_bytes` are buffered and return (buffer, offset)
+        so that callers can unpack them in place.
+        """
+        if self._end - self._start < num_bytes:
+            self.reserve(num_bytes)
+            while self._end - self._start < num_bytes:
+                self.fill()
+        return self._buf, self._start
+
+    def consume(self, num_bytes):
+        self._start += num_bytes
+
+    def read(self, num_bytes):
+        """Block until `num_bytes` are buffered and return them as a string"""
+        self.peek(num_bytes)
+        start = self._start
+        self._start += num_bytes
+        return self._view[start:self._start].tobytes()
+
+    def read_view(self, num_bytes):
+        """
+        Like read(), but return a memoryview over a new bytearray that
+        belongs to the caller. Whatever is not buffered yet is received
+        straight into it, so a large value is never copied in userspace
+        beyond its first buffered chunk.
+        """
+        view = memoryview(bytearray(num_bytes))
+        have = min(self._end - self._start, num_bytes)
+        view[:have] = self._view[self._start:self._start + have]
+        self._start += have
+        while have < num_bytes:
+            n = self.sock.recv_into(view[have:])
+            if not n:
+                raise exc.MemcachedConnectionClosedError('Connection closed')
+            have += n
+            self.bytes_received += n
+        return view
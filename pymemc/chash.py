@@ -1,38 +1,183 @@
 import hashlib
 import bisect
+import collections
+import struct
+import zlib
+import time
+import threading
+from array import array
+
+_uint32 = struct.Struct('>I')
+_ketama_key = struct.Struct('<I')
+_ketama_points = struct.Struct('<4I')
+
+# points per node libketama gives equally weighted servers
+KETAMA_REPLICAS = 160
+
+def md5_hash(key):
+    """The top 32 bits of the key's md5 digest"""
+    return _uint32.unpack_from(hashlib.md5(key).digest())[0]
+
+def ketama_hash(key):
+    """The key hash used by libketama compatible clients"""
+    return _ketama_key.unpack_from(hashlib.md5(key).digest())[0]
+
+def crc32_hash(key):
+    """A cheaper, non-cryptographic alternative to md5_hash"""
+    return zlib.crc32(key) & 0xffffffff
 
 class ConsistentHash(object):
-    def __init__(self, replicas=10):
+    """
+    A consistent hash ring mapping keys to nodes.
+
+    Ring points are unsigned 32 bit integers kept in a sorted array, with
+    a parallel array holding the index of the node that owns each point.
+    Nodes are placed on the ring by name (str(node) unless one is given),
+    so every process that names its servers the same way agrees on where
+    keys live.
+
+    `hash_fn` maps a key string to a 32 bit integer and defaults to
+    md5_hash. With ketama=True points are laid out the way libketama
+    does it (replicas/4 md5 digests of "name-i", four points each) and
+    keys are hashed with ketama_hash, so placement can be shared with
+    other ketama clients using the same node names (usually "host:port").
+    replicas defaults to KETAMA_REPLICAS then, as libketama uses, and
+    to 10 otherwise.
+
+    Nodes can be removed for good with remove_node, or taken out for a
+    while with mark_down, after which they rejoin the ring on the next
+    lookup. Either way only the keys that lived on that node move.
+    """
+    def __init__(self, replicas=None, hash_fn=None, ketama=False):
+        if replicas is None:
+            replicas = KETAMA_REPLICAS if ketama else 10
         self.replicas = replicas
-        self.ring = {}
-        self.sorted_keys = []
+        self.ketama = ketama
+        self.hash_fn = hash_fn or (ketama_hash if ketama else md5_hash)
+        self._members = [] # (node, name) pairs in insertion order
+        self._down = {} # node -> (name, time it may rejoin the ring)
+        self._next_revive = None
+        self._lock = threading.Lock()
+        self._build()
+
+    def hashkey(self, key):
+        return self.hash_fn(key)
+
+    def _node_points(self, name):
+        if self.ketama:
+            for i in xrange(self.replicas // 4):
+                digest = hashlib.md5("%s-%i" % (name, i)).digest()
+                for point in _ketama_points.unpack(digest):
+                    yield point
+        else:
+            for i in xrange(self.replicas):
+                yield self.hash_fn("%s:%i" % (name, i))
+
+    def _build(self):
+        ring = sorted(
+            (point, index)
+            for index, (node, name) in enumerate(self._members)
+            for point in self._node_points(name)
+        )
+        points = array('I', [point for point, _ in ring])
+        owners = array('I', [index for _, index in ring])
+        # keys hashing past the last point wrap around to the first one
+        owners.extend(owners[:1])
+        nodes = tuple(node for node, _ in self._members)
+        # swap everything in at once so that readers never see a ring
+        # that is half old and half new
+        self._ring = (points, owners, nodes)
         # many people use memcache with just a single node;
         # there is no need to waste time computing a hash
         # in this case
-        self.single_node = True
+        self.single_node = len(nodes) == 1
 
-    def hashkey(self, key):
-        m = hashlib.md5(key)
-        return long(m.hexdigest(), 16)
-
-    def add_node(self, node):
-        for i in xrange(self.replicas):
-            key = self.hashkey("%s:%i" % (node,i))
-            self.ring[key] = node
-            self.sorted_keys.append(key)
-        self.sorted_keys.sort()
-        if len(self.all_nodes()) > 1:
-            self.single_node = False
+    def add_node(self, node, name=None):
+        with self._lock:
+            self._members.append((node, name or str(node)))
+            self._build()
+
+    def remove_node(self, node):
+        with self._lock:
+            self._down.pop(node, None)
+            self._members = [m for m in self._members if m[0] is not node]
+            self._build()
+
+    def mark_down(self, node, retry_interval):
+        """
+        Take a node off the ring for `retry_interval` seconds. The last
+        live node is never taken down; with nowhere else to send its
+        keys, callers are better off seeing the node's errors.
+        """
+        with self._lock:
+            members = [m for m in self._members if m[0] is not node]
+            if not members or len(members) == len(self._members):
+                return False
+            name = [m[1] for m in self._members if m[0] is node][0]
+            retry_at = time.time() + retry_interval
+            self._down[node] = (name, retry_at)
+            self._next_revive = min(retry_at, self._next_revive or retry_at)
+            self._members = members
+            self._build()
+            return True
+
+    def mark_up(self, node):
+        """Put a node taken down with mark_down back on the ring now"""
+        with self._lock:
+            if node in self._down:
+                self._revive([node])
+
+    def down_nodes(self):
+        return self._down.keys()
+
+    def _revive(self, revived):
+        for node in revived:
+            name = self._down.pop(node)[0]
+            self._members.append((node, name))
+        self._next_revive = min([retry_at for _, retry_at in self._down.values()] or [None])
+        self._build()
+
+    def _check_down(self):
+        if time.time() >= self._next_revive:
+            with self._lock:
+                now = time.time()
+                self._revive([node for node, (_, retry_at) in self._down.items() if retry_at <= now])
 
     def get_node(self, key):
+        if self._down:
+            self._check_down()
+        points, owners, nodes = self._ring
         if self.single_node:
-            return self.ring[self.sorted_keys[0]]
-        ckey = self.hashkey(key)
-        if ckey > self.sorted_keys[-1]:
-            return self.ring[self.sorted_keys[0]]
-        index = bisect.bisect_left(self.sorted_keys, ckey)
-        return self.ring[self.sorted_keys[index]]
+            return nodes[0]
+        return nodes[owners[bisect.bisect_left(points, self.hash_fn(key))]]
 
-    def all_nodes(self):
-        return list(set(self.ring.values()))
+    def get_nodes(self, keys):
+        """Route a batch of keys, returning the node for each in order"""
+        if self._down:
+            self._check_down()
+        points, owners, nodes = self._ring
+        if self.single_node:
+            return [nodes[0]] * len(keys)
+        hash_fn, bisect_left = self.hash_fn, bisect.bisect_left
+        return [nodes[owners[bisect_left(points, hash_fn(key))]] for key in keys]
 
+    def group_keys(self, keys):
+        """
+        Route a batch of keys in one pass, returning a dict that maps
+        each node to the list of keys that live on it.
+        """
+        if self._down:
+            self._check_down()
+        points, owners, nodes = self._ring
+        if self.single_node:
+            return {nodes[0]: list(keys)}
+        hash_fn, bisect_left = self.hash_fn, bisect.bisect_left
+        groups = collections.defaultdict(list)
+        for key in keys:
+            groups[nodes[owners[bisect_left(points, hash_fn(key))]]].append(key)
+        return dict(groups)
+
+    def all_nodes(self):
+        if self._down:
+            self._check_down()
+        return self._ring[2]
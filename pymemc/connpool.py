@@ -1,66 +1,370 @@
-import Queue
+import collections
 import socket
+import struct
 import contextlib
 import functools
 import logging
+import random
+import threading
+import time
 
 import exc
+import bufsock
+import deadline
 
 logger = logging.getLogger(__name__)
 
+def _past_deadline(error):
+    """
+    Whether `error` came from cutting a socket operation short for the
+    call's deadline, rather than from the server. Timeouts capped at the
+    deadline raise socket.timeout, but a connect given no time at all
+    fails with other socket errors (EINPROGRESS), so any socket error
+    raised once the deadline has passed counts.
+    """
+    # poll() rounds timeouts down to the millisecond, so the deadline
+    # may be a hair away still
+    return isinstance(error, socket.error) and deadline.expired(0.01)
+
 @contextlib.contextmanager
 def pooled_connection(pool):
-    conn = pool.get()
+    observer = pool.observer
+    if observer is not None:
+        started = time.time()
+    try:
+        conn = pool.get()
+    except socket.error, e:
+        if _past_deadline(e):
+            raise exc.MemcachedTimeoutError("deadline exceeded connecting to %s" % pool)
+        pool.failures += 1
+        raise
+    if observer is not None:
+        checked_out = time.time()
+        observer.checkout(str(pool), checked_out - started)
+        sent, received = conn.bytes_sent, conn.bytes_received
     try:
         yield conn
-    except Exception:
+    except (exc.MemcachedConnectionClosedError, socket.error), e:
+        if _past_deadline(e):
+            # the server is slow, not gone; only this connection is in
+            # an unknown state
+            pool.discard(conn)
+            raise exc.MemcachedTimeoutError("deadline exceeded waiting for %s" % pool)
+        pool.failures += 1
+        pool.discard(conn)
+        # if the server went away, the rest of its idle connections are
+        # stale too; connections to other servers are left alone
+        pool.clear_pool()
+        raise
+    except:
+        # the connection may be halfway through a response
+        pool.discard(conn)
         raise
     else:
+        pool.failures = 0
         pool.put(conn)
+    finally:
+        if observer is not None:
+            observer.request(str(pool), time.time() - checked_out,
+                             conn.bytes_sent - sent, conn.bytes_received - received)
+
+# the errors that mean a connection to a server failed
+CONNECTION_ERRORS = (exc.MemcachedConnectionClosedError, socket.error)
+
+def backoff(client, name, attempt, error, idempotent=True):
+    """
+    After try number `attempt` (counting from 0) of `client`'s call to
+    `name` failed with connection error `error`, eject the servers that
+    keep failing and wait before the next try: a random delay of up to
+    retry_backoff seconds, doubling with each retry up to
+    retry_backoff_max. Returns False, without waiting, if the call is
+    out of retries, is not idempotent and the client's
+    retry_non_idempotent is not set, or would be retried past its
+    deadline.
+    """
+    client._eject_failed_nodes()
+    if attempt >= client.max_retries or \
+            not (idempotent or client.retry_non_idempotent):
+        return False
+    delay = random.uniform(0, min(client.retry_backoff_max,
+                                  client.retry_backoff * 2 ** attempt))
+    left = deadline.remaining()
+    if left is not None and left <= delay:
+        return False
+    if client.observer is not None:
+        client.observer.retry(name, error)
+    logger.warning("Connection error (%s), retry %d of %d in %.3fs...",
+                   error, attempt + 1, client.max_retries, delay)
+    time.sleep(delay)
+    return True
 
-def instance_reconnect(method):
+def instance_reconnect(method, idempotent=True):
+    """
+    Retry a client method that fails with a connection error, up to
+    the client's max_retries times, after a backoff with full jitter
+    (see backoff). Methods that are not idempotent are only retried if
+    the client's retry_non_idempotent is set, since the server may have
+    applied the request before the connection failed. Nothing is
+    retried past the call's deadline.
+    """
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
-        retries = 3
-        while retries:
+        attempt = 0
+        while True:
             try:
                 return method(self, *args, **kwargs)
-            except (exc.MemcachedConnectionClosedError, socket.error), e:
-                logger.warning("Stale connection, retry %i...", retries)
-                retries -= 1
-                if not retries:
+            except CONNECTION_ERRORS, e:
+                if not backoff(self, method.__name__, attempt, e, idempotent):
                     raise
-                for pool in self.hash.all_nodes():
-                    pool.clear_pool()
+                attempt += 1
     return wrapper
 
+def non_idempotent(method):
+    """instance_reconnect for methods that are not safe to repeat"""
+    return instance_reconnect(method, idempotent=False)
+
 class ConnectionPool(object):
+    """
+    A pool of connections to one server.
+
+    At most `pool_size` idle connections are kept for reuse, and with
+    `max_connections` set no more than that many are open at once; get()
+    then waits up to `wait_timeout` seconds (forever if None) for one to
+    be put back, and raises MemcachedTimeoutError after that. Idle
+    connections are closed once they have been idle `idle_timeout`
+    seconds, and, if `check_fn` is given, checked with it before being
+    reused after `check_after` seconds idle.
+    """
     def __init__(self, klass, *args, **kwargs):
+        self._queue = collections.deque() # idle (conn, idle_since), newest last
+        self.pool_size = kwargs.pop('pool_size', 5)
+        self.max_connections = kwargs.pop('max_connections', None)
+        self.wait_timeout = kwargs.pop('wait_timeout', None)
+        self.idle_timeout = kwargs.pop('idle_timeout', None)
+        self.check_after = kwargs.pop('check_after', None)
+        self._check_fn = kwargs.pop('check_fn', None)
         self._args = args
         self._kwargs = kwargs
-        self._queue = Queue.Queue(self._kwargs.pop('pool_size', 5))
         self._klass = klass
+        self._cond = threading.Condition(threading.Lock())
+        # an instrument.Observer told about checkouts and requests
+        self.observer = None
+        self._open = 0
+        # slots reserved by warm() for connections still being opened
+        self._warming = 0
+        # consecutive connection failures, reset by any success
+        self.failures = 0
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.reaped = 0
+        self.failed_checks = 0
+        self.waits = 0
+        self.wait_time = 0.0
 
     def get(self):
+        while True:
+            conn, idle_since = self._checkout()
+            if conn is None:
+                return self._connect()
+            if self.check_after is not None and self._check_fn is not None and \
+                    time.time() - idle_since >= self.check_after and \
+                    not self._check_fn(conn):
+                with self._cond:
+                    self.failed_checks += 1
+                self.discard(conn)
+                continue
+            with self._cond:
+                self.reused += 1
+            return conn
+
+    def _checkout(self):
+        """
+        Take the most recently used idle connection, or reserve a slot
+        for a new one and return (None, None), waiting for one or the
+        other if the pool is at max_connections.
+        """
+        started = None
+        with self._cond:
+            while True:
+                self._reap()
+                if self._queue:
+                    conn, idle_since = self._queue.pop()
+                    break
+                if self.max_connections is None or self._open < self.max_connections:
+                    self._open += 1
+                    conn = idle_since = None
+                    break
+                now = time.time()
+                if started is None:
+                    started = now
+                    self.waits += 1
+                remaining = None
+                if self.wait_timeout is not None:
+                    remaining = started + self.wait_timeout - now
+                remaining = deadline.cap(remaining)
+                if remaining is not None and remaining <= 0:
+                    self.wait_time += now - started
+                    raise exc.MemcachedTimeoutError(
+                        "timed out waiting for a connection to %s" % self)
+                self._cond.wait(remaining)
+            if started is not None:
+                self.wait_time += time.time() - started
+        return conn, idle_since
+
+    def _connect(self):
         try:
-            return self._queue.get_nowait()
-        except Queue.Empty:
-            return self._klass(*self._args, **self._kwargs)
+            conn = self._klass(*self._args, **self._kwargs)
+        except:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.created += 1
+        return conn
+
+    def _reap(self):
+        """Close connections idle for longer than idle_timeout (holding the lock)"""
+        if self.idle_timeout is None:
+            return
+        expired = time.time() - self.idle_timeout
+        while self._queue and self._queue[0][1] < expired:
+            conn, _ = self._queue.popleft()
+            self._open -= 1
+            self.reaped += 1
+            _close(conn)
 
     def put(self, conn):
+        with self._cond:
+            if len(self._queue) < self.pool_size:
+                self._queue.append((conn, time.time()))
+                self._cond.notify()
+                return
+        self.discard(conn)
+
+    def discard(self, conn):
+        """Close a checked out connection instead of putting it back"""
+        _close(conn)
+        with self._cond:
+            self._open -= 1
+            self.discarded += 1
+            self._cond.notify()
+
+    def warm(self, count):
+        """Open connections until `count` of them are idle in the pool"""
+        conns = []
         try:
-            self._queue.put_nowait(conn)
-        except Queue.Full:
-            pass
+            while True:
+                # reserve each slot the way _checkout does, counting those
+                # other warm() calls are still filling
+                with self._cond:
+                    if len(self._queue) + self._warming >= min(count, self.pool_size):
+                        break
+                    if self.max_connections is not None and self._open >= self.max_connections:
+                        break
+                    self._open += 1
+                    self._warming += 1
+                try:
+                    conns.append(self._connect())
+                except:
+                    with self._cond:
+                        self._warming -= 1
+                    raise
+        finally:
+            for conn in conns:
+                with self._cond:
+                    self._warming -= 1
+                    if len(self._queue) < self.pool_size:
+                        self._queue.append((conn, time.time()))
+                        self._cond.notify()
+                        continue
+                self.discard(conn)
 
     def clear_pool(self):
-        if not self._queue.empty():
-            self._queue.queue.clear()
-                    
+        """Close every idle connection"""
+        with self._cond:
+            conns = [conn for conn, _ in self._queue]
+            self._queue.clear()
+            self._open -= len(conns)
+            self.discarded += len(conns)
+            self._cond.notify_all()
+        for conn in conns:
+            _close(conn)
+
+    def stats(self):
+        return {
+            'open': self._open,
+            'idle': len(self._queue),
+            'created': self.created,
+            'reused': self.reused,
+            'discarded': self.discarded,
+            'reaped': self.reaped,
+            'failed_checks': self.failed_checks,
+            'waits': self.waits,
+            'wait_time': self.wait_time,
+        }
+
+def _close(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+# a binary protocol noop request, which the server answers with a bare header
+NOOP_REQUEST = struct.pack('!BBHBBHLLQ', 0x80, 0x0A, 0, 0, 0, 0, 0, 0, 0)
+
+def noop_check(sock):
+    """Whether a connection answers a noop, as a live one does at once"""
+    if sock.buffered():
+        # unread bytes mean an earlier response was left half read
+        return False
+    try:
+        sock.sendall(NOOP_REQUEST)
+        response = sock.read(24)
+    except (exc.MemcachedConnectionClosedError, socket.error):
+        return False
+    return response[:2] == '\x81\x0a'
+
 class SocketConnectionPool(ConnectionPool):
-    def __init__(self, *args, **kwargs):
-        def socket_create_and_connect(*args, **kwargs):
-            sock = socket.create_connection(*args, **kwargs)
+    """
+    A pool of BufferedSockets to `address`. Connecting may take up to
+    `connect_timeout` seconds, and each read or write on the socket up
+    to `io_timeout` (by default, the connect timeout), or less if the
+    deadline of the call it is checked out for comes sooner.
+    """
+    def __init__(self, address, connect_timeout=None, io_timeout=None, **kwargs):
+        if io_timeout is None:
+            io_timeout = connect_timeout
+        def socket_create_and_connect():
+            timeout = deadline.cap(connect_timeout)
+            if timeout is not None and timeout <= 0:
+                raise exc.MemcachedTimeoutError("deadline exceeded connecting to %s" % self)
+            sock = socket.create_connection(address, timeout)
             sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-            return sock
-        super(SocketConnectionPool, self).__init__(socket_create_and_connect, *args, **kwargs)
+            sock.settimeout(io_timeout)
+            return bufsock.BufferedSocket(sock)
+        self.address = address
+        self.io_timeout = io_timeout
+        kwargs.setdefault('check_fn', noop_check)
+        super(SocketConnectionPool, self).__init__(socket_create_and_connect, **kwargs)
+
+    def get(self):
+        deadline.check()
+        conn = super(SocketConnectionPool, self).get()
+        if deadline.current() is not None:
+            timeout = deadline.cap(self.io_timeout)
+            if timeout <= 0:
+                self.put(conn)
+                raise exc.MemcachedTimeoutError("deadline exceeded")
+            conn.settimeout(timeout)
+        return conn
+
+    def put(self, conn):
+        if deadline.current() is not None:
+            conn.settimeout(self.io_timeout)
+        super(SocketConnectionPool, self).put(conn)
+
+    def __str__(self):
+        # this is the name the pool is placed on the hash ring by
+        return "%s:%d" % self.address
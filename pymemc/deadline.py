@@ -0,0 +1,72 @@
+import contextlib
+import functools
+import threading
+import time
+
+import exc
+
+# the deadline (a time.time() value) of the call running on each thread
+_local = threading.local()
+
+def current():
+    """The deadline in force on this thread, or None"""
+    return getattr(_local, 'deadline', None)
+
+def remaining():
+    """Seconds left until the deadline in force, or None if there is none"""
+    deadline = current()
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+def expired(slack=0):
+    """Whether the deadline in force has passed, or will within `slack` seconds"""
+    deadline = current()
+    return deadline is not None and time.time() + slack >= deadline
+
+def check():
+    """Raise MemcachedTimeoutError if the deadline in force has passed"""
+    if expired():
+        raise exc.MemcachedTimeoutError("deadline exceeded")
+
+def cap(timeout):
+    """
+    `timeout` (seconds, or None for none), cut down to the time left
+    until the deadline in force, if that is sooner
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    left = max(left, 0)
+    if timeout is None:
+        return left
+    return min(timeout, left)
+
+@contextlib.contextmanager
+def at(deadline):
+    """
+    Put `deadline` in force for the block, unless it is None or a
+    sooner one already is.
+    """
+    outer = current()
+    if deadline is not None and (outer is None or deadline < outer):
+        _local.deadline = deadline
+    try:
+        yield
+    finally:
+        _local.deadline = outer
+
+def bounded(method):
+    """
+    Give a client method a keyword-only `timeout` argument, the seconds
+    the whole call may take across its retries and its per-server
+    requests, defaulting to the client's own `timeout`.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        timeout = kwargs.pop('timeout', self.timeout)
+        if timeout is None:
+            return method(self, *args, **kwargs)
+        with at(time.time() + timeout):
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -2,4 +2,7 @@ class MemcachedError(Exception):
     pass
 
 class MemcachedConnectionClosedError(MemcachedError):
+    pass
+
+class MemcachedTimeoutError(MemcachedError):
     pass
\ No newline at end of file
@@ -0,0 +1,188 @@
+import bisect
+import functools
+import threading
+import time
+
+# histogram bucket upper bounds, in seconds: 100us doubling up to ~13s
+LATENCY_BOUNDS = tuple(0.0001 * 2 ** i for i in xrange(18))
+
+class Histogram(object):
+    """
+    Counts of observed values in fixed buckets, cheap enough to record
+    every call in. Values above the last bound land in an overflow
+    bucket.
+    """
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        The upper bound of the bucket the `p`th percentile falls in (the
+        largest value seen, for the overflow bucket), or 0 if empty
+        """
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'bounds': list(self.bounds),
+            'counts': list(self.counts),
+        }
+
+class Observer(object):
+    """
+    The hooks a Client calls when it is given an observer. They run on
+    the hot path, on whichever thread did the work, so they should be
+    quick and thread safe. Override the ones of interest.
+    """
+    def op(self, name, seconds):
+        """A public call, such as 'get_multi', returned or raised"""
+
+    def checkout(self, server, seconds):
+        """A connection to `server` was checked out (or opened)"""
+
+    def request(self, server, seconds, bytes_sent, bytes_received):
+        """A checked out connection to `server` was used and returned"""
+
+    def phase(self, name, seconds):
+        """A value was serialized ('serialize') or deserialized ('deserialize')"""
+
+    def lookup(self, hits, misses):
+        """A get or get_multi found `hits` of its keys"""
+
+    def retry(self, name, error):
+        """A call to `name` is about to be retried after `error`"""
+
+class Stats(Observer):
+    """
+    An observer that keeps latency histograms per call and per server,
+    byte and hit counters, and exports them all with to_dict().
+
+    >>> stats = Stats()
+    >>> stats.op('get', 0.0003)
+    >>> stats.to_dict()['ops']['get']['count']
+    1
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._ops = {}
+            self._phases = {}
+            self._servers = {}
+            self.hits = 0
+            self.misses = 0
+            self.retries = 0
+
+    def _histogram(self, table, name):
+        histogram = table.get(name)
+        if histogram is None:
+            histogram = table[name] = Histogram()
+        return histogram
+
+    def _server(self, server):
+        entry = self._servers.get(server)
+        if entry is None:
+            entry = self._servers[server] = {
+                'latency': Histogram(),
+                'pool_wait': Histogram(),
+                'bytes_sent': 0,
+                'bytes_received': 0,
+            }
+        return entry
+
+    def op(self, name, seconds):
+        with self._lock:
+            self._histogram(self._ops, name).record(seconds)
+
+    def checkout(self, server, seconds):
+        with self._lock:
+            self._server(server)['pool_wait'].record(seconds)
+
+    def request(self, server, seconds, bytes_sent, bytes_received):
+        with self._lock:
+            entry = self._server(server)
+            entry['latency'].record(seconds)
+            entry['bytes_sent'] += bytes_sent
+            entry['bytes_received'] += bytes_received
+
+    def phase(self, name, seconds):
+        with self._lock:
+            self._histogram(self._phases, name).record(seconds)
+
+    def lookup(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def retry(self, name, error):
+        with self._lock:
+            self.retries += 1
+
+    def to_dict(self):
+        """Everything recorded so far, as plain dicts, lists and numbers"""
+        with self._lock:
+            return {
+                'ops': dict((name, h.to_dict()) for name, h in self._ops.iteritems()),
+                'phases': dict((name, h.to_dict()) for name, h in self._phases.iteritems()),
+                'servers': dict((server, {
+                    'latency': entry['latency'].to_dict(),
+                    'pool_wait': entry['pool_wait'].to_dict(),
+                    'bytes_sent': entry['bytes_sent'],
+                    'bytes_received': entry['bytes_received'],
+                }) for server, entry in self._servers.iteritems()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'retries': self.retries,
+            }
+
+def observed(method):
+    """Report how long a client method took to the client's observer, if any"""
+    name = method.__name__
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        observer = self.observer
+        if observer is None:
+            return method(self, *args, **kwargs)
+        start = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            observer.op(name, time.time() - start)
+    return wrapper
+
+def timed_phase(observer, name, fn):
+    """`fn`, reporting how long each call takes to `observer` as phase `name`"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            observer.phase(name, time.time() - start)
+    return wrapper
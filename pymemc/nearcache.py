@@ -0,0 +1,139 @@
+import collections
+import functools
+import threading
+import time
+
+# invalidations are tracked per stripe of keys, so that a write to one
+# key only drops the fills of the few keys that share its stripe
+STRIPES = 1024
+
+class NearCache(object):
+    """
+    A small in-process cache of already deserialized values, kept in
+    front of the servers for keys that are read far more often than
+    they change.
+
+    Holds at most `max_size` entries, evicting the least recently used
+    first, and entries expire `ttl` seconds after they were stored.
+    Values are handed out as they were stored, so callers must not
+    mutate what they get back.
+
+    Only this process's own writes invalidate entries. A value changed
+    by another client can be served stale for up to `ttl` seconds.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict() # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        # bumped on every invalidation; each stripe holds its value as
+        # of the last invalidation of a key in the stripe
+        self._generation = 0
+        self._invalidated = [0] * STRIPES
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def generation(self):
+        """
+        A token to take before fetching values to store with fill().
+        Fetched values whose keys (or keys in the same stripe) are
+        invalidated in the meantime may already be stale, and fill()
+        drops them.
+        """
+        return self._generation
+
+    def get(self, key):
+        """Return (True, value) on a hit, or (False, None) on a miss"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] <= time.time():
+                self.misses += 1
+                return False, None
+            # reinserting moves the entry to the most recently used end
+            self._entries[key] = entry
+            self.hits += 1
+            return True, entry[0]
+
+    def get_multi(self, keys):
+        """Return a dict of the keys that hit and a list of those that missed"""
+        found, missing = {}, []
+        now = time.time()
+        with self._lock:
+            entries = self._entries
+            for key in keys:
+                entry = entries.pop(key, None)
+                if entry is None or entry[1] <= now:
+                    missing.append(key)
+                else:
+                    entries[key] = entry
+                    found[key] = entry[0]
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def fill(self, items, generation):
+        """
+        Store the (key, value) pairs in `items`, except those whose
+        stripe was invalidated since `generation` was taken.
+        """
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            entries = self._entries
+            invalidated = self._invalidated
+            for key, value in items:
+                if invalidated[hash(key) % STRIPES] > generation:
+                    continue
+                entries.pop(key, None)
+                entries[key] = (value, expires_at)
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            for key in keys:
+                self._invalidated[hash(key) % STRIPES] = generation
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._invalidated = [self._generation] * STRIPES
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+def invalidates(method):
+    """
+    Drop the key, or keys, named by a client method's first argument
+    from the client's near cache once the method is done, whether or
+    not it succeeded.
+    """
+    @functools.wraps(method)
+    def wrapper(self, keys, *args, **kwargs):
+        if self.near_cache is None:
+            return method(self, keys, *args, **kwargs)
+        if isinstance(keys, basestring):
+            names = [keys]
+        elif isinstance(keys, dict):
+            names = keys
+        else:
+            # the method may consume an iterator, so copy it first
+            keys = names = list(keys)
+        try:
+            return method(self, keys, *args, **kwargs)
+        finally:
+            self.near_cache.invalidate([self._encode_key(key) for key in names])
+    return wrapper
@@ -1,10 +1,23 @@
 import struct
 import logging
+import hashlib
+import zlib
 import collections
 import contextlib
+import functools
 import pkg_resources
 import itertools
 import sys
+import select
+import socket
+import errno
+import os
+import time
+import fcntl
+import mmap
+import threading
+import Queue
+import multiprocessing
 
 try:
     import cPickle as pickle
@@ -12,13 +25,19 @@ except ImportError:
     import pickle as pickle
 
 import chash
+import deadline
+import instrument
 import threadpool
 import connpool
+import bufsock
+import nearcache
+import serialization
 
 # in general, raise an exception if an expected return value
 # is out of bounds but handle normal errors with true/false
 # and failure lists (this includes k/v oversize errors)
-from exc import MemcachedConnectionClosedError, MemcachedError
+from exc import MemcachedConnectionClosedError, MemcachedError, MemcachedTimeoutError
+from serialization import F
 
 try:
     __version__ = pkg_resources.require("pymemc")[0].version
@@ -27,8 +46,11 @@ except pkg_resources.DistributionNotFound:
 
 __all__ = [
     'Client',
+    'AsyncClient',
+    'MultiplexedClient',
     'MemcachedError',
     'MemcachedConnectionClosedError',
+    'MemcachedTimeoutError',
     '__version__',
 ]
 
@@ -39,15 +61,6 @@ MAGIC_REQUEST = 0x80  ##   Request packet for this protocol version
 MAGIC_RESPONSE = 0x81 ##   Response packet for this protocol version
 MAX_KEY_SIZE =  0xFA  ##   Max key size in bytes
 
-class F(object):
-    """
-    Compression/Serialization Flags
-    """
-    _pickle = 1 << 0
-    _int = 1 << 1
-    _long = 1 << 2
-    _compressed = 1 << 3
-
 class H(object):
     """
     Memcached Header Constants
@@ -99,12 +112,31 @@ class M(object):
     _flushq = 0x18
     _appendq = 0x19
     _prependq = 0x1A
+    _verbosity = 0x1B
+    _touch = 0x1C
+    _gat = 0x1D
+    _gatq = 0x1E
+
 
+# precompiled packers for the fixed-size part of each packet; keys and
+# values are appended as separate buffers rather than packed in
+HEADER = struct.Struct(H._fmt)
+FLUSH_HEADER = struct.Struct(H._fmt + 'I')
+SET_HEADER = struct.Struct(H._fmt + 'LL')
+INCR_HEADER = struct.Struct(H._fmt + 'qqL')
+TOUCH_HEADER = struct.Struct(H._fmt + 'L')
+UINT32 = struct.Struct('!L')
+UINT64 = struct.Struct('!Q')
+
+# body-less requests never change, so they are packed once
+_qnsv_packets = {}
 
 def _qnsv(opcode):
     """A quit/no-op/stat/version request packet"""
-    return [
-        struct.pack(H._fmt,
+    try:
+        packet = _qnsv_packets[opcode]
+    except KeyError:
+        packet = _qnsv_packets[opcode] = HEADER.pack(
             MAGIC_REQUEST,      # magic
             opcode,             # get cmd
             0,                  # key len
@@ -115,12 +147,12 @@ def _qnsv(opcode):
             0,                  # opaque
             0,                  # cas
         )
-    ]
+    return [packet]
 
 def _f(opcode, expire):
     """A flush request packet"""
     return [
-        struct.pack(H._fmt + 'I',
+        FLUSH_HEADER.pack(
             MAGIC_REQUEST,      # magic
             opcode,             # get cmd
             0,                  # key len
@@ -137,7 +169,7 @@ def _f(opcode, expire):
 def _gd(opcode, key, opaque, cas):
     """A get* or delete* request packet"""
     return [
-        struct.pack(H._fmt+'%ds' % len(key),
+        HEADER.pack(
             MAGIC_REQUEST,      # magic
             opcode,             # get cmd
             len(key),           # key len
@@ -147,14 +179,14 @@ def _gd(opcode, key, opaque, cas):
             len(key),           # body len
             opaque,             # opaque
             cas,                # cas
-            key,                # key
-        )
+        ),
+        key,                    # key
     ]
 
 def _s(opcode, key, val, opaque, expire, cas, flags):
     """A set*  or replace* packet"""
     return [
-        struct.pack(H._fmt+'LL%ds%ds' % (len(key), len(val)),
+        SET_HEADER.pack(
             MAGIC_REQUEST,      # magic
             opcode,             # get cmd
             len(key),           # key len
@@ -166,15 +198,15 @@ def _s(opcode, key, val, opaque, expire, cas, flags):
             cas,                # cas
             flags,              # flags
             expire,             # expire
-            key,                # key
-            val,                # val
-        )
+        ),
+        key,                    # key
+        val,                    # val
     ]
 
 def _ap(opcode, key, val, opaque, cas):
     """A prepend/append packet"""
     return [
-        struct.pack(H._fmt+'%ds%ds' % (len(key), len(val)),
+        HEADER.pack(
             MAGIC_REQUEST,      # magic
             opcode,             # get cmd
             len(key),           # key len
@@ -184,15 +216,33 @@ def _ap(opcode, key, val, opaque, cas):
             len(key)+len(val),  # total body len
             opaque,             # opaque
             cas,                # cas
-            key,                # key
-            val,                # val
-        )
+        ),
+        key,                    # key
+        val,                    # val
+    ]
+
+def _t(opcode, key, opaque, expire):
+    """A touch or gat* packet"""
+    return [
+        TOUCH_HEADER.pack(
+            MAGIC_REQUEST,      # magic
+            opcode,             # get cmd
+            len(key),           # key len
+            4,                  # extlen
+            0,                  # datatype
+            0,                  # status
+            len(key)+4,         # total body len
+            opaque,             # opaque
+            0,                  # cas
+            expire,             # expire
+        ),
+        key,                    # key
     ]
 
 def _id(opcode, key, opaque, expire, cas, delta, initial):
     """An increment or decrement packet"""
     return [
-        struct.pack(H._fmt+'qqL%ds' % (len(key),),
+        INCR_HEADER.pack(
             MAGIC_REQUEST,      # magic
             opcode,             # get cmd
             len(key),           # key len
@@ -205,97 +255,228 @@ def _id(opcode, key, opaque, expire, cas, delta, initial):
             delta,              # delta
             initial,            # initial
             expire,             # expire
-            key,                # key
-        )
+        ),
+        key,                    # key
     ]
 
-# TODO: yada yada yada, if you send too much without receiving
-# the socket will eventually block. You can see this if you do
-# a multiget with a very large (~100K) number of keys. I guess
-# the fix is to use non-blocking sockets and do some reads when
-# you hit EWOULDBLOCK. I'm waiting on that for now.
-# in the mean time I am chunking getQ packets into blocks of 1K
-# which prevents this from happening but slightly hurts performance
+# pipelined packets are gathered into writes of about this many bytes
+SEND_BATCH_SIZE = 65536
+# buffers at least this large are written as they are instead of being
+# copied into a batch
+SEND_COPY_THRESHOLD = 16384
+
+def sendbatches(packets):
+    """
+    Coalesce an iterable of packet lists into a smaller number of
+    buffers to write, so that a pipeline of small packets costs a
+    handful of send() calls and full-sized TCP segments instead of a
+    syscall per packet. Large pieces (typically values) are passed
+    through untouched rather than copied into a batch.
+    """
+    batch = []
+    batch_size = 0
+    for packet in packets:
+        for buf in packet:
+            if len(buf) >= SEND_COPY_THRESHOLD:
+                if batch:
+                    yield ''.join(batch)
+                    batch = []
+                    batch_size = 0
+                yield buf
+                continue
+            if not isinstance(buf, str):
+                buf = _tobytes(buf)
+            batch.append(buf)
+            batch_size += len(buf)
+            if batch_size >= SEND_BATCH_SIZE:
+                yield ''.join(batch)
+                batch = []
+                batch_size = 0
+    if batch:
+        yield ''.join(batch)
+
+# values of these types are stored as raw bytes and written straight
+# from the caller's memory
+BUFFER_TYPES = (bytearray, memoryview, buffer, mmap.mmap)
+
+def _bytes_view(value):
+    """A view of a buffer object whose len() is its size in bytes"""
+    if isinstance(value, memoryview):
+        if value.itemsize == 1 and value.strides == (1,):
+            return value
+        return value.tobytes()
+    return buffer(value)
+
+def _tobytes(buf):
+    if isinstance(buf, memoryview):
+        return buf.tobytes()
+    return str(buf)
+
+def _tail(buf, offset):
+    """The part of `buf` from `offset` on, without copying it"""
+    if isinstance(buf, memoryview):
+        return buf[offset:]
+    return buffer(buf, offset)
+
 def socksend(sock, lst):
-    sock.sendall(''.join(lst))
-
-def sockrecv(sock, num_bytes):
-    d = ''
-    while len(d) < num_bytes:
-        c = sock.recv(min(8192, num_bytes - len(d)))
-        if not c:
-            raise MemcachedConnectionClosedError('Connection closed')
-        d += c
-    return d
-
-def sockresponse(sock):
-    header = sockrecv(sock, H._size)
+    for buf in sendbatches([lst]):
+        sock.sendall(buf)
+
+def _wait_io(sock, want_write, timeout):
+    """
+    Block until `sock` is readable and/or (if want_write) writable.
+    Returns a (readable, writable) pair; raises socket.timeout if
+    nothing happened within `timeout` seconds (None waits forever).
+    """
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        events = select.POLLIN | (select.POLLOUT if want_write else 0)
+        poller.register(sock, events)
+        ready = poller.poll(None if timeout is None else timeout * 1000)
+        if not ready:
+            raise socket.timeout('timed out')
+        revents = ready[0][1]
+        # treat hangups/errors as readable so that recv() surfaces them
+        readable = bool(revents & (select.POLLIN | select.POLLHUP | select.POLLERR))
+        writable = bool(revents & select.POLLOUT)
+        return readable, writable
+    rlist, wlist, _ = select.select([sock], [sock] if want_write else [], [], timeout)
+    if not rlist and not wlist:
+        raise socket.timeout('timed out')
+    return bool(rlist), bool(wlist)
+
+def sockpipeline(sock, packets, on_response, raw=False):
+    """
+    Send a stream of pipelined (quiet) request packets followed by a noop,
+    reading responses as they arrive instead of after everything has been
+    written. Interleaving the two keeps the server from blocking on a full
+    send buffer while we block on a full one of our own, so a single pass
+    can carry any number of keys.
+
+    `packets` is an iterable of packet lists as returned by the request
+    builders, which are written in batches (see sendbatches). `on_response`
+    is called with each parsed response tuple (the same shape sockresponse
+    returns, raw or not) other than the final noop.
+    """
+    timeout = sock.gettimeout()
+    sock.setblocking(0)
+    try:
+        batches = sendbatches(itertools.chain(packets, [_qnsv(M._noop)]))
+        wbuf, wpos = '', 0
+        writing = True
+        while 1:
+            if writing and wpos == len(wbuf):
+                try:
+                    wbuf, wpos = batches.next(), 0
+                except StopIteration:
+                    wbuf, wpos = '', 0
+                    writing = False
+            readable, writable = _wait_io(sock, writing, deadline.cap(timeout))
+            if writable:
+                try:
+                    wpos += sock.send(_tail(wbuf, wpos))
+                except socket.error, e:
+                    if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+            if not readable:
+                continue
+            try:
+                sock.fill()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+                raise
+            for response in sockresponses(sock, raw):
+                if response[1] == M._noop:
+                    return
+                on_response(response)
+    finally:
+        sock.settimeout(timeout)
+
+def sockresponse(sock, raw=False):
+    """
+    Read one response. The body comes back as a string, or with
+    raw=True as a memoryview over a buffer of its own (see
+    BufferedSocket.read_view), which saves copying large values.
+    """
+    buf, offset = sock.peek(H._size)
     magic, opcode, keylen, \
     extlen, datatype, status, \
-    bodylen, opaque, cas = struct.unpack(H._fmt, header)
+    bodylen, opaque, cas = HEADER.unpack_from(buf, offset)
+    sock.consume(H._size)
 
     if (magic != MAGIC_RESPONSE):
         logger.critical("MAGIC mismatch: client (%x) != server (%x); client "
                         "may not be compatible with this version of memcached "
                         "server!", MAGIC_RESPONSE, magic)
     if bodylen > 0:
-        extra = sockrecv(sock, bodylen)
+        extra = sock.read_view(bodylen) if raw else sock.read(bodylen)
     else:
         extra = None
 
     return (magic, opcode, keylen, extlen, datatype, status, bodylen, opaque,
             cas, extra)
 
-def chunk(iterable, chunksize):
-    it = iter(iterable)
-    item = list(itertools.islice(it, chunksize))
-    while item:
-        yield item
-        item = list(itertools.islice(it, chunksize))
-
-class Client(object):
+def sockresponses(sock, raw=False):
+    """
+    Yield every complete response already sitting in the socket's read
+    buffer without blocking. If the next response is only partially
+    buffered, room is reserved for all of it so that the following
+    fill() can complete it.
+    """
+    while sock.buffered() >= H._size:
+        buf, offset = sock.peek(H._size)
+        bodylen, = UINT32.unpack_from(buf, offset + 8)
+        if sock.buffered() < H._size + bodylen:
+            sock.reserve(H._size + bodylen)
+            return
+        yield sockresponse(sock, raw)
+
+class BaseClient(object):
+    """
+    Key encoding, value serialization and key routing shared by Client
+    and AsyncClient. Subclasses put their per-server connection objects
+    on self.hash.
+    """
     def __init__(self,
-                 host_list,
                  encode_fn=pickle.dumps,
                  decode_fn=pickle.loads,
                  compress_fn=None,
                  decompress_fn=None,
-                 max_threads=None,
-                 ch_replicas=100,
                  default_encoding="utf-8",
                  max_value_size=1048576,
-                 connect_timeout_seconds=1):
-        """
-        Create a new instance of the pymemc client.
-
-        >>> c = Client('localhost:11211')
-        >>> c.flush_all()
-        True
-        """
-        if isinstance(host_list, str):
-            host_list = [host_list]
-        if not isinstance(host_list, list):
-            raise Exception("host_list must be a list or single host str")
-
-        self.encode_fn = encode_fn
-        self.decode_fn = decode_fn
+                 serializer=None,
+                 compression=None,
+                 compress_min_size=1024,
+                 compress_min_savings=0.1):
+        self.serializer = serializer or serialization.Serializer(encode_fn, decode_fn)
         self.compress_fn = compress_fn
         self.decompress_fn = decompress_fn
-        # if max threads is not specified, we'll use one per host
-        self.threadpool = threadpool.ThreadPool(max_threads or len(host_list))
-        self.hash = chash.ConsistentHash(replicas=ch_replicas)
         self.default_encoding = default_encoding
         self.max_value_size = max_value_size
-        # maintain a separate pool of connections for each host
-        for host_str in host_list:
-            pool = connpool.SocketConnectionPool(self._parse_host(host_str), connect_timeout_seconds)
-            self.hash.add_node(pool)
-
-    @contextlib.contextmanager
-    def sock4key(self, key):
-        r = self.hash.get_node(key)
-        with connpool.pooled_connection(r) as sock:
-            yield sock
+        self.compress_min_size = compress_min_size
+        self.compress_min_savings = compress_min_savings
+        self.observer = None
+
+        builtin = serialization.builtin_compressors()
+        # every compressor we know, so that values any of them wrote can
+        # be read back; without a decompress_fn, values flagged
+        # _compressed are the ones older versions "compressed" with no
+        # compress_fn at all
+        self._compressors = dict((c.flag, c) for c in builtin.itervalues())
+        self._compressors[F._compressed] = serialization.Compressor(
+            F._compressed, compress_fn, decompress_fn or (lambda val: val))
+        if compression and compress_fn:
+            raise ValueError("give either compression or compress_fn, not both")
+        if compression:
+            if compression not in builtin:
+                raise ValueError("compression %r is not available; have %s" %
+                                 (compression, ", ".join(sorted(builtin))))
+            self.compressor = builtin[compression]
+        elif compress_fn:
+            self.compressor = self._compressors[F._compressed]
+        else:
+            self.compressor = None
 
     def _parse_host(self, host_str):
         if ":" in host_str:
@@ -312,58 +493,366 @@ class Client(object):
             # raise MemcachedError("%d: Key Too Large" % (R._key_too_large,))
         return key
 
-    def _encode(self, val):
-        return self.encode_fn(val)
+    def _compress(self, val):
+        """
+        Return (flag, value), compressing the value only if it is at
+        least compress_min_size bytes long and compressing it saves at
+        least a compress_min_savings fraction of them.
+        """
+        compressor = self.compressor
+        if compressor is None or len(val) < self.compress_min_size:
+            return (0, val)
+        compressed = compressor.compress(val)
+        if len(compressed) > len(val) * (1 - self.compress_min_savings):
+            return (0, val)
+        return (compressor.flag, compressed)
+
+    def _decompress(self, val, flags):
+        compressor = self._compressors.get(flags & serialization.COMPRESSION_FLAGS)
+        if compressor is None:
+            raise MemcachedError("can't decompress a value with flags %d; "
+                                 "is lz4 or zstandard missing?" % flags)
+        return compressor.decompress(val)
 
-    def _decode(self, val):
-        return self.decode_fn(val)
+    def _serialize(self, value):
+        if isinstance(value, BUFFER_TYPES):
+            # no compression either, or we would have to copy it
+            return (0, _bytes_view(value))
+        codec = self.serializer.codec_for(value)
+        value = codec.encode(value)
+        if not codec.compress:
+            return (codec.flag, value)
+        flag, value = self._compress(value)
+        return (codec.flag | flag, value)
 
-    def _compress(self, val):
-        if self.compress_fn:
-            return self.compress_fn(val)
-        else:
-            return val
+    def _deserialize(self, value, flags):
+        if flags & serialization.COMPRESSION_FLAGS:
+            value = self._decompress(value, flags)
+        return self.serializer.decode(value, flags)
 
-    def _decompress(self, val):
-        if self.decompress_fn:
-            return self.decompress_fn(val)
-        else:
-            return val
+    def _unpack_value(self, extra, raw=False):
+        """
+        Deserialize the flags + value body of a get* response. With
+        raw=True the body is a memoryview, and a slice of it holding the
+        value as stored (not decompressed or decoded) is returned.
+        """
+        if raw:
+            return extra[4:]
+        flags, = UINT32.unpack_from(extra)
+        return self._deserialize(extra[4:], flags)
 
-    def _serialize(self, value):
-        flags = 0
-        if isinstance(value, str):
-            pass
-        elif isinstance(value, int):
-            flags |= F._int
-            value = str(value)
-        elif isinstance(value, long):
-            flags |= F._long
-            value = str(value)
-        else:
-            flags |= F._pickle
-            value = self._encode(value)
+    def _chunked(self, extra):
+        """Whether the flags + value body of a get* response is a chunk manifest"""
+        return bool(UINT32.unpack_from(extra)[0] & F._chunked)
+
+    def _group_keys(self, keys, hashkey):
+        """
+        Group encoded keys by the server they live on (or all on the
+        hashkey's server) without checking out any connections.
+        """
+        if hashkey:
+            # user is forcing everything to one shard
+            return {self.hash.get_node(hashkey): list(keys)}
+        return self.hash.group_keys(keys)
 
-        if (flags & F._int) or (flags & F._long):
-            return (flags, value)
+# values handed to an encode pool are encoded this many at a time
+ENCODE_BATCH_SIZE = 128
 
-        value = self._compress(value)
-        flags |= F._compressed
-        return (flags, value)
+# chunked values are split into parts this much smaller than
+# max_value_size, leaving room for the item's key and header
+CHUNK_OVERHEAD = 1024
 
-    def _deserialize(self, value, flags):
-        if flags & F._compressed:
-            value = self._decompress(value)
-        if flags & F._int:
-            return int(value)
-        elif flags & F._long:
-            return long(value)
-        elif flags & F._pickle:
-            return self._decode(value)
-        return value
+# the value stored under a chunked value's key: the token its part keys
+# are made from, the number of parts, the total length and crc32 of the
+# encoded value, and its flags
+CHUNK_MANIFEST = struct.Struct('!4sLLLL')
+
+_ChunkManifest = collections.namedtuple('_ChunkManifest', 'token count length crc32 flags')
+
+# clients that encode values in a process pool, by id. The pool's
+# workers are forked from the client's process, so they find the client
+# (and its serializer and compression settings) here without it having
+# to be pickled.
+_process_encoders = {}
+
+def _encode_in_process(client_id, items):
+    return _process_encoders[client_id]._encode_items(items)
+
+def _with_missed(failures, missed):
+    """The keys in `failures`, plus the `missed` keys the deadline cut short"""
+    failures = list(failures)
+    seen = set(failures)
+    failures.extend(key for key in missed if key not in seen)
+    return failures
+
+class _StreamClosed(Exception):
+    """Stops iter_multi's fetch threads once its consumer has gone"""
+
+# marks the end of one iter_multi fetch thread's results
+_STREAM_DONE = object()
+
+class Client(BaseClient):
+    def __init__(self,
+                 host_list,
+                 encode_fn=pickle.dumps,
+                 decode_fn=pickle.loads,
+                 compress_fn=None,
+                 decompress_fn=None,
+                 max_threads=None,
+                 ch_replicas=None,
+                 default_encoding="utf-8",
+                 max_value_size=1048576,
+                 connect_timeout_seconds=1,
+                 ch_hash_fn=None,
+                 ch_ketama=False,
+                 failure_threshold=None,
+                 dead_retry=30,
+                 near_cache_size=None,
+                 near_cache_ttl=5,
+                 serializer=None,
+                 compression=None,
+                 compress_min_size=1024,
+                 compress_min_savings=0.1,
+                 encode_workers=None,
+                 encode_processes=False,
+                 chunk_large_values=False,
+                 pool_size=5,
+                 max_connections=None,
+                 pool_wait_timeout=None,
+                 pool_idle_timeout=None,
+                 pool_check_after=None,
+                 prewarm_connections=0,
+                 max_retries=2,
+                 retry_backoff=0.01,
+                 retry_backoff_max=1.0,
+                 retry_non_idempotent=False,
+                 io_timeout_seconds=None,
+                 timeout=None,
+                 observer=None):
+        """
+        Create a new instance of the pymemc client.
+
+        Keys are spread over the servers on a consistent hash ring with
+        `ch_replicas` points per server (100 by default). With `ch_ketama`
+        the ring is laid out the way libketama does it, with 160 points
+        per server by default, so other ketama clients given the same
+        "host:port" server list send keys to the same servers.
+
+        If `failure_threshold` is set, a server that fails that many times
+        in a row is taken out of the hash ring for `dead_retry` seconds and
+        its keys are served by the remaining servers in the meantime.
+
+        If `near_cache_size` is set, up to that many values fetched with
+        get or get_multi are kept in process (see nearcache.NearCache) for
+        `near_cache_ttl` seconds and served from there. This client's own
+        writes invalidate them; other clients' writes do not, so only turn
+        it on for keys that can stand being that stale.
+
+        `serializer` picks how values are encoded, by type, and decoded,
+        by flags (see serialization.Serializer). The default pickles what
+        it has no faster codec for, using encode_fn and decode_fn.
+
+        Values are compressed with `compression` ('zlib', or 'lz4' or
+        'zstd' if their packages are installed), or with compress_fn and
+        decompress_fn, but only those of at least `compress_min_size`
+        bytes, and only if that saves at least `compress_min_savings` of
+        their size. Values are stored as they are otherwise.
+
+        With `encode_workers` set, set_multi, add_multi and replace_multi
+        serialize and compress values on that many worker threads (or,
+        with `encode_processes`, worker processes), and each server's
+        pipeline starts writing as soon as its first values are ready.
+        Values are still pickled in this process to hand them to worker
+        processes, so those only sidestep the GIL for the work done on
+        top of that: compression, and codecs slower than pickle. The
+        process pool is forked when the client is created, so create
+        the client before starting other threads.
+
+        Values larger than `max_value_size` once encoded are not stored,
+        unless `chunk_large_values` is set. Then they are split into parts
+        stored under keys of their own, plus a manifest under the value's
+        key, and are reassembled and checked against the manifest's crc32
+        on the way back. Values whose parts have been evicted read as
+        missing, and if a manifest is not stored (say, by an add of a key
+        that exists), the parts written for it are deleted again. Only
+        Client reassembles chunked values; AsyncClient and
+        MultiplexedClient read them as missing. delete removes only the
+        manifest, leaving the parts (as overwriting a value does) to be
+        evicted or expire, and touch and gat only extend the expiration
+        time of the manifest, so the value reads as missing once the
+        parts expire.
+
+        Each server gets a pool of connections (see
+        connpool.ConnectionPool) that keeps up to `pool_size` idle ones.
+        With `max_connections` set, calls wait up to `pool_wait_timeout`
+        seconds for a connection to a server that has that many open, and
+        raise MemcachedTimeoutError after that. Connections idle for
+        `pool_idle_timeout` seconds are closed, those idle for
+        `pool_check_after` seconds are checked with a noop before they are
+        reused, and `prewarm_connections` are opened to each server up
+        front. pool_stats() reports how the pools are doing.
+
+        Calls that fail with a connection error close the connections to
+        that server only, and are retried up to `max_retries` times after
+        a random delay of up to `retry_backoff` seconds, doubling with
+        each retry up to `retry_backoff_max`. incr, decr, append, prepend
+        and their multi versions are not retried, as the server may have
+        applied them before the connection failed, unless
+        `retry_non_idempotent` is set.
+
+        Connecting to a server may take up to `connect_timeout_seconds`,
+        and each read or write after that, or wait on the encode pool, up
+        to `io_timeout_seconds` (which defaults to the connect timeout),
+        after which the wait raises MemcachedTimeoutError. Every call also takes a
+        keyword-only `timeout`, defaulting to `timeout`: the seconds the
+        whole call may take, across its retries and its requests to each
+        server. Calls past their deadline raise MemcachedTimeoutError,
+        except for multi-key calls, which return what the servers that
+        answered in time returned: keys on the others are missing from
+        get_multi's results, and among the failures of set_multi's.
+
+        An `observer` (see instrument.Observer) is told how long each call
+        took, how long connections took to check out and to use, and the
+        bytes sent and received on them, per server, how long values took
+        to serialize and deserialize, get and get_multi hits and misses,
+        and retries. instrument.Stats is one that keeps histograms of it
+        all, for export with to_dict(). Without one, none of it is timed.
+
+        >>> c = Client('localhost:11211')
+        >>> c.flush_all()
+        True
+        """
+        if isinstance(host_list, str):
+            host_list = [host_list]
+        if not isinstance(host_list, list):
+            raise Exception("host_list must be a list or single host str")
+
+        super(Client, self).__init__(encode_fn, decode_fn, compress_fn,
+                                     decompress_fn, default_encoding,
+                                     max_value_size, serializer, compression,
+                                     compress_min_size, compress_min_savings)
+        self.chunk_large_values = chunk_large_values
+        self.encode_processes = encode_processes
+        self.encode_pool = None
+        if encode_workers and encode_processes:
+            # fork before starting any threads of our own
+            _process_encoders[id(self)] = self
+            self.encode_pool = multiprocessing.Pool(encode_workers)
+        elif encode_workers:
+            self.encode_pool = threadpool.ThreadPool(encode_workers)
+        # if max threads is not specified, we'll use one per host
+        self.threadpool = threadpool.ThreadPool(max_threads or len(host_list))
+        if ch_replicas is None:
+            ch_replicas = chash.KETAMA_REPLICAS if ch_ketama else 100
+        self.hash = chash.ConsistentHash(replicas=ch_replicas, hash_fn=ch_hash_fn, ketama=ch_ketama)
+        self.connect_timeout_seconds = connect_timeout_seconds
+        self.io_timeout_seconds = io_timeout_seconds
+        self.timeout = timeout
+        self.observer = observer
+        if observer is not None:
+            # time these per instance, so that they cost nothing otherwise
+            self._serialize = instrument.timed_phase(observer, 'serialize', self._serialize)
+            self._deserialize = instrument.timed_phase(observer, 'deserialize', self._deserialize)
+        self.failure_threshold = failure_threshold
+        self.dead_retry = dead_retry
+        self.pool_options = {
+            'pool_size': pool_size,
+            'max_connections': max_connections,
+            'wait_timeout': pool_wait_timeout,
+            'idle_timeout': pool_idle_timeout,
+            'check_after': pool_check_after,
+        }
+        self.prewarm_connections = prewarm_connections
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.retry_non_idempotent = retry_non_idempotent
+        self.near_cache = None
+        if near_cache_size:
+            self.near_cache = nearcache.NearCache(near_cache_size, near_cache_ttl)
+        # maintain a separate pool of connections for each host
+        for host_str in host_list:
+            self.add_server(host_str)
+
+    def add_server(self, host_str):
+        """
+        Add a server to the hash ring. Only keys that now hash to the
+        new server move.
+        """
+        pool = connpool.SocketConnectionPool(self._parse_host(host_str), self.connect_timeout_seconds,
+                                             self.io_timeout_seconds, **self.pool_options)
+        pool.observer = self.observer
+        if self.prewarm_connections:
+            try:
+                pool.warm(self.prewarm_connections)
+            except socket.error, e:
+                logger.warning("Could not prewarm connections to %s: %s", pool, e)
+        self.hash.add_node(pool)
+
+    def remove_server(self, host_str):
+        """
+        Remove a server from the hash ring and drop its connections. Only
+        keys that lived on that server move.
+        """
+        address = self._parse_host(host_str)
+        for pool in list(self.hash.all_nodes()) + self.hash.down_nodes():
+            if pool.address == address:
+                self.hash.remove_node(pool)
+                pool.clear_pool()
+
+    def _eject_failed_nodes(self):
+        if not self.failure_threshold:
+            return
+        for pool in self.hash.all_nodes():
+            if pool.failures >= self.failure_threshold:
+                if self.hash.mark_down(pool, self.dead_retry):
+                    logger.warning("Ejecting %s for %ds after %d failures",
+                                   pool, self.dead_retry, pool.failures)
+                    pool.clear_pool()
+                    # if it is still down when it rejoins the ring, one
+                    # more failure is enough to eject it again
+                    pool.failures = self.failure_threshold - 1
+
+    @contextlib.contextmanager
+    def sock4key(self, key):
+        r = self.hash.get_node(key)
+        with connpool.pooled_connection(r) as sock:
+            yield sock
+
+    def _run_multi(self, method, keys, hashkey, args=(), idempotent=True):
+        """
+        Call method(pool, keys, *args) on the thread pool with each
+        server's share of `keys`, and wait for them all. Returns the keys
+        of the shares the deadline cut short.
+
+        Shares that fail with a connection error are retried the way
+        instance_reconnect retries calls, but their keys are routed
+        afresh each time, so that the keys of a server ejected from the
+        ring in the meantime go to the servers that own them now.
+        """
+        missed = []
+        attempt = 0
+        while keys:
+            groups = self._group_keys(keys, hashkey).items()
+            futures = [self.threadpool.add_task(method, pool, group, *args)
+                       for pool, group in groups]
+            missed_indexes, errors = threadpool.settle(futures)
+            for i in missed_indexes:
+                missed.extend(groups[i][1])
+            keys = []
+            error = None
+            for i, exc_info in sorted(errors.iteritems()):
+                if not issubclass(exc_info[0], connpool.CONNECTION_ERRORS):
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                keys.extend(groups[i][1])
+                error = error or exc_info
+            if keys and not connpool.backoff(self, method.__name__, attempt, error[1], idempotent):
+                raise error[0], error[1], error[2]
+            attempt += 1
+        return missed
 
     @connpool.instance_reconnect
-    def _per_host_g(self, key, socket_fn, failure_test, unpack=True, return_cas=False):
+    def _per_host_g(self, key, socket_fn, failure_test, unpack=True, return_cas=False, raw=False):
         """
         helper for "get-like" commands
         """
@@ -374,7 +863,7 @@ class Client(object):
 
         with self.sock4key(key) as sock:
             socksend(sock, socket_fn(key))
-            (_, _, _, _, _, status, bodylen, _, cas, extra) = sockresponse(sock)
+            (_, _, _, _, _, status, bodylen, _, cas, extra) = sockresponse(sock, raw)
 
         if status != R._no_error:
             if failure_test(status):
@@ -385,53 +874,66 @@ class Client(object):
         if not unpack:
             return True
 
-        flags, value = struct.unpack('!L%ds' % (bodylen - 4, ), extra)
-        value = self._deserialize(value, flags)
+        value = self._unpack_value(extra, raw)
+        if isinstance(value, _ChunkManifest):
+            value = self._resolve_chunked({key: value}, raw).get(key)
+            if value is None:
+                return None
         if return_cas:
             return value, cas
         else:
             return value
 
-    @connpool.instance_reconnect
-    def _per_host_gmulti(self, sister_keys, response_map, socket_fn, last_socket_fn, hashkey=None):
-        with self.sock4key(hashkey or sister_keys[0]) as sock:
-            last_i = len(sister_keys)-1
-            for i,key in enumerate(sister_keys):
-                if i == last_i:
-                    socksend(sock, last_socket_fn(key, i))
-                else:
-                    socksend(sock, socket_fn(key, i))
-            while 1:
-                (_, _, _, _, _, status, bodylen, opaque, _, extra) = sockresponse(sock)
-                if status == R._no_error:
-                    flags, value = struct.unpack('!L%ds' % (bodylen - 4, ), extra)
-                    response_map[sister_keys[opaque]] = self._deserialize(value, flags)
-                if opaque == last_i: # last response?
-                    break
+    def _per_host_gmulti(self, pool, sister_keys, response_map, socket_fn, raw=False, cas_map=None):
+        def on_response(response):
+            (_, _, _, _, _, status, bodylen, opaque, cas, extra) = response
+            if status == R._no_error:
+                response_map[sister_keys[opaque]] = self._unpack_value(extra, raw)
+                if cas_map is not None:
+                    cas_map[sister_keys[opaque]] = cas
+
+        with connpool.pooled_connection(pool) as sock:
+            packets = (socket_fn(key, i) for i,key in enumerate(sister_keys))
+            sockpipeline(sock, packets, on_response, raw)
 
-    def _gmulti_helper(self, keys, hashkey, socket_fn, last_socket_fn):
+    def _gmulti_helper(self, keys, hashkey, socket_fn, raw=False, cas_map=None):
         """
             helper for "multi_get-like" commands
         """
         response_map = {}
+        self._run_multi(self._per_host_gmulti, keys, hashkey,
+                        (response_map, socket_fn, raw, cas_map))
+        # servers the deadline cut short may still be adding to the map
+        return self._resolve_chunked(dict(response_map), raw)
 
-        if hashkey:
-            groups = [list(keys)]
-        else:
-            sock_keygroup_map = collections.defaultdict(list)
-            for key in keys:
-                key = self._encode_key(key)
-                with self.sock4key(key) as sock:
-                    sock_keygroup_map[id(sock)].append(key)
-            groups = sock_keygroup_map.values()
-
-        for group in groups:
-            for small_group in chunk(group, 1000):
-                self.threadpool.add_task(self._per_host_gmulti, small_group, response_map, socket_fn, last_socket_fn, hashkey=hashkey)
-        self.threadpool.wait()
-        return response_map
+    def _per_host_stream(self, pool, sister_keys, hashkey, emit, socket_fn, raw=False):
+        """
+        Fetch keys from `pool` for iter_multi, retrying those not yet
+        emitted on whichever servers own them once the connection fails.
+        """
+        pending = [(pool, sister_keys)]
+        attempt = 0
+        while pending:
+            pool, sister_keys = pending.pop()
+            emitted = set()
+            def on_response(response):
+                (_, _, _, _, _, status, bodylen, opaque, _, extra) = response
+                if status == R._no_error:
+                    emitted.add(opaque)
+                    emit((sister_keys[opaque], self._unpack_value(extra, raw)))
+
+            try:
+                with connpool.pooled_connection(pool) as sock:
+                    packets = (socket_fn(key, i) for i,key in enumerate(sister_keys))
+                    sockpipeline(sock, packets, on_response, raw)
+            except connpool.CONNECTION_ERRORS, e:
+                if not connpool.backoff(self, 'iter_multi', attempt, e):
+                    raise
+                attempt += 1
+                # don't fetch (and yield) the same keys twice
+                remaining = [key for i,key in enumerate(sister_keys) if i not in emitted]
+                pending.extend(self._group_keys(remaining, hashkey).items())
 
-    @connpool.instance_reconnect
     def _per_host_s(self, key, val, expire, socket_fn, failure_test, serialize=True):
         """
         helper for "set-like" commands
@@ -443,9 +945,44 @@ class Client(object):
 
         key = self._encode_key(key)
 
-        if (sys.getsizeof(val) > self.max_value_size) or (len(key) > MAX_KEY_SIZE):
+        if len(key) > MAX_KEY_SIZE:
             return False
+        if len(val) > self.max_value_size:
+            if not (serialize and self.chunk_large_values):
+                return False
+            return self._per_host_s_chunked(key, flags, val, expire, socket_fn, failure_test)
+
+        if not serialize:
+            # appends and prepends
+            return self._per_host_ap_send(key, val, socket_fn, failure_test)
+        return self._per_host_s_send(key, val, expire, flags, socket_fn, failure_test)
+
+    def _per_host_s_chunked(self, key, flags, val, expire, socket_fn, failure_test):
+        """
+        Store an encoded value too large for one item as parts plus a
+        manifest. The parts are written first, so that a stored manifest
+        never points at missing parts, and deleted again if the manifest
+        is not stored after all (say, by an add of a key that exists).
+        """
+        parts, manifest = self._split_value(key, flags, val)
+        stored = False
+        try:
+            stored = not self._store_encoded(parts, expire, self._set_part, lambda status: True) \
+                and self._per_host_s_send(key, manifest, expire, F._chunked, socket_fn, failure_test)
+        finally:
+            if not stored:
+                self._discard_parts([part[0] for part in parts])
+        return stored
+
+    @connpool.non_idempotent
+    def _per_host_ap_send(self, key, val, socket_fn, failure_test):
+        return self._s_send(key, val, 0, 0, socket_fn, failure_test)
 
+    @connpool.instance_reconnect
+    def _per_host_s_send(self, key, val, expire, flags, socket_fn, failure_test):
+        return self._s_send(key, val, expire, flags, socket_fn, failure_test)
+
+    def _s_send(self, key, val, expire, flags, socket_fn, failure_test):
         with self.sock4key(key) as sock:
             socksend(sock, socket_fn(key, val, expire, flags))
             (_, _, _, _, _, status, _, _, _, extra) = sockresponse(sock)
@@ -457,72 +994,275 @@ class Client(object):
 
         return True
 
-    @connpool.instance_reconnect
-    def _per_host_smulti(self, kv_map, failure_list, expire, socket_fn, last_socket_fn, failure_test, hashkey=None, serialize=True):
-        items = kv_map.items()
-        last_index = len(items)-1
-
-        with self.sock4key(hashkey or kv_map.keys()[0]) as sock:
-            for i,(key,val) in enumerate(items):
-                if serialize:
-                    flags, val = self._serialize(val)
+    def _encode_items(self, items):
+        """
+        Serialize (and compress) the values of (key, value) pairs. Returns
+        a list of (key, flags, payload) triples, and a list of the same
+        for the keys left out because they or their values are too large
+        to store. The payload of those is None unless it can be chunked.
+        """
+        encoded = []
+        too_large = []
+        for key, val in items:
+            flags, val = self._serialize(val)
+            if len(key) > MAX_KEY_SIZE:
+                too_large.append((key, None, None))
+            elif len(val) > self.max_value_size:
+                if self.chunk_large_values:
+                    too_large.append((key, flags, val))
                 else:
-                    flags = 0
-                if (sys.getsizeof(val) > self.max_value_size) or (len(key) > MAX_KEY_SIZE):
-                    failure_list.append(key)
-                if i == last_index:
-                    socksend(sock, last_socket_fn(key, val, i, expire, flags))
+                    too_large.append((key, None, None))
+            else:
+                encoded.append((key, flags, val))
+        return encoded, too_large
+
+    def _submit_encode(self, items):
+        """Encode a batch of items on the encode pool, returning a future"""
+        if self.encode_processes:
+            if any(isinstance(val, BUFFER_TYPES) for _, val in items):
+                # buffers can't be pickled over to a worker, and are
+                # sent as they are anyway
+                return threadpool.resolved(self._encode_items(items))
+            return threadpool.ProcessFuture(
+                self.encode_pool.apply_async(_encode_in_process, (id(self), items)))
+        return self.encode_pool.add_task(self._encode_items, items)
+
+    def _per_host_smulti(self, pool, keys, values, batches, failure_list, too_large, expire, socket_fn, failure_test):
+        """
+        Store the values of `keys` on `pool`. `batches`, if given, maps
+        each key to the encode pool's future for the batch it is in;
+        otherwise the values are encoded here.
+        """
+        if batches is None:
+            # encode before checking out a connection, so that it doesn't
+            # sit idle while the values are pickled and compressed
+            batches = [threadpool.resolved(self._encode_items([(key, values[key]) for key in keys]))]
+        else:
+            # this server's batches, in the order they were submitted
+            ordered = []
+            seen = set()
+            for key in keys:
+                batch = batches[key]
+                if batch not in seen:
+                    seen.add(batch)
+                    ordered.append(batch)
+            batches = ordered
+        wanted = set(keys)
+        self._per_host_smulti_send(pool, wanted, batches, failure_list, expire, socket_fn, failure_test)
+        for batch in batches:
+            too_large.extend(item for item in batch.result(deadline.cap(self.io_timeout_seconds))[1]
+                             if item[0] in wanted)
+
+    def _per_host_store(self, pool, keys, by_key, failure_list, expire, socket_fn, failure_test):
+        """Store already encoded (key, flags, payload) triples on `pool`"""
+        batch = threadpool.resolved(([by_key[key] for key in keys], []))
+        self._per_host_smulti_send(pool, set(keys), [batch], failure_list, expire, socket_fn, failure_test)
+
+    def _per_host_smulti_send(self, pool, wanted, batches, failure_list, expire, socket_fn, failure_test):
+        sent = []
+        def packets():
+            # batches are written as soon as each one is encoded, while
+            # the encode pool works on the rest; a batch may also hold
+            # keys that (after a retry) live on other servers
+            for batch in batches:
+                encoded, _ = batch.result(deadline.cap(self.io_timeout_seconds))
+                for key, flags, val in encoded:
+                    if key in wanted:
+                        sent.append(key)
+                        yield socket_fn(key, val, len(sent) - 1, expire, flags)
+
+        def on_response(response):
+            (_, _, _, _, _, status, _, opaque, _, extra) = response
+            if status != R._no_error:
+                if failure_test(status):
+                    failure_list.append(sent[opaque])
                 else:
-                    socksend(sock, socket_fn(key, val, i, expire, flags))
-            while 1:
-                (magic, opcode, keylen, extlen, datatype, status, bodylen, opaque,
-                        cas, extra) = sockresponse(sock)
-                if status != R._no_error:
-                    if failure_test(status):
-                        failure_list.append(kv_map.keys()[opaque])
-                    else:
-                        raise MemcachedError("%d: %s" % (status, extra))
-                if opaque == last_index: # last item!
-                    break
+                    raise MemcachedError("%d: %s" % (status, extra))
 
-    def _smulti_helper(self, kvmap, expire, hashkey, socket_fn, last_socket_fn, failure_test):
+        with connpool.pooled_connection(pool) as sock:
+            sockpipeline(sock, packets(), on_response)
+
+    def _store_encoded(self, items, expire, socket_fn, failure_test, hashkey=None):
         """
-            helper for "multi_set-like" commands
+        Pipeline already encoded (key, flags, payload) triples to the
+        servers they live on, returning the keys that were not stored.
         """
         failures = []
-        if hashkey:
-            # user is forcing everything to one shard
-            groups = [kvmap]
-        else:
-            # group keys by the shard they hash to
-            hash_groups = collections.defaultdict(dict)
-            for key in kvmap.keys():
-                key = self._encode_key(key)
-                with self.sock4key(key) as sock:
-                    hash_groups[id(sock)][key] = kvmap[key]
-            groups = hash_groups.values()
-
-        for g in groups:
-            self.threadpool.add_task(self._per_host_smulti, g, failures, expire, socket_fn, last_socket_fn, failure_test, hashkey=hashkey)
-        self.threadpool.wait()
+        by_key = dict((item[0], item) for item in items)
+        missed = self._run_multi(self._per_host_store, by_key.keys(), hashkey,
+                                 (by_key, failures, expire, socket_fn, failure_test))
+        return _with_missed(failures, missed)
+
+    @staticmethod
+    def _set_part(key, value, opaque, expire, flags):
+        return _s(M._setq, key, value, opaque, expire, 0, flags)
+
+    def _discard_parts(self, part_keys):
+        """Delete the parts of a chunked value whose manifest was not stored"""
+        try:
+            self._run_multi(self._per_host_delete, part_keys, None, ([],))
+        except (MemcachedError, socket.error):
+            logger.warning("Failed to delete the parts of an unstored chunked value", exc_info=True)
+
+    def _chunk_key(self, key, token, index):
+        return "pymemc-chunk:%s:%s:%d" % (hashlib.md5(key).hexdigest(), token.encode('hex'), index)
+
+    def _split_value(self, key, flags, val):
+        """
+        Split an encoded value too large to store into parts, returning
+        the (key, flags, payload) triples to store them under and the
+        manifest to store under `key` itself. Every write picks a new
+        token for its part keys, so the parts of two writes never mix.
+        """
+        if isinstance(val, memoryview):
+            val = val.tobytes()
+        token = os.urandom(4)
+        size = self.max_value_size - CHUNK_OVERHEAD
+        parts = [(self._chunk_key(key, token, i), 0, val[offset:offset+size])
+                 for i, offset in enumerate(xrange(0, len(val), size))]
+        manifest = CHUNK_MANIFEST.pack(token, len(parts), len(val),
+                                       zlib.crc32(val) & 0xffffffff, flags)
+        return parts, manifest
+
+    def _deserialize(self, value, flags):
+        if flags & F._chunked:
+            return _ChunkManifest(*CHUNK_MANIFEST.unpack(value))
+        return super(Client, self)._deserialize(value, flags)
+
+    def _unpack_value(self, extra, raw=False):
+        if raw and self._chunked(extra):
+            return self._deserialize(extra[4:].tobytes(), F._chunked)
+        return super(Client, self)._unpack_value(extra, raw)
+
+    def _resolve_chunked(self, values, raw=False):
+        """
+        Replace the manifests among `values`, a dict of fetched values,
+        with the values they describe, fetching every part with a single
+        multiget. Values with parts missing (say, evicted) or damaged are
+        dropped, as if they had not been found.
+        """
+        manifests = dict((key, value) for key, value in values.iteritems()
+                         if isinstance(value, _ChunkManifest))
+        if not manifests:
+            return values
+        part_keys = dict((key, [self._chunk_key(key, m.token, i) for i in xrange(m.count)])
+                         for key, m in manifests.iteritems())
+        socket_fn = lambda key,opaque: _gd(M._getq, key, opaque, 0)
+        parts = self._gmulti_helper([k for keys in part_keys.itervalues() for k in keys],
+                                    None, socket_fn)
+        for key, m in manifests.iteritems():
+            del values[key]
+            try:
+                val = ''.join([parts[k] for k in part_keys[key]])
+            except KeyError:
+                logger.info("Parts of chunked value %r are missing", key)
+                continue
+            if len(val) != m.length or zlib.crc32(val) & 0xffffffff != m.crc32:
+                logger.warning("Chunked value %r failed its integrity check", key)
+                continue
+            if raw:
+                values[key] = memoryview(bytearray(val))
+            else:
+                values[key] = super(Client, self)._deserialize(val, m.flags)
+        return values
 
+    def _smulti_helper(self, kvmap, expire, hashkey, socket_fn, failure_test):
+        """
+            helper for "multi_set-like" commands
+        """
+        failures = []
+        too_large = []
+        encoded = dict((self._encode_key(key), val) for key, val in kvmap.iteritems())
+
+        batches = None
+        if self.encode_pool is not None:
+            # batch each server's values together, so that each server's
+            # pipeline can start as soon as its first batch is encoded
+            batches = {}
+            for keys in self._group_keys(encoded, hashkey).itervalues():
+                for i in xrange(0, len(keys), ENCODE_BATCH_SIZE):
+                    batch_keys = keys[i:i+ENCODE_BATCH_SIZE]
+                    batch = self._submit_encode([(key, encoded[key]) for key in batch_keys])
+                    batches.update(dict.fromkeys(batch_keys, batch))
+        missed = self._run_multi(self._per_host_smulti, encoded.keys(), hashkey,
+                                 (encoded, batches, failures, too_large, expire, socket_fn, failure_test))
+        failures = _with_missed(failures, missed)
+        too_large = list(too_large)
+
+        # write the parts of the values that had to be chunked, then the
+        # manifests of those whose parts were all stored
+        parts_of, manifests = {}, []
+        for key, flags, val in too_large:
+            if val is None:
+                failures.append(key)
+                continue
+            parts_of[key], manifest = self._split_value(key, flags, val)
+            manifests.append((key, F._chunked, manifest))
+        if manifests:
+            failed_parts = set(self._store_encoded([p for ps in parts_of.itervalues() for p in ps], expire,
+                                                   self._set_part, lambda status: True))
+            unstored = [key for key, ps in parts_of.iteritems()
+                        if failed_parts.intersection(p[0] for p in ps)]
+            stored = [m for m in manifests if m[0] not in unstored]
+            try:
+                unstored.extend(self._store_encoded(stored, expire, socket_fn, failure_test, hashkey))
+            except:
+                unstored = parts_of.keys()
+                raise
+            finally:
+                # don't leave the parts of values that were not stored
+                # sitting in the cache until they are evicted
+                if unstored:
+                    self._discard_parts([p[0] for key in unstored for p in parts_of[key]])
+            failures.extend(unstored)
         return failures
 
-    @connpool.instance_reconnect
-    def _per_host_delete(self, items, failure_list, hashkey=None):
-        last_i = len(items)-1
-        with self.sock4key(hashkey or items[0]) as sock:
-            for i,key in enumerate(items):
-                if i == last_i:
-                    socksend(sock, _gd(M._delete, key, i, 0))
-                else:
-                    socksend(sock, _gd(M._deleteq, key, i, 0))
-            while 1:
-                (_, _, _, _, _, status, _, opaque, _, _) = sockresponse(sock)
-                if status != R._no_error:
-                    failure_list.append(items[opaque])
-                if opaque == last_i: # last item!
-                    break
+    def _per_host_delete(self, pool, items, failure_list):
+        def on_response(response):
+            (_, _, _, _, _, status, _, opaque, _, _) = response
+            if status != R._no_error:
+                failure_list.append(items[opaque])
+
+        with connpool.pooled_connection(pool) as sock:
+            packets = (_gd(M._deleteq, key, i, 0) for i,key in enumerate(items))
+            sockpipeline(sock, packets, on_response)
+
+    def _per_host_touch(self, pool, items, expire, failure_list):
+        def on_response(response):
+            (_, _, _, _, _, status, _, opaque, _, _) = response
+            if status != R._no_error:
+                failure_list.append(items[opaque])
+
+        # there is no quiet touch, so every key gets a response
+        with connpool.pooled_connection(pool) as sock:
+            packets = (_t(M._touch, key, i, expire) for i,key in enumerate(items))
+            sockpipeline(sock, packets, on_response)
+
+    def _per_host_id(self, pool, keys, deltas, opcode, expire, initial, response_map):
+        def on_response(response):
+            (_, _, _, _, _, status, _, opaque, _, extra) = response
+            key = keys[opaque]
+            if status == R._no_error:
+                response_map[key], = UINT64.unpack(extra)
+            else:
+                response_map[key] = None
+
+        with connpool.pooled_connection(pool) as sock:
+            # on a retry, don't apply the deltas that were answered twice
+            packets = (_id(opcode, key, i, expire, 0, deltas[key], initial)
+                       for i,key in enumerate(keys) if key not in response_map)
+            sockpipeline(sock, packets, on_response)
+
+    def _idmulti_helper(self, kvmap, opcode, expire, initial, hashkey):
+        """
+            helper for incr_multi and decr_multi
+        """
+        response_map = {}
+        deltas = dict((self._encode_key(key), delta) for key, delta in kvmap.iteritems())
+
+        self._run_multi(self._per_host_id, deltas.keys(), hashkey,
+                        (deltas, opcode, expire, initial, response_map), idempotent=False)
+        return dict((key, value) for key, value in response_map.items() if value is not None)
 
     @connpool.instance_reconnect
     def _per_host_stats(self, cpool, rmap):
@@ -538,8 +1278,7 @@ class Client(object):
                     rmap[host_key] = host_stats
                     break
                 else:
-                    key, value = struct.unpack('!%ds%ds' % (keylen, (bodylen-keylen)), extra)
-                    host_stats[key] = value
+                    host_stats[extra[:keylen]] = extra[keylen:]
 
     @connpool.instance_reconnect
     def _per_host_version(self, cpool, rmap):
@@ -550,28 +1289,56 @@ class Client(object):
             if status != R._no_error:
                 raise MemcachedError("%d: %s" % (status, extra))
 
-            version_string = struct.unpack('!%ds' % ((bodylen-keylen), ), extra)[0]
+            version_string = extra[keylen:]
             host_key = tuple(sock.getpeername())
             rmap[host_key] = version_string
 
-    def get(self, key, cas=False):
+    @instrument.observed
+    @deadline.bounded
+    def get(self, key, cas=False, raw=False):
         """
         The get command returns the value for a single key.
 
+        With raw=True the value comes back as a memoryview of the bytes
+        stored, without decompressing or decoding them. Values that were
+        set from a buffer object (bytearray, memoryview, buffer, mmap)
+        are stored as they are, so this returns the same bytes without
+        copying them into a string first.
+
         >>> c = Client('localhost:11211')
         >>> c.set('foo', 'bar')
         True
         >>> c.get('foo')
         'bar'
+        >>> c.set('blob', bytearray('raw bytes'))
+        True
+        >>> c.get('blob', raw=True).tobytes()
+        'raw bytes'
         """
         socket_fn = lambda key: _gd(M._get, key, 0, 0)
         failure_test = lambda status: status == R._key_not_found
-        return self._per_host_g(key, socket_fn, failure_test, return_cas=cas)
+        if self.near_cache is None or cas or raw:
+            value = self._per_host_g(key, socket_fn, failure_test, return_cas=cas, raw=raw)
+        else:
+            cache_key = self._encode_key(key)
+            hit, value = self.near_cache.get(cache_key)
+            if not hit:
+                generation = self.near_cache.generation()
+                value = self._per_host_g(key, socket_fn, failure_test)
+                if value is not None:
+                    self.near_cache.fill([(cache_key, value)], generation)
+        if self.observer is not None:
+            found = value is not None
+            self.observer.lookup(int(found), int(not found))
+        return value
 
-    def get_multi(self, keys, hashkey=None):
+    @instrument.observed
+    @deadline.bounded
+    def get_multi(self, keys, hashkey=None, raw=False):
         """
         The get_multi command returns a dictionary mapping found keys to their
-        values. Keys will be omitted if their value is not found.
+        values. Keys will be omitted if their value is not found. With
+        raw=True values are memoryviews, as for get.
 
         >>> c = Client('localhost:11211')
         >>> c.set_multi({'a':1, 'b':2})
@@ -580,12 +1347,147 @@ class Client(object):
         {'a': 1, 'b': 2}
         """
         socket_fn = lambda key,opaque: _gd(M._getq, key, opaque, 0)
-        last_socket_fn = lambda key,opaque: _gd(M._get, key, opaque, 0)
-        return self._gmulti_helper(keys, hashkey, socket_fn, last_socket_fn)
+        keys = [self._encode_key(key) for key in keys]
+        if self.near_cache is None or raw:
+            found = self._gmulti_helper(keys, hashkey, socket_fn, raw)
+        else:
+            found, missing = self.near_cache.get_multi(keys)
+            if missing:
+                generation = self.near_cache.generation()
+                response_map = self._gmulti_helper(missing, hashkey, socket_fn)
+                self.near_cache.fill(response_map.iteritems(), generation)
+                found.update(response_map)
+        if self.observer is not None:
+            self.observer.lookup(len(found), len(keys) - len(found))
+        return found
+
+    @instrument.observed
+    @deadline.bounded
+    def gets_multi(self, keys, hashkey=None):
+        """
+        The gets_multi command is get_multi for optimistic updates: it
+        returns a dictionary mapping found keys to (value, cas) pairs, to
+        write back with cas_multi. It always reads from the servers, not
+        the near cache.
+
+        >>> c = Client('localhost:11211')
+        >>> c.set_multi({'a':1, 'b':2})
+        []
+        >>> sorted((k, v) for k, (v, cas) in c.gets_multi(['a', 'b']).iteritems())
+        [('a', 1), ('b', 2)]
+        """
+        socket_fn = lambda key,opaque: _gd(M._getq, key, opaque, 0)
+        cas_map = {}
+        keys = [self._encode_key(key) for key in keys]
+        response_map = self._gmulti_helper(keys, hashkey, socket_fn, cas_map=cas_map)
+        return dict((key, (value, cas_map[key])) for key, value in response_map.iteritems())
+
+    def iter_multi(self, keys, hashkey=None, batch_size=1000, max_pending=1000, raw=False, timeout=None):
+        """
+        The iter_multi command is a generator version of get_multi: it
+        yields (key, value) pairs in the order the responses arrive from
+        all servers, skipping missing keys. Keys are fetched `batch_size`
+        at a time (the next batch while the current one is consumed) and
+        at most `max_pending` values wait to be consumed, so memory stays
+        bounded however many keys there are.
+
+        Batches are fetched on threads of their own rather than the
+        client's thread pool, so the loop body can use the client too.
+        Closing the generator early abandons the rest of the fetch.
+        The `timeout` covers the whole iteration, loop body included;
+        once it has passed, iteration just stops.
 
+        >>> c = Client('localhost:11211')
+        >>> c.set_multi({'a':1, 'b':2})
+        []
+        >>> sorted(c.iter_multi(['a', 'b', 'missing']))
+        [('a', 1), ('b', 2)]
+        """
+        socket_fn = lambda key,opaque: _gd(M._getq, key, opaque, 0)
+        results = Queue.Queue(max_pending)
+        closed = threading.Event()
+        keys = iter(keys)
+        if timeout is None:
+            timeout = self.timeout
+        until = None if timeout is None else time.time() + timeout
+
+        def emit(item):
+            while not closed.is_set():
+                try:
+                    results.put(item, True, 0.1)
+                    return
+                except Queue.Full:
+                    pass
+            raise _StreamClosed()
+
+        def fetch(pool, group):
+            exc_info = None
+            try:
+                with deadline.at(until):
+                    self._per_host_stream(pool, group, hashkey, emit, socket_fn, raw)
+            except _StreamClosed:
+                return
+            except MemcachedTimeoutError:
+                # end this fetch quietly; the consumer stops at the deadline
+                pass
+            except Exception:
+                exc_info = sys.exc_info()
+            try:
+                emit((_STREAM_DONE, exc_info))
+            except _StreamClosed:
+                pass
+
+        def start_batch():
+            batch = [self._encode_key(key) for key in itertools.islice(keys, batch_size)]
+            if not batch:
+                return 0
+            groups = self._group_keys(batch, hashkey)
+            for pool, group in groups.iteritems():
+                thread = threading.Thread(target=fetch, args=(pool, group), name="pymemc-iter-multi")
+                thread.daemon = True
+                thread.start()
+            return len(groups)
+
+        # start another batch whenever fewer than about one batch's worth
+        # of fetches are still running
+        low_water = len(self.hash.all_nodes())
+        running = 0
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and running <= low_water:
+                    started = start_batch()
+                    exhausted = not started
+                    running += started
+                if not running:
+                    return
+                try:
+                    key, value = results.get(True, None if until is None else max(until - time.time(), 0))
+                except Queue.Empty:
+                    return
+                if key is _STREAM_DONE:
+                    running -= 1
+                    if value is not None:
+                        raise value[0], value[1], value[2]
+                    continue
+                if isinstance(value, _ChunkManifest):
+                    with deadline.at(until):
+                        value = self._resolve_chunked({key: value}, raw).get(key)
+                    if value is None:
+                        continue
+                yield key, value
+        finally:
+            closed.set()
+
+    @instrument.observed
+    @deadline.bounded
+    @nearcache.invalidates
     def set(self, key, val, expire=0, cas=0):
         """
-        The set command sets a single key/val.
+        The set command sets a single key/val. Buffer objects (bytearray,
+        memoryview, buffer, mmap) are stored as raw bytes and written to
+        the socket without being copied; wrap other buffer providers,
+        such as numpy arrays, in one of those to store their bytes.
 
         >>> c = Client('localhost:11211')
         >>> c.set('bar', 'baz')
@@ -595,6 +1497,35 @@ class Client(object):
         failure_test = lambda status: status in (R._items_not_stored, R._key_exists, R._invalid_arguments, R._value_too_large)
         return self._per_host_s(key, val, expire, socket_fn, failure_test)
 
+    @instrument.observed
+    @deadline.bounded
+    @nearcache.invalidates
+    def cas_multi(self, kvmap, expire=0, hashkey=None):
+        """
+        The cas_multi command sets many keys at once, each only if it has
+        not changed since it was read: kvmap maps keys to (value, cas)
+        pairs, with cas tokens as returned by gets_multi. It returns a
+        list of the keys that were not set, those that were changed or
+        deleted in the meantime included, or an empty list if all were.
+
+        >>> c = Client('localhost:11211')
+        >>> c.set_multi({'c':3, 'd':4})
+        []
+        >>> found = c.gets_multi(['c', 'd'])
+        >>> c.set('d', 5)
+        True
+        >>> c.cas_multi(dict((k, (v + 1, cas)) for k, (v, cas) in found.iteritems()))
+        ['d']
+        """
+        tokens = dict((self._encode_key(key), cas) for key, (_, cas) in kvmap.iteritems())
+        values = dict((key, value) for key, (value, _) in kvmap.iteritems())
+        socket_fn = lambda key,value,opaque,expire,flags: _s(M._setq, key, value, opaque, expire, tokens[key], flags)
+        failure_test = lambda status: status != R._no_error
+        return self._smulti_helper(values, expire, hashkey, socket_fn, failure_test)
+
+    @instrument.observed
+    @deadline.bounded
+    @nearcache.invalidates
     def set_multi(self, kvmap, expire=0, hashkey=None):
         """
         The set_multi command returns a list of keys that could not be set, or
@@ -605,10 +1536,12 @@ class Client(object):
         []
         """
         socket_fn = lambda key,value,opaque,expire,flags: _s(M._setq, key, value, opaque, expire, 0, flags)
-        last_socket_fn = lambda key,value,opaque,expire,flags: _s(M._set, key, value, opaque, expire, 0, flags)
         failure_test = lambda status: status != R._no_error
-        return self._smulti_helper(kvmap, expire, hashkey, socket_fn, last_socket_fn, failure_test)
+        return self._smulti_helper(kvmap, expire, hashkey, socket_fn, failure_test)
 
+    @instrument.observed
+    @deadline.bounded
+    @nearcache.invalidates
     def add(self, key, val, expire=0, cas=0):
         """
         The add command sets a single key.
@@ -626,6 +1559,9 @@ class Client(object):
         failure_test = lambda status: status == R._key_exists
         return self._per_host_s(key, val, expire, socket_fn, failure_test)
 
+    @instrument.observed
+    @deadline.bounded
+    @nearcache.invalidates
     def add_multi(self, kvmap, expire=0, hashkey=None):
         """
         The add_multi command returns a list of keys that could not be added, or
@@ -638,10 +1574,12 @@ class Client(object):
         ['e', 'f']
         """
         socket_fn = lambda key,value,opaque,expire,flags: _s(M._addq, key, value, opaque, expire, 0, flags)
-        last_socket_fn = lambda key,value,opaque,expire,flags: _s(M._add, key, value, opaque, expire, 0, flags)
         failure_test = lambda status: status != R._no_error
-        return self._smulti_helper(kvmap, expire, hashkey, socket_fn, last_socket_fn, failure_test)
+        return self._smulti_helper(kvmap, expire, hashkey, socket_fn, failure_test)
 
+    @instrument.observed
+    @deadline.bounded
+    @nearcache.invalidates
     def replace(self, key, val, expire=0, cas=0):
         """
         The replace command replaces a single key.
@@ -659,6 +1597,9 @@ class Client(object):
         failure_test = lambda status: status == R._key_not_found or status == R._key_exists
         return self._per_host_s(key, val, expire, socket_fn, failure_test)
 
+    @instrument.observed
+    @deadline.bounded
+    @nearcache.invalidates
     def replace_multi(self, kvmap, expire=0, hashkey=None):
         """
         The replace_multi command returns a list of keys that could not be
@@ -673,14 +1614,17 @@ class Client(object):
         ['y', 'x']
         """
         socket_fn = lambda key,value,opaque,expire,flags: _s(M._replaceq, key, value, opaque, expire, 0, flags)
-        last_socket_fn = lambda key,value,opaque,expire,flags: _s(M._replace, key, value, opaque, expire, 0, flags)
         failure_test = lambda status: status == R._key_not_found or status == R._key_exists
-        return self._smulti_helper(kvmap, expire, hashkey, socket_fn, last_socket_fn, failure_test)
+        return self._smulti_helper(kvmap, expire, hashkey, socket_fn, failure_test)
 
+    @instrument.observed
+    @deadline.bounded
+    @nearcache.invalidates
     def delete(self, key, cas=0):
         """
         The delete command removes the value for a single key.
         True is returned on success, or False if the key was missing.
+        Only the manifest of a chunked value is removed, not its parts.
 
         >>> c = Client('localhost:11211')
         >>> c.set('delete_me', 'val')
@@ -695,6 +1639,9 @@ class Client(object):
         rval = self._per_host_g(key, socket_fn, failure_test, unpack=False)
         return rval or False
 
+    @instrument.observed
+    @deadline.bounded
+    @nearcache.invalidates
     def delete_multi(self, keys, hashkey=None):
         """
         The delete_multi command removes the value for each key
@@ -711,37 +1658,106 @@ class Client(object):
         ['l', 'k']
         """
         failures = []
-        if hashkey:
-            # user is forcing everything to specific shard
-            groups = [list(keys)]
-        else:
-            # group keys by the shard they live on
-            groups = collections.defaultdict(list)
-            for key in keys:
-                key = self._encode_key(key)
-                with self.sock4key(key) as sock:
-                    groups[id(sock)].append(key)
-            groups = groups.values()
+        keys = [self._encode_key(key) for key in keys]
 
-        for g in groups:
-            self.threadpool.add_task(self._per_host_delete, g, failures, hashkey=hashkey)
-        self.threadpool.wait()
+        missed = self._run_multi(self._per_host_delete, keys, hashkey, (failures,))
 
-        return failures
+        return _with_missed(failures, missed)
 
-    @connpool.instance_reconnect
-    def incr(self, key, expire=0, delta=1, initial=0):
+    @instrument.observed
+    @deadline.bounded
+    def touch(self, key, expire):
         """
-        Increment key by the specified amount. If the key does
-        not exist, create it with the value of initial.
+        The touch command sets a new expiration time for a key without
+        fetching or resending its value. True is returned on success,
+        or False if the key was missing. Only the manifest of a chunked
+        value is touched, not its parts.
 
         >>> c = Client('localhost:11211')
-        >>> c.incr('incr', initial=1)
-        1
-        >>> c.incr('incr')
-        2
-        >>> c.incr('incr', delta=2)
-        4
+        >>> c.set('touch_me', 'val')
+        True
+        >>> c.touch('touch_me', 3600)
+        True
+        >>> c.touch('missing', 3600)
+        False
+        """
+        socket_fn = lambda key: _t(M._touch, key, 0, expire)
+        failure_test = lambda status: status == R._key_not_found
+        rval = self._per_host_g(key, socket_fn, failure_test, unpack=False)
+        return rval or False
+
+    @instrument.observed
+    @deadline.bounded
+    def touch_multi(self, keys, expire, hashkey=None):
+        """
+        The touch_multi command sets a new expiration time for each key
+        in a list. It returns the keys that could not be touched, or an
+        empty list if all were.
+
+        >>> c = Client('localhost:11211')
+        >>> c.set_multi({'i':9, 'j':10})
+        []
+        >>> c.touch_multi(['i', 'j', 'k'], 3600)
+        ['k']
+        """
+        failures = []
+        keys = [self._encode_key(key) for key in keys]
+
+        missed = self._run_multi(self._per_host_touch, keys, hashkey, (expire, failures))
+
+        return _with_missed(failures, missed)
+
+    @instrument.observed
+    @deadline.bounded
+    def gat(self, key, expire, cas=False):
+        """
+        The gat (get and touch) command returns the value for a single
+        key, and sets a new expiration time for it in the same round trip.
+
+        >>> c = Client('localhost:11211')
+        >>> c.set('foo', 'bar')
+        True
+        >>> c.gat('foo', 3600)
+        'bar'
+        """
+        socket_fn = lambda key: _t(M._gat, key, 0, expire)
+        failure_test = lambda status: status == R._key_not_found
+        return self._per_host_g(key, socket_fn, failure_test, return_cas=cas)
+
+    @instrument.observed
+    @deadline.bounded
+    def gat_multi(self, keys, expire, hashkey=None):
+        """
+        The gat_multi command is get_multi that also sets a new
+        expiration time for every key found. Both always go to the
+        servers, not the near cache.
+
+        >>> c = Client('localhost:11211')
+        >>> c.set_multi({'a':1, 'b':2})
+        []
+        >>> c.gat_multi(['a', 'b'], 3600)
+        {'a': 1, 'b': 2}
+        """
+        socket_fn = lambda key,opaque: _t(M._gatq, key, opaque, expire)
+        keys = [self._encode_key(key) for key in keys]
+        return self._gmulti_helper(keys, hashkey, socket_fn)
+
+    @instrument.observed
+    @deadline.bounded
+    @nearcache.invalidates
+    @connpool.non_idempotent
+    def incr(self, key, expire=0, delta=1, initial=0):
+        """
+        Increment key by the specified amount. If the key does
+        not exist, create it with the value of initial.
+
+        >>> c = Client('localhost:11211')
+        >>> c.incr('incr', initial=1)
+        1
+        >>> c.incr('incr')
+        2
+        >>> c.incr('incr', delta=2)
+        4
         """
         key = self._encode_key(key)
         with self.sock4key(key) as sock:
@@ -751,10 +1767,13 @@ class Client(object):
         if status != R._no_error:
             raise MemcachedError("%d: %s" % (status, extra))
 
-        value, = struct.unpack('!Q', extra)
+        value, = UINT64.unpack(extra)
         return value
 
-    @connpool.instance_reconnect
+    @instrument.observed
+    @deadline.bounded
+    @nearcache.invalidates
+    @connpool.non_idempotent
     def decr(self, key, expire=0, delta=1, initial=0):
         """
         Decrement key by the specified amount. If the key does
@@ -776,9 +1795,47 @@ class Client(object):
         if status != R._no_error:
             raise MemcachedError("%d: %s" % (status, extra))
 
-        value, = struct.unpack('!Q', extra)
+        value, = UINT64.unpack(extra)
         return value
 
+    @instrument.observed
+    @deadline.bounded
+    @nearcache.invalidates
+    def incr_multi(self, kvmap, expire=0, initial=0, hashkey=None):
+        """
+        The incr_multi command increments many keys at once: kvmap maps
+        keys to their deltas, and keys that don't exist are created with
+        the value of initial. It returns a dictionary mapping keys to
+        their new values. Keys that could not be incremented, such as
+        those holding values that are not numbers, are omitted.
+
+        >>> c = Client('localhost:11211')
+        >>> sorted(c.incr_multi({'hits': 1, 'bytes': 512}, initial=1).items())
+        [('bytes', 1), ('hits', 1)]
+        >>> sorted(c.incr_multi({'hits': 1, 'bytes': 512}).items())
+        [('bytes', 513), ('hits', 2)]
+        """
+        return self._idmulti_helper(kvmap, M._increment, expire, initial, hashkey)
+
+    @instrument.observed
+    @deadline.bounded
+    @nearcache.invalidates
+    def decr_multi(self, kvmap, expire=0, initial=0, hashkey=None):
+        """
+        The decr_multi command decrements many keys at once, like
+        incr_multi. Values never go below 0.
+
+        >>> c = Client('localhost:11211')
+        >>> c.decr_multi({'left': 1}, initial=10)
+        {'left': 10}
+        >>> c.decr_multi({'left': 3})
+        {'left': 7}
+        """
+        return self._idmulti_helper(kvmap, M._decrement, expire, initial, hashkey)
+
+    @instrument.observed
+    @deadline.bounded
+    @nearcache.invalidates
     def append(self, key, val):
         """
         The append command will prepend the specified value to
@@ -796,6 +1853,9 @@ class Client(object):
         failure_test = lambda status: status == R._items_not_stored
         return self._per_host_s(key, val, 0, socket_fn, failure_test, serialize=False)
 
+    @instrument.observed
+    @deadline.bounded
+    @nearcache.invalidates
     def prepend(self, key, val):
         """
         The prepend command will prepend the specified value to
@@ -837,11 +1897,18 @@ class Client(object):
         >>> c = Client('localhost:11211')
         >>> c.close()
         """
-        self.quit()
-        for r in self.hash.all_nodes():
-            with connpool.pooled_connection(r) as sock:
-                sock.close()
-
+        try:
+            self.quit()
+        finally:
+            for pool in self.hash.all_nodes():
+                pool.clear_pool()
+            if self.encode_processes and self.encode_pool is not None:
+                self.encode_pool.terminate()
+                self.encode_pool = None
+                _process_encoders.pop(id(self), None)
+
+    @instrument.observed
+    @deadline.bounded
     @connpool.instance_reconnect
     def flush_all(self, expire=0):
         """
@@ -858,8 +1925,12 @@ class Client(object):
                 (_, _, _, _, _, status, _, _, _, extra) = sockresponse(sock)
                 if status != R._no_error:
                     raise MemcachedError("%d: %s" % (status, extra))
+        if self.near_cache is not None:
+            self.near_cache.clear()
         return True
 
+    @instrument.observed
+    @deadline.bounded
     def stats(self):
         """
         The stats command returns all statistics from the server.
@@ -870,12 +1941,32 @@ class Client(object):
         """
         host_stats_map = {}
 
-        for sock in self.hash.all_nodes():
-            self.threadpool.add_task(self._per_host_stats, sock, host_stats_map)
-        self.threadpool.wait()
+        futures = [
+            self.threadpool.add_task(self._per_host_stats, pool, host_stats_map)
+            for pool in self.hash.all_nodes()
+        ]
+        threadpool.wait_deadline(futures)
+
+        return dict(host_stats_map)
 
-        return host_stats_map
+    def pool_stats(self):
+        """
+        The pool_stats command returns the connection pool counters for
+        each server: connections open, idle, created, reused, discarded
+        (closed after an error, or with the pool full), reaped (closed
+        after idling), and failed_checks, plus how many times callers
+        waited for a connection (waits) and for how long in all
+        (wait_time, in seconds).
 
+        >>> c = Client('localhost:11211')
+        >>> sorted(c.pool_stats().values()[0]) #doctest: +ELLIPSIS
+        ['created', 'discarded', ...]
+        """
+        return dict((pool.address, pool.stats())
+                    for pool in list(self.hash.all_nodes()) + self.hash.down_nodes())
+
+    @instrument.observed
+    @deadline.bounded
     @connpool.instance_reconnect
     def noop(self):
         """
@@ -894,6 +1985,8 @@ class Client(object):
                     raise MemcachedError("%d: %s" % (status, extra))
         return True
 
+    @instrument.observed
+    @deadline.bounded
     def version(self):
         """
         The version command returns the server's version string.
@@ -904,11 +1997,1092 @@ class Client(object):
         """
         host_version_map = {}
 
-        for r in self.hash.all_nodes():
-            self.threadpool.add_task(self._per_host_version, r, host_version_map)
-        self.threadpool.wait()
+        futures = [
+            self.threadpool.add_task(self._per_host_version, pool, host_version_map)
+            for pool in self.hash.all_nodes()
+        ]
+        threadpool.wait_deadline(futures)
+
+        return dict(host_version_map)
+
+class _SelectPoller(object):
+    """A select.poll lookalike for platforms that only have select()"""
+    def __init__(self):
+        self._fds = {}
+
+    def register(self, fd, events):
+        self._fds[fd] = events
+
+    modify = register
+
+    def unregister(self, fd):
+        self._fds.pop(fd, None)
+
+    def poll(self, timeout=None):
+        rfds = [fd for fd, events in self._fds.iteritems() if events & POLLIN]
+        wfds = [fd for fd, events in self._fds.iteritems() if events & POLLOUT]
+        if timeout is not None:
+            timeout = timeout / 1000.0
+        rlist, wlist, _ = select.select(rfds, wfds, [], timeout)
+        ready = collections.defaultdict(int)
+        for fd in rlist:
+            ready[fd] |= POLLIN
+        for fd in wlist:
+            ready[fd] |= POLLOUT
+        return ready.items()
+
+if hasattr(select, 'poll'):
+    POLLIN, POLLOUT = select.POLLIN, select.POLLOUT
+    POLLERR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+    _poller = select.poll
+else:
+    POLLIN, POLLOUT, POLLERR = 1, 4, 0
+    _poller = _SelectPoller
+
+class _AsyncOp(object):
+    """
+    A request, or a pipeline of quiet requests closed by a noop, queued
+    on an AsyncConnection.
+
+    `build(opaque)` returns the request packets, numbering them from
+    `opaque`. `on_response(index, response)` sees every response other
+    than the closing noop, where `index` is the position of the packet
+    it answers; for non-quiet ops it returns True on the last response.
+    `result()`, if given, produces the value the op's future resolves to.
+    """
+    __slots__ = ('build', 'count', 'on_response', 'result', 'quiet',
+                 'future', 'base', 'exc_info')
+
+    def __init__(self, build, count, on_response, result, quiet):
+        self.build = build
+        self.count = count
+        self.on_response = on_response
+        self.result = result
+        self.quiet = quiet
+        self.future = threadpool.Future()
+        self.base = 0
+        self.exc_info = None
+
+    def finish(self):
+        if self.exc_info is None:
+            try:
+                self.future.set_result(self.result and self.result())
+                return
+            except Exception:
+                self.exc_info = sys.exc_info()
+        self.future.set_exception(self.exc_info)
+
+def _fails_connection(method):
+    """
+    Fail an AsyncConnection's ops with whatever error `method` raises,
+    rather than let it escape into (and stop) the event loop
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        try:
+            method(self, *args)
+        except Exception:
+            self.fail(sys.exc_info())
+    return wrapper
+
+class AsyncConnection(object):
+    """
+    A single non-blocking connection to one server, driven by an
+    EventLoop. Any thread may submit ops: they get unique opaques and
+    are queued for the loop to write. The server answers requests in
+    order, so each response belongs to the oldest op still in flight.
+
+    If ops are in flight and nothing is read from or written to the
+    server for `io_timeout` seconds, the connection is dropped and they
+    fail with socket.timeout.
+    """
+    def __init__(self, loop, address, connect_timeout, io_timeout=None):
+        self.loop = loop
+        self.address = address
+        self.connect_timeout = connect_timeout
+        self.io_timeout = io_timeout
+        self.sock = None
+        self.connecting = False
+        self.connect_deadline = None
+        self.last_activity = 0
+        self._addrinfo = []
+        self._events = 0
+        self._lock = threading.Lock()
+        self._outbuf = collections.deque() # buffers waiting to be written
+        self._wpos = 0 # bytes of _outbuf[0] already written
+        self._inflight = collections.deque() # ops waiting on responses
+        self._opaque = 0
+
+    def __str__(self):
+        # named like its AsyncServer
+        return "%s:%d" % self.address
+
+    def submit(self, op):
+        self.loop.check_running()
+        with self._lock:
+            if self._opaque + op.count >= 0xffffffff:
+                self._opaque = 0
+            op.base = self._opaque
+            self._opaque += op.count
+        # build outside the lock, so that a large op doesn't hold up
+        # other submitters
+        packets = op.build(op.base)
+        if op.quiet:
+            packets.append(_qnsv(M._noop))
+        buffers = list(sendbatches(packets))
+        with self._lock:
+            if not self._inflight:
+                # the server has had no reason to talk to us until now
+                self.last_activity = time.time()
+            # the loop writes _outbuf without the lock, so the op must
+            # be in flight before its request can go out
+            self._inflight.append(op)
+            self._outbuf.extend(buffers)
+        if not self.loop.wake(self):
+            # the loop stopped before it could see the op
+            self._fail_ops(self.loop.stopped_exc_info())
+        return op.future
+
+    def pending(self):
+        return len(self._inflight)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    # everything below runs on the event loop thread
+
+    def deadline(self):
+        """When check_timeout next has something to do, if ever"""
+        if self.connecting:
+            return self.connect_deadline
+        if self._inflight and self.io_timeout is not None and self.sock is not None:
+            return self.last_activity + self.io_timeout
+        return None
+
+    @_fails_connection
+    def update(self):
+        """Connect if there is work queued, and poll for what we need"""
+        if self.sock is None:
+            if self._outbuf:
+                self._connect()
+            return
+        events = POLLIN
+        if self._outbuf or self.connecting:
+            events |= POLLOUT
+        if events != self._events:
+            self.loop.modify(self, events)
+            self._events = events
+
+    def _connect(self):
+        if not self._addrinfo:
+            host, port = self.address
+            try:
+                self._addrinfo = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            except socket.error:
+                self.fail(sys.exc_info())
+                return
+        family, socktype, proto, _, sockaddr = self._addrinfo.pop(0)
+        sock = socket.socket(family, socktype, proto)
+        sock.setblocking(0)
+        err = sock.connect_ex(sockaddr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self._connect_failed(socket.error(err, os.strerror(err)))
+            return
+        self.sock = bufsock.BufferedSocket(sock)
+        self.connecting = True
+        self.connect_deadline = time.time() + self.connect_timeout
+        self._events = POLLIN | POLLOUT
+        self.loop.register(self, self._events)
+
+    def _connect_failed(self, error):
+        if self.sock is not None:
+            self.loop.unregister(self)
+            self.sock.close()
+            self.sock = None
+        if self._addrinfo:
+            # try the next address the host name resolved to
+            self._connect()
+            return
+        try:
+            raise error
+        except socket.error:
+            self.fail(sys.exc_info())
+
+    @_fails_connection
+    def check_timeout(self, now):
+        if self.connecting:
+            if now >= self.connect_deadline:
+                self._addrinfo = []
+                self._connect_failed(socket.timeout('timed out'))
+        elif self._inflight and self.io_timeout is not None and \
+                now >= self.last_activity + self.io_timeout:
+            try:
+                raise socket.timeout('timed out')
+            except socket.timeout:
+                self.fail(sys.exc_info())
+
+    @_fails_connection
+    def handle_events(self, events):
+        if self.connecting:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self._connect_failed(socket.error(err, os.strerror(err)))
+                return
+            if not events & POLLOUT:
+                return
+            self.connecting = False
+            self._addrinfo = []
+            self.last_activity = time.time()
+            self.sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        if events & (POLLIN | POLLERR):
+            self._handle_read()
+        if events & POLLOUT and self.sock is not None:
+            self._handle_write()
+
+    def _handle_write(self):
+        outbuf = self._outbuf
+        while outbuf:
+            if self._wpos == 0 and len(outbuf) > 1 and len(outbuf[0]) < SEND_BATCH_SIZE \
+                    and isinstance(outbuf[0], str):
+                # ops queued separately can still share a write
+                batch = [outbuf.popleft()]
+                size = len(batch[0])
+                while outbuf and size + len(outbuf[0]) <= SEND_BATCH_SIZE \
+                        and isinstance(outbuf[0], str):
+                    size += len(outbuf[0])
+                    batch.append(outbuf.popleft())
+                outbuf.appendleft(''.join(batch))
+            buf = outbuf[0]
+            try:
+                sent = self.sock.send(_tail(buf, self._wpos))
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if sent:
+                # quiet pipelines get no replies until their closing
+                # noop, so a long write is progress too
+                self.last_activity = time.time()
+                self._wpos += sent
+            if self._wpos < len(buf):
+                return
+            outbuf.popleft()
+            self._wpos = 0
+
+    def _handle_read(self):
+        try:
+            self.sock.fill()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        self.last_activity = time.time()
+        for response in sockresponses(self.sock):
+            if not self._inflight:
+                raise MemcachedError("response received with no request in flight")
+            op = self._inflight[0]
+            if op.quiet and response[1] == M._noop:
+                done = True
+            else:
+                try:
+                    done = op.on_response(response[7] - op.base, response)
+                except Exception:
+                    op.exc_info = op.exc_info or sys.exc_info()
+                    done = not op.quiet
+            if done:
+                self._inflight.popleft()
+                op.finish()
+
+    def fail(self, exc_info):
+        """Drop the connection, failing everything queued or in flight"""
+        if self.sock is not None:
+            self.loop.unregister(self)
+            self.sock.close()
+            self.sock = None
+        self.connecting = False
+        self._addrinfo = []
+        self._events = 0
+        self._fail_ops(exc_info)
+
+    def _fail_ops(self, exc_info):
+        """Fail everything queued or in flight, from any thread"""
+        with self._lock:
+            ops, self._inflight = self._inflight, collections.deque()
+            self._outbuf.clear()
+            self._wpos = 0
+        for op in ops:
+            op.exc_info = exc_info
+            op.finish()
+
+class AsyncServer(object):
+    """
+    The connections an async client keeps to one server. Ops go to the
+    connection with the fewest ops in flight, so a slow pipeline on one
+    connection does not hold up everything else bound for the server.
+    """
+    def __init__(self, loop, address, connect_timeout, io_timeout=None, connections=1):
+        self.address = address
+        self.connections = [AsyncConnection(loop, address, connect_timeout, io_timeout)
+                            for _ in xrange(max(1, connections))]
+
+    def __str__(self):
+        # the same ring name as connpool.SocketConnectionPool's
+        return "%s:%d" % self.address
+
+    def submit(self, op):
+        conns = self.connections
+        if len(conns) == 1:
+            return conns[0].submit(op)
+        return min(conns, key=lambda conn: conn.pending()).submit(op)
+
+    def peername(self):
+        """The resolved (host, port) of a live connection, if there is one"""
+        for conn in self.connections:
+            if conn.sock is not None and not conn.connecting:
+                return tuple(conn.sock.getpeername())
+        return self.address
+
+class EventLoop(threading.Thread):
+    """
+    A single thread that multiplexes every AsyncConnection of a client
+    with poll(). Other threads hand it work through wake().
+
+    Once the loop stops, whether closed or because of an error of its
+    own, every op still queued or in flight fails, and so does any op
+    submitted after that.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self, name="pymemc-eventloop")
+        self.daemon = True
+        self._poller = _poller()
+        self._conns = {} # fd -> connection
+        self._lock = threading.Lock()
+        self._woken = set()
+        self._signalled = False
+        self._known = set() # every connection that has been handed work
+        self.closed = False
+        self.stopped = False
+        self.exc_info = None # what stopped the loop, if not close()
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._poller.register(self._wake_r, POLLIN)
+        self.start()
+
+    def wake(self, conn):
+        """
+        Have the loop look at `conn`. Returns False if the loop has
+        stopped, and will not.
+        """
+        with self._lock:
+            if self.stopped:
+                return False
+            self._woken.add(conn)
+            self._known.add(conn)
+            if not self._signalled:
+                self._signalled = True
+                # under the lock, so that run() can't close the pipe
+                # in the meantime
+                try:
+                    os.write(self._wake_w, 'x')
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+        return True
+
+    def stopped_exc_info(self):
+        """The error ops fail with once the loop has stopped"""
+        if self.exc_info is not None:
+            return self.exc_info
+        try:
+            raise MemcachedConnectionClosedError('Client closed')
+        except MemcachedConnectionClosedError:
+            return sys.exc_info()
+
+    def check_running(self):
+        """Raise the error ops would fail with if the loop is closed or stopped"""
+        if self.closed or self.stopped:
+            exc_info = self.stopped_exc_info()
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def register(self, conn, events):
+        fd = conn.fileno()
+        self._poller.register(fd, events)
+        self._conns[fd] = conn
+
+    def modify(self, conn, events):
+        self._poller.modify(conn.fileno(), events)
+
+    def unregister(self, conn):
+        fd = conn.fileno()
+        if self._conns.pop(fd, None) is not None:
+            self._poller.unregister(fd)
+
+    def close(self):
+        self.closed = True
+        self.wake(None)
+        if threading.current_thread() is not self:
+            self.join()
+
+    def _timeout(self):
+        deadlines = [conn.deadline() for conn in self._conns.itervalues()]
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        if not deadlines:
+            return None
+        return max(0, (min(deadlines) - time.time()) * 1000)
+
+    def run(self):
+        try:
+            self._run()
+        except Exception:
+            self.exc_info = sys.exc_info()
+            logger.exception("pymemc event loop failed")
+        finally:
+            with self._lock:
+                self.stopped = True
+                known = list(self._known)
+                os.close(self._wake_r)
+                os.close(self._wake_w)
+            exc_info = self.stopped_exc_info()
+            for conn in known:
+                if conn is not None:
+                    try:
+                        conn.fail(exc_info)
+                    except Exception:
+                        # at least don't leave its callers waiting
+                        conn._fail_ops(exc_info)
+
+    def _run(self):
+        while not self.closed:
+            try:
+                events = self._poller.poll(self._timeout())
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self._wake_r:
+                    try:
+                        os.read(self._wake_r, 4096)
+                    except OSError:
+                        pass
+                    continue
+                conn = self._conns.get(fd)
+                if conn is not None:
+                    conn.handle_events(event)
+                    conn.update()
+            with self._lock:
+                woken, self._woken = self._woken, set()
+                self._signalled = False
+            for conn in woken:
+                if conn is not None:
+                    conn.update()
+            now = time.time()
+            for conn in self._conns.values():
+                conn.check_timeout(now)
+
+def _gather(futures, combine):
+    """
+    A future that resolves to combine() once all of `futures` have
+    finished, or fails with the first of their errors.
+    """
+    if not futures:
+        return threadpool.resolved(combine())
+    future = threadpool.Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        for f in futures:
+            if f.exception() is not None:
+                future.set_exception(f.exc_info())
+                return
+        try:
+            future.set_result(combine())
+        except Exception:
+            future.set_exception(sys.exc_info())
+
+    for f in futures:
+        f.add_done_callback(on_done)
+    return future
+
+class AsyncClient(BaseClient):
+    """
+    A client whose calls return futures instead of blocking.
+
+    Every server gets `connections_per_server` (by default one)
+    non-blocking connections, and one event loop thread drives all of
+    them, so any number of requests can be in flight at once without a
+    thread (or a socket) per request. Requests from different callers
+    are tagged with unique opaques and share the connection, and often
+    the same TCP segments. Requests use the same packets and value
+    serialization as Client, so the two can share a cache. Futures resolve on the event loop thread; use
+    future.result() to wait, or add_done_callback() for a callback,
+    which should be quick since it holds up the loop.
+
+    Failed requests are not retried: a connection error fails every
+    request in flight on that connection, and the next request
+    reconnects.
+    """
+    def __init__(self,
+                 host_list,
+                 encode_fn=pickle.dumps,
+                 decode_fn=pickle.loads,
+                 compress_fn=None,
+                 decompress_fn=None,
+                 ch_replicas=None,
+                 default_encoding="utf-8",
+                 max_value_size=1048576,
+                 connect_timeout_seconds=1,
+                 ch_hash_fn=None,
+                 ch_ketama=False,
+                 connections_per_server=1,
+                 serializer=None,
+                 compression=None,
+                 compress_min_size=1024,
+                 compress_min_savings=0.1):
+        """
+        Create a new instance of the pymemc async client.
+
+        >>> c = AsyncClient('localhost:11211')
+        >>> c.flush_all().result()
+        True
+        """
+        if isinstance(host_list, str):
+            host_list = [host_list]
+        if not isinstance(host_list, list):
+            raise Exception("host_list must be a list or single host str")
+
+        super(AsyncClient, self).__init__(encode_fn, decode_fn, compress_fn,
+                                          decompress_fn, default_encoding,
+                                          max_value_size, serializer, compression,
+                                          compress_min_size, compress_min_savings)
+        self.loop = EventLoop()
+        self.io_timeout_seconds = connect_timeout_seconds
+        if ch_replicas is None:
+            ch_replicas = chash.KETAMA_REPLICAS if ch_ketama else 100
+        self.hash = chash.ConsistentHash(replicas=ch_replicas, hash_fn=ch_hash_fn, ketama=ch_ketama)
+        for host_str in host_list:
+            server = AsyncServer(self.loop, self._parse_host(host_str), connect_timeout_seconds,
+                                 connect_timeout_seconds, connections_per_server)
+            self.hash.add_node(server)
+
+    def _submit(self, server, build, count, on_response, result, quiet=False):
+        return server.submit(_AsyncOp(build, count, on_response, result, quiet))
+
+    def _single(self, server, packet, on_response):
+        """Send one non-quiet request; on_response's return value is the result"""
+        rval = []
+        def handle(index, response):
+            rval.append(on_response(response))
+            return True
+        return self._submit(server, lambda opaque: [packet], 1, handle, lambda: rval[0])
+
+    def _all_nodes(self, packet, on_response, combine):
+        """Send `packet` to every server and gather the results"""
+        results = {}
+        futures = []
+        for server in self.hash.all_nodes():
+            def handle(response, server=server):
+                results[server.peername()] = on_response(response)
+            futures.append(self._single(server, packet, handle))
+        return _gather(futures, lambda: combine(results))
+
+    def _g(self, key, packet_fn, failure_test, unpack=True, return_cas=False):
+        """
+        helper for "get-like" commands
+        """
+        key = self._encode_key(key)
+        if (len(key) > MAX_KEY_SIZE):
+            return threadpool.resolved(None)
+
+        def on_response(response):
+            (_, _, _, _, _, status, _, _, cas, extra) = response
+            if status != R._no_error:
+                if failure_test(status):
+                    return None
+                raise MemcachedError("%d: %s" % (status, extra))
+            if not unpack:
+                return True
+            if self._chunked(extra):
+                # only Client reassembles chunked values
+                return None
+            value = self._unpack_value(extra)
+            if return_cas:
+                return value, cas
+            return value
+        return self._single(self.hash.get_node(key), packet_fn(key), on_response)
+
+    def _gmulti(self, keys, hashkey, socket_fn):
+        """
+        helper for "multi_get-like" commands
+        """
+        response_map = {}
+        futures = []
+        keys = [self._encode_key(key) for key in keys]
+        for server, group in self._group_keys(keys, hashkey).iteritems():
+            def on_response(index, response, group=group):
+                (_, _, _, _, _, status, _, _, _, extra) = response
+                if status == R._no_error and not self._chunked(extra):
+                    response_map[group[index]] = self._unpack_value(extra)
+            def build(opaque, group=group):
+                return [socket_fn(key, opaque+i) for i,key in enumerate(group)]
+            futures.append(self._submit(server, build, len(group), on_response, None, quiet=True))
+        return _gather(futures, lambda: response_map)
+
+    def _s(self, key, val, expire, socket_fn, failure_test, serialize=True):
+        """
+        helper for "set-like" commands
+        """
+        if serialize:
+            flags, val = self._serialize(val)
+        else:
+            flags = 0
+        key = self._encode_key(key)
+        if (len(val) > self.max_value_size) or (len(key) > MAX_KEY_SIZE):
+            return threadpool.resolved(False)
+
+        def on_response(response):
+            (_, _, _, _, _, status, _, _, _, extra) = response
+            if status != R._no_error:
+                if failure_test(status):
+                    return False
+                raise MemcachedError("%d: %s" % (status, extra))
+            return True
+        return self._single(self.hash.get_node(key), socket_fn(key, val, expire, flags), on_response)
+
+    def _smulti(self, kvmap, expire, hashkey, socket_fn, failure_test):
+        """
+        helper for "multi_set-like" commands
+        """
+        failures = []
+        futures = []
+        encoded = {}
+        for key, val in kvmap.iteritems():
+            key = self._encode_key(key)
+            flags, val = self._serialize(val)
+            if (len(val) > self.max_value_size) or (len(key) > MAX_KEY_SIZE):
+                failures.append(key)
+            else:
+                encoded[key] = (flags, val)
+
+        for server, keys in self._group_keys(encoded, hashkey).iteritems():
+            def on_response(index, response, keys=keys):
+                (_, _, _, _, _, status, _, _, _, extra) = response
+                if status != R._no_error:
+                    if failure_test(status):
+                        failures.append(keys[index])
+                    else:
+                        raise MemcachedError("%d: %s" % (status, extra))
+            def build(opaque, keys=keys):
+                return [socket_fn(key, encoded[key][1], opaque+i, expire, encoded[key][0])
+                        for i,key in enumerate(keys)]
+            futures.append(self._submit(server, build, len(keys), on_response, None, quiet=True))
+        return _gather(futures, lambda: failures)
+
+    def _id(self, opcode, key, expire, delta, initial):
+        """
+        helper for incr/decr
+        """
+        key = self._encode_key(key)
+        def on_response(response):
+            (_, _, _, _, _, status, _, _, _, extra) = response
+            if status != R._no_error:
+                raise MemcachedError("%d: %s" % (status, extra))
+            value, = UINT64.unpack(extra)
+            return value
+        return self._single(self.hash.get_node(key), _id(opcode, key, 0, expire, 0, delta, initial), on_response)
+
+    def get(self, key, cas=False):
+        """
+        The get command returns a future for the value of a single key.
+
+        >>> c = AsyncClient('localhost:11211')
+        >>> c.set('foo', 'bar').result()
+        True
+        >>> c.get('foo').result()
+        'bar'
+        """
+        socket_fn = lambda key: _gd(M._get, key, 0, 0)
+        failure_test = lambda status: status == R._key_not_found
+        return self._g(key, socket_fn, failure_test, return_cas=cas)
+
+    def get_multi(self, keys, hashkey=None):
+        """
+        The get_multi command returns a future for a dictionary mapping
+        found keys to their values.
+
+        >>> c = AsyncClient('localhost:11211')
+        >>> c.set_multi({'a':1, 'b':2}).result()
+        []
+        >>> c.get_multi(['a', 'b']).result()
+        {'a': 1, 'b': 2}
+        """
+        socket_fn = lambda key,opaque: _gd(M._getq, key, opaque, 0)
+        return self._gmulti(keys, hashkey, socket_fn)
+
+    def touch(self, key, expire):
+        """
+        The touch command sets a new expiration time for a key. The future
+        resolves to True on success, or False if the key was missing.
+        """
+        socket_fn = lambda key: _t(M._touch, key, 0, expire)
+        failure_test = lambda status: status == R._key_not_found
+        future = threadpool.Future()
+        def on_done(f):
+            if f.exception() is not None:
+                future.set_exception(f.exc_info())
+            else:
+                future.set_result(f.result() or False)
+        self._g(key, socket_fn, failure_test, unpack=False).add_done_callback(on_done)
+        return future
+
+    def gat(self, key, expire, cas=False):
+        """
+        The gat command returns a future for the value of a single key,
+        and sets a new expiration time for it.
+        """
+        socket_fn = lambda key: _t(M._gat, key, 0, expire)
+        failure_test = lambda status: status == R._key_not_found
+        return self._g(key, socket_fn, failure_test, return_cas=cas)
+
+    def gat_multi(self, keys, expire, hashkey=None):
+        """
+        The gat_multi command returns a future for a dictionary mapping
+        found keys to their values, and sets a new expiration time for
+        each of them.
+        """
+        socket_fn = lambda key,opaque: _t(M._gatq, key, opaque, expire)
+        return self._gmulti(keys, hashkey, socket_fn)
+
+    def set(self, key, val, expire=0, cas=0):
+        """
+        The set command sets a single key/val.
+
+        >>> c = AsyncClient('localhost:11211')
+        >>> c.set('bar', 'baz').result()
+        True
+        """
+        socket_fn = lambda key,val,expire,flags: _s(M._set, key, val, 0, expire, cas, flags)
+        failure_test = lambda status: status in (R._items_not_stored, R._key_exists, R._invalid_arguments, R._value_too_large)
+        return self._s(key, val, expire, socket_fn, failure_test)
+
+    def set_multi(self, kvmap, expire=0, hashkey=None):
+        """
+        The set_multi command returns a future for the list of keys that
+        could not be set.
+
+        >>> c = AsyncClient('localhost:11211')
+        >>> c.set_multi({'c':3, 'd':4}).result()
+        []
+        """
+        socket_fn = lambda key,value,opaque,expire,flags: _s(M._setq, key, value, opaque, expire, 0, flags)
+        failure_test = lambda status: status != R._no_error
+        return self._smulti(kvmap, expire, hashkey, socket_fn, failure_test)
+
+    def add(self, key, val, expire=0, cas=0):
+        """
+        The add command sets a single key.
+        Add MUST fail if the item already exists.
+
+        >>> c = AsyncClient('localhost:11211')
+        >>> c.add('async_added', 'val').result()
+        True
+        >>> c.add('async_added', 'newval').result()
+        False
+        """
+        socket_fn = lambda key,val,expire,flags: _s(M._add, key, val, 0, expire, cas, flags)
+        failure_test = lambda status: status == R._key_exists
+        return self._s(key, val, expire, socket_fn, failure_test)
+
+    def add_multi(self, kvmap, expire=0, hashkey=None):
+        """
+        The add_multi command returns a future for the list of keys that
+        could not be added.
+        """
+        socket_fn = lambda key,value,opaque,expire,flags: _s(M._addq, key, value, opaque, expire, 0, flags)
+        failure_test = lambda status: status != R._no_error
+        return self._smulti(kvmap, expire, hashkey, socket_fn, failure_test)
+
+    def replace(self, key, val, expire=0, cas=0):
+        """
+        The replace command replaces a single key.
+        Replace MUST fail if the item doesn't exist.
+        """
+        socket_fn = lambda key,val,expire,flags: _s(M._replace, key, val, 0, expire, cas, flags)
+        failure_test = lambda status: status == R._key_not_found or status == R._key_exists
+        return self._s(key, val, expire, socket_fn, failure_test)
+
+    def replace_multi(self, kvmap, expire=0, hashkey=None):
+        """
+        The replace_multi command returns a future for the list of keys
+        that could not be replaced.
+        """
+        socket_fn = lambda key,value,opaque,expire,flags: _s(M._replaceq, key, value, opaque, expire, 0, flags)
+        failure_test = lambda status: status == R._key_not_found or status == R._key_exists
+        return self._smulti(kvmap, expire, hashkey, socket_fn, failure_test)
+
+    def delete(self, key, cas=0):
+        """
+        The delete command removes the value for a single key. The future
+        resolves to True on success, or False if the key was missing.
+        """
+        socket_fn = lambda key: _gd(M._delete, key, 0, cas)
+        failure_test = lambda status: status == R._key_not_found or status == R._key_exists
+        future = threadpool.Future()
+        def on_done(f):
+            if f.exception() is not None:
+                future.set_exception(f.exc_info())
+            else:
+                future.set_result(f.result() or False)
+        self._g(key, socket_fn, failure_test, unpack=False).add_done_callback(on_done)
+        return future
+
+    def delete_multi(self, keys, hashkey=None):
+        """
+        The delete_multi command returns a future for the list of keys
+        that could not be removed.
+        """
+        failures = []
+        futures = []
+        keys = [self._encode_key(key) for key in keys]
+        for server, group in self._group_keys(keys, hashkey).iteritems():
+            def on_response(index, response, group=group):
+                if response[5] != R._no_error:
+                    failures.append(group[index])
+            def build(opaque, group=group):
+                return [_gd(M._deleteq, key, opaque+i, 0) for i,key in enumerate(group)]
+            futures.append(self._submit(server, build, len(group), on_response, None, quiet=True))
+        return _gather(futures, lambda: failures)
+
+    def incr(self, key, expire=0, delta=1, initial=0):
+        """
+        Increment key by the specified amount. If the key does
+        not exist, create it with the value of initial.
+
+        >>> c = AsyncClient('localhost:11211')
+        >>> c.incr('async_incr', initial=1).result()
+        1
+        >>> c.incr('async_incr').result()
+        2
+        """
+        return self._id(M._increment, key, expire, delta, initial)
+
+    def decr(self, key, expire=0, delta=1, initial=0):
+        """
+        Decrement key by the specified amount. If the key does
+        not exist, create it with the value of initial.
+        """
+        return self._id(M._decrement, key, expire, delta, initial)
+
+    def append(self, key, val):
+        """
+        The append command will append the specified value to
+        the requested key.
+        """
+        socket_fn = lambda key,val,expire,flags: _ap(M._append, key, val, 0, 0)
+        failure_test = lambda status: status == R._items_not_stored
+        return self._s(key, val, 0, socket_fn, failure_test, serialize=False)
+
+    def prepend(self, key, val):
+        """
+        The prepend command will prepend the specified value to
+        the requested key.
+        """
+        socket_fn = lambda key,val,expire,flags: _ap(M._prepend, key, val, 0, 0)
+        failure_test = lambda status: status == R._items_not_stored
+        return self._s(key, val, 0, socket_fn, failure_test, serialize=False)
+
+    def _check_status(self, response):
+        (_, _, _, _, _, status, _, _, _, extra) = response
+        if status != R._no_error:
+            raise MemcachedError("%d: %s" % (status, extra))
+
+    def flush_all(self, expire=0):
+        """
+        The flush command flushes all data the DB. Optionally this will happen
+        after `expire` seconds.
+        """
+        return self._all_nodes(_f(M._flush, expire), self._check_status, lambda results: True)
+
+    def noop(self):
+        """
+        The noop command can be used as a keep-alive.
+        """
+        return self._all_nodes(_qnsv(M._noop), self._check_status, lambda results: True)
+
+    def version(self):
+        """
+        The version command returns a future for each server's version
+        string, keyed by server address.
+        """
+        def on_response(response):
+            self._check_status(response)
+            return response[9][response[2]:]
+        return self._all_nodes(_qnsv(M._version), on_response, lambda results: results)
+
+    def stats(self):
+        """
+        The stats command returns a future for all statistics from each
+        server, keyed by server address.
+        """
+        host_stats_map = {}
+        futures = []
+        for server in self.hash.all_nodes():
+            host_stats = {}
+            def on_response(index, response, server=server, host_stats=host_stats):
+                (_, _, keylen, _, _, status, _, _, _, extra) = response
+                if status != R._no_error:
+                    raise MemcachedError("%d: %s" % (status, extra))
+                if keylen == 0: # last response?
+                    host_stats_map[server.peername()] = host_stats
+                    return True
+                host_stats[extra[:keylen]] = extra[keylen:]
+                return False
+            futures.append(self._submit(server, lambda opaque: [_qnsv(M._stat)], 1, on_response, None))
+        return _gather(futures, lambda: host_stats_map)
+
+    def close(self):
+        """
+        Close the connections to all servers and stop the event loop.
+        Requests still in flight fail with MemcachedConnectionClosedError.
+        """
+        self.loop.close()
 
-        return host_version_map
+class MultiplexedClient(AsyncClient):
+    """
+    A blocking client with the same calls and results as Client, built
+    on AsyncClient's connections.
+
+    Client checks a socket out of a pool for every call, so each busy
+    thread holds its own socket to each server. Here every thread shares
+    `connections_per_server` sockets per server: callers queue requests
+    with unique opaques, the event loop thread writes them out together
+    and routes each response back to the caller waiting on it. Use it
+    when many threads talk to the cache at once and the socket count on
+    either end matters more than the hop through the loop thread.
+
+    Every call takes a keyword-only `timeout`, defaulting to `timeout`:
+    the seconds it may wait for its result before raising
+    MemcachedTimeoutError. Calls never wait on a stopped event loop;
+    they raise the error that stopped it.
+
+    >>> c = MultiplexedClient('localhost:11211')
+    >>> c.set('foo', 'bar')
+    True
+    >>> c.get('foo')
+    'bar'
+    """
+    def __init__(self, host_list, timeout=None, **kwargs):
+        super(MultiplexedClient, self).__init__(host_list, **kwargs)
+        self.timeout = timeout
+
+    def _wait(self, future):
+        """
+        The result of `future`, waiting no longer than the call's
+        deadline, and checking that the event loop is still running at
+        least once every io timeout
+        """
+        while True:
+            if not future.done() and not self.loop.is_alive():
+                exc_info = self.loop.stopped_exc_info()
+                raise exc_info[0], exc_info[1], exc_info[2]
+            try:
+                return future.result(deadline.cap(self.io_timeout_seconds))
+            except MemcachedTimeoutError:
+                if future.done():
+                    # the request itself timed out
+                    raise
+            deadline.check()
+
+    @deadline.bounded
+    def get(self, key, cas=False):
+        return self._wait(super(MultiplexedClient, self).get(key, cas))
+
+    @deadline.bounded
+    def get_multi(self, keys, hashkey=None):
+        return self._wait(super(MultiplexedClient, self).get_multi(keys, hashkey))
+
+    @deadline.bounded
+    def touch(self, key, expire):
+        return self._wait(super(MultiplexedClient, self).touch(key, expire))
+
+    @deadline.bounded
+    def gat(self, key, expire, cas=False):
+        return self._wait(super(MultiplexedClient, self).gat(key, expire, cas))
+
+    @deadline.bounded
+    def gat_multi(self, keys, expire, hashkey=None):
+        return self._wait(super(MultiplexedClient, self).gat_multi(keys, expire, hashkey))
+
+    @deadline.bounded
+    def set(self, key, val, expire=0, cas=0):
+        return self._wait(super(MultiplexedClient, self).set(key, val, expire, cas))
+
+    @deadline.bounded
+    def set_multi(self, kvmap, expire=0, hashkey=None):
+        return self._wait(super(MultiplexedClient, self).set_multi(kvmap, expire, hashkey))
+
+    @deadline.bounded
+    def add(self, key, val, expire=0, cas=0):
+        return self._wait(super(MultiplexedClient, self).add(key, val, expire, cas))
+
+    @deadline.bounded
+    def add_multi(self, kvmap, expire=0, hashkey=None):
+        return self._wait(super(MultiplexedClient, self).add_multi(kvmap, expire, hashkey))
+
+    @deadline.bounded
+    def replace(self, key, val, expire=0, cas=0):
+        return self._wait(super(MultiplexedClient, self).replace(key, val, expire, cas))
+
+    @deadline.bounded
+    def replace_multi(self, kvmap, expire=0, hashkey=None):
+        return self._wait(super(MultiplexedClient, self).replace_multi(kvmap, expire, hashkey))
+
+    @deadline.bounded
+    def delete(self, key, cas=0):
+        return self._wait(super(MultiplexedClient, self).delete(key, cas))
+
+    @deadline.bounded
+    def delete_multi(self, keys, hashkey=None):
+        return self._wait(super(MultiplexedClient, self).delete_multi(keys, hashkey))
+
+    @deadline.bounded
+    def incr(self, key, expire=0, delta=1, initial=0):
+        return self._wait(super(MultiplexedClient, self).incr(key, expire, delta, initial))
+
+    @deadline.bounded
+    def decr(self, key, expire=0, delta=1, initial=0):
+        return self._wait(super(MultiplexedClient, self).decr(key, expire, delta, initial))
+
+    @deadline.bounded
+    def append(self, key, val):
+        return self._wait(super(MultiplexedClient, self).append(key, val))
+
+    @deadline.bounded
+    def prepend(self, key, val):
+        return self._wait(super(MultiplexedClient, self).prepend(key, val))
+
+    @deadline.bounded
+    def flush_all(self, expire=0):
+        return self._wait(super(MultiplexedClient, self).flush_all(expire))
+
+    @deadline.bounded
+    def noop(self):
+        return self._wait(super(MultiplexedClient, self).noop())
+
+    @deadline.bounded
+    def version(self):
+        return self._wait(super(MultiplexedClient, self).version())
+
+    @deadline.bounded
+    def stats(self):
+        return self._wait(super(MultiplexedClient, self).stats())
 
 if __name__ == "__main__":
     import doctest
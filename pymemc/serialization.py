@@ -0,0 +1,213 @@
+import json
+import marshal
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle as pickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class F(object):
+    """
+    Compression/Serialization Flags
+
+    A value's flags are the flag of the codec that encoded it, plus the
+    flag of the compressor it went through afterwards, if any. The codec
+    flags _pickle, _int, _long and _text match python-memcached and
+    pymemcache, so uncompressed values can be shared with them.
+
+    Compression flags do not match. _compressed marks values passed
+    through a client's own compress_fn, as it always has in pymemc,
+    while those libraries use the same bit for zlib. To read values
+    they compressed, give the client zlib.compress and zlib.decompress
+    as compress_fn and decompress_fn. Values compressed with the
+    built in compressors (_zlib, _lz4, _zstd) are only readable by
+    pymemc. _chunked marks the manifest of a value stored in parts.
+    """
+    _pickle = 1 << 0
+    _int = 1 << 1
+    _long = 1 << 2
+    _compressed = 1 << 3
+    _text = 1 << 4
+    _bool = 1 << 5
+    _float = 1 << 6
+    _json = 1 << 7
+    _marshal = 1 << 8
+    _msgpack = 1 << 9
+    _zlib = 1 << 10
+    _lz4 = 1 << 11
+    _zstd = 1 << 12
+    _chunked = 1 << 13
+
+# flag bits that say how a value was compressed rather than encoded
+COMPRESSION_FLAGS = F._compressed | F._zlib | F._lz4 | F._zstd
+
+class Codec(object):
+    """
+    One way of turning values into bytes and back. The flag is stored
+    with the value, and `compress` says whether encoded values are worth
+    passing to the compressor (short numeric strings are not).
+    """
+    __slots__ = ('flag', 'encode', 'decode', 'compress')
+
+    def __init__(self, flag, encode, decode, compress=True):
+        self.flag = flag
+        self.encode = encode
+        self.decode = decode
+        self.compress = compress
+
+def _identity(value):
+    return value
+
+def _encode_text(value):
+    return value.encode('utf-8')
+
+def _decode_text(value):
+    return value.decode('utf-8')
+
+def _encode_bool(value):
+    return '1' if value else '0'
+
+def _decode_bool(value):
+    return value == '1'
+
+def _encode_json(value):
+    return json.dumps(value, separators=(',', ':'))
+
+class Serializer(object):
+    """
+    A registry of codecs, looked up by the value's type when encoding
+    and by the stored flags when decoding.
+
+    Out of the box str is stored as is, unicode as UTF-8 text, and int,
+    long, bool and float as their decimal strings, which is much cheaper
+    than pickling them. Everything else goes to the `fallback` codec,
+    pickle (by way of encode_fn/decode_fn) unless another flag is given:
+    F._json, F._marshal or, if the msgpack package is installed,
+    F._msgpack. All of those are registered for decoding either way.
+
+    register_codec and register_type change the layout, e.g. to read
+    and write values the way another client flags them:
+
+    >>> s = Serializer()
+    >>> s.register_type(dict, F._json)
+    >>> s.codec_for({'a': 1}).flag == F._json
+    True
+    """
+    def __init__(self, encode_fn=pickle.dumps, decode_fn=pickle.loads, fallback=F._pickle):
+        self._flags = {} # flag -> codec
+        self._types = {} # type -> codec
+        self._type_order = [] # registered types, for isinstance checks
+        self.fallback = None
+        self.register_codec(0, _identity, _identity, (str,))
+        self.register_codec(F._text, _encode_text, _decode_text, (unicode,))
+        self.register_codec(F._int, str, int, (int,), compress=False)
+        self.register_codec(F._long, str, long, (long,), compress=False)
+        self.register_codec(F._bool, _encode_bool, _decode_bool, (bool,), compress=False)
+        self.register_codec(F._float, repr, float, (float,), compress=False)
+        self.register_codec(F._pickle, encode_fn, decode_fn)
+        self.register_codec(F._json, _encode_json, json.loads)
+        # only read marshalled values you wrote yourself; marshal is not
+        # safe against malicious input
+        self.register_codec(F._marshal, marshal.dumps, marshal.loads)
+        if msgpack is not None:
+            self.register_codec(F._msgpack, msgpack.packb, msgpack.unpackb)
+        if fallback not in self._flags:
+            raise ValueError("no codec is registered for fallback flag %d" % fallback)
+        self.fallback = self._flags[fallback]
+
+    def register_codec(self, flag, encode, decode, types=(), compress=True):
+        """
+        Register a codec under `flag`, replacing any codec already there,
+        and use it to encode values of `types`.
+        """
+        if flag & COMPRESSION_FLAGS:
+            raise ValueError("flag %d overlaps the compression flags" % flag)
+        codec = Codec(flag, encode, decode, compress)
+        for t, old in self._types.items():
+            if old.flag == flag:
+                self._types[t] = codec
+        if self.fallback is not None and self.fallback.flag == flag:
+            self.fallback = codec
+        self._flags[flag] = codec
+        for t in types:
+            self.register_type(t, flag)
+
+    def register_type(self, t, flag):
+        """Encode values of type `t` (and its subclasses) with the codec for `flag`"""
+        self._types[t] = self._flags[flag]
+        if t not in self._type_order:
+            self._type_order.append(t)
+        # forget the codecs looked up for other types so far; they may
+        # be subclasses of t
+        for known in self._types.keys():
+            if known not in self._type_order:
+                del self._types[known]
+
+    def codec_for(self, value):
+        try:
+            return self._types[type(value)]
+        except KeyError:
+            pass
+        codec = self.fallback
+        for t in self._type_order:
+            if isinstance(value, t):
+                codec = self._types[t]
+                break
+        # remember the answer, so the next value of this type is one lookup
+        self._types[type(value)] = codec
+        return codec
+
+    def decode(self, value, flags):
+        """
+        Decode an (already decompressed) value. Values with flags no codec
+        is registered for are returned as they are.
+        """
+        codec = self._flags.get(flags & ~COMPRESSION_FLAGS)
+        if codec is None:
+            return value
+        return codec.decode(value)
+
+class Compressor(object):
+    """A compression algorithm and the flag that marks values it compressed"""
+    __slots__ = ('flag', 'compress', 'decompress')
+
+    def __init__(self, flag, compress, decompress):
+        self.flag = flag
+        self.compress = compress
+        self.decompress = decompress
+
+def _zstd_compress(value):
+    # compressor objects can't be shared between threads
+    return zstandard.ZstdCompressor().compress(value)
+
+def _zstd_decompress(value):
+    return zstandard.ZstdDecompressor().decompress(value)
+
+def builtin_compressors():
+    """
+    The compressors that can be picked by name, keyed by name: always
+    zlib, and lz4 and zstd when the lz4 and zstandard packages are
+    installed.
+    """
+    found = {'zlib': Compressor(F._zlib, zlib.compress, zlib.decompress)}
+    if lz4_frame is not None:
+        found['lz4'] = Compressor(F._lz4, lz4_frame.compress, lz4_frame.decompress)
+    if zstandard is not None:
+        found['zstd'] = Compressor(F._zstd, _zstd_compress, _zstd_decompress)
+    return found
@@ -1,9 +1,138 @@
 import Queue
 import logging
+import multiprocessing
 import threading
+import sys
+
+import exc
+import deadline
 
 logger = logging.getLogger(__name__)
 
+class Future(object):
+    """
+    The eventual result of a call that completes on another thread.
+    Callbacks added with add_done_callback run on the completing thread.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise exc.MemcachedTimeoutError("timed out waiting for result")
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        return (self.exc_info(timeout) or (None, None, None))[1]
+
+    def exc_info(self, timeout=None):
+        """The (type, value, traceback) the future failed with, if any"""
+        if not self._event.wait(timeout):
+            raise exc.MemcachedTimeoutError("timed out waiting for result")
+        return self._exc_info
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        self._run_callback(fn)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        """Fail the future with a (type, value, traceback) triple"""
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            self._run_callback(fn)
+
+    def _run_callback(self, fn):
+        try:
+            fn(self)
+        except Exception:
+            logger.exception("future callback exception")
+
+class ProcessFuture(object):
+    """The result() half of a Future, for a multiprocessing AsyncResult"""
+    def __init__(self, async_result):
+        self._async_result = async_result
+
+    def result(self, timeout=None):
+        try:
+            return self._async_result.get(timeout)
+        except multiprocessing.TimeoutError:
+            raise exc.MemcachedTimeoutError("timed out waiting for result")
+
+def resolved(result):
+    """A future that has already completed with `result`"""
+    future = Future()
+    future.set_result(result)
+    return future
+
+def wait_all(futures):
+    """
+    Wait for every one of `futures` to finish, then return their results
+    in order, or raise the first error any of them failed with.
+    """
+    for future in futures:
+        future.exc_info()
+    return [future.result() for future in futures]
+
+def settle(futures):
+    """
+    Wait for every one of `futures` to finish, or for the deadline in
+    force to pass. Returns the indexes of those the deadline cut short,
+    by leaving them running or failing them with MemcachedTimeoutError,
+    and a dict mapping the indexes of those that failed otherwise to
+    their (type, value, traceback).
+    """
+    missed = []
+    errors = {}
+    for i, future in enumerate(futures):
+        try:
+            exc_info = future.exc_info(deadline.cap(None))
+        except exc.MemcachedTimeoutError:
+            missed.append(i)
+            continue
+        if exc_info is None:
+            continue
+        if issubclass(exc_info[0], exc.MemcachedTimeoutError) and \
+                deadline.current() is not None:
+            missed.append(i)
+        else:
+            errors[i] = exc_info
+    return missed, errors
+
+def wait_deadline(futures):
+    """
+    Wait for every one of `futures` to finish, or for the deadline in
+    force to pass. Returns the indexes of those the deadline cut short
+    (see settle), and raises the first other error any of them failed
+    with. Without a deadline this is wait_all.
+    """
+    missed, errors = settle(futures)
+    if errors:
+        error = errors[min(errors)]
+        raise error[0], error[1], error[2]
+    return missed
+
 class Worker(threading.Thread):
     def __init__(self, tasks):
         threading.Thread.__init__(self)
@@ -13,24 +142,34 @@ class Worker(threading.Thread):
 
     def run(self):
         while True:
-            f, args, kargs = self.tasks.get()
+            future, until, f, args, kargs = self.tasks.get()
             try:
-                f(*args, **kargs)
+                with deadline.at(until):
+                    result = f(*args, **kargs)
+                future.set_result(result)
             except Exception:
-                logger.exception("threadpool exception")
+                future.set_exception(sys.exc_info())
             finally:
                 self.tasks.task_done()
 
 class ThreadPool:
     def __init__(self, num_threads):
-        self.tasks = Queue.Queue(num_threads)
+        self.tasks = Queue.Queue()
         self.threads = []
 
         for t in xrange(num_threads):
             self.threads.append(Worker(self.tasks))
 
     def add_task(self, func, *args, **kargs):
-        self.tasks.put((func, args, kargs))
+        """
+        Queue func(*args, **kargs) to run on a worker thread and return
+        a Future for its result. Wait on that future (or wait_all on
+        several) rather than on wait(), which waits for every caller's
+        tasks. The caller's deadline, if any, holds for the task too.
+        """
+        future = Future()
+        self.tasks.put((future, deadline.current(), func, args, kargs))
+        return future
 
     def wait(self):
         self.tasks.join()
@@ -5,33 +5,36 @@ from optparse import OptionParser
 
 cmd = "memcached %s -p"
 start_port = 11211
-    
+
+def start_servers(num_procs, verbose=0, port=start_port, quiet=False):
+    """
+    Start `num_procs` memcached processes on consecutive ports from
+    `port`, and return them.
+    """
+    verbosity = "-" + "v"*verbose if verbose else ""
+    procs = []
+    for i in xrange(num_procs):
+        args = shlex.split(cmd % verbosity) + [str(port+i)]
+        if not quiet:
+            print " ".join(args)
+        p = subprocess.Popen(args)
+        procs.append(p)
+    return procs
+
 def main():
-    global cmd, start_port
     parser = OptionParser(usage="usage: %prog -v <num_procs>")
-    
+
     parser.add_option("-v", "--verbose",
                       metavar="verbosity", help="be noisy", default=0, action="count")
-    
+
     (options, args) = parser.parse_args()
-    
+
     if not args:
         num_procs = 1
     else:
         num_procs = int(args[0])
-    
-    if options.verbose:
-        verbosity = "-" + "v"*options.verbose
-        cmd = cmd % verbosity
-    else:
-        cmd = cmd % ""
-    
-    procs = []
-    for i in xrange(num_procs):
-        args = shlex.split(cmd) + [str(start_port+i)]
-        print " ".join(args)
-        p = subprocess.Popen(args)
-        procs.append(p)
+
+    procs = start_servers(num_procs, options.verbose)
     try:
         for p in procs:
             p.wait()
@@ -40,4 +43,4 @@ def main():
             p.terminate()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -6,8 +6,10 @@ import unittest
 import socket
 import random
 import base64
+import struct
 import pymemc
 import subprocess
+import threading
 
 # these are not really unit tests but I'm using the unittest framework.
 # to run them you need a local memcache server(s) running on the host/ports
@@ -17,6 +19,9 @@ import subprocess
 HOST_STRINGS = ['localhost:11211', 'localhost:11212', 'localhost:11213', 'localhost:11214']
 HOST_STRINGS = HOST_STRINGS[:1] # comment this out to run across multiple servers
 
+# the module behind the package, for tests that need its internals
+internals = sys.modules[pymemc.Client.__module__]
+
 class BaseTest(unittest.TestCase):
     def setUp(self):
         try:
@@ -83,6 +88,19 @@ class TestGetSetDelete(BaseTest):
             else:
                 assert self.client.get(key) == None
 
+    def testTouchGat(self):
+        """test touch and get-and-touch"""
+        assert self.client.set('short', 'lived', expire=1) == True
+        assert self.client.set('shorter', 'lived', expire=1) == True
+        assert self.client.touch('short', 60) == True
+        assert self.client.gat('shorter', 60) == 'lived'
+        assert self.client.touch(self.random_str(), 60) == False
+        assert self.client.gat(self.random_str(), 60) == None
+        time.sleep(1.5)
+        assert self.client.get('short') == 'lived'
+        assert self.client.get('shorter') == 'lived'
+        assert self.client.gat('short', 60, cas=True) == self.client.get('short', cas=True)
+
     def testSetOversizeKey(self):
         """test oversize keys"""
         # max default key size = 255 bytes
@@ -185,6 +203,252 @@ class TestAddReplace(BaseTest):
         for key, val in sample_data.iteritems():
             assert self.client.replace(key, val) == False
 
+class TestSerialization(BaseTest):
+    def testTypesRoundTrip(self):
+        """test that values of each built in type come back as they went in"""
+        values = {
+            'str': 'bytes\xff', 'unicode': u'caf\xe9', 'int': 7, 'long': 1L << 70,
+            'true': True, 'false': False, 'float': 0.1, 'dict': {'a': [1, 2.5]},
+        }
+        assert self.client.set_multi(values) == []
+        rvalues = self.client.get_multi(values.keys())
+        assert rvalues == values
+        for key, val in values.iteritems():
+            assert type(rvalues[key]) is type(val)
+
+    def testFlags(self):
+        """test that fast codecs, not pickle, store the scalar types"""
+        F = pymemc.serialization.F
+        for val, flag in ((u'x', F._text), (True, F._bool), (1.5, F._float), ({}, F._pickle)):
+            flags, _ = self.client._serialize(val)
+            assert flags & ~F._compressed == flag
+
+    def testCustomLayout(self):
+        """test registering codecs and routing types to them"""
+        serializer = pymemc.serialization.Serializer(fallback=pymemc.serialization.F._json)
+        serializer.register_codec(1 << 20, lambda v: ','.join(v), lambda v: v.split(','), (list,))
+        client = pymemc.Client(HOST_STRINGS, serializer=serializer)
+        assert client.set('list', ['a', 'b']) == True
+        assert client.set('dict', {'k': 1}) == True
+        assert client.get('list') == ['a', 'b']
+        assert client.get('dict') == {'k': 1}
+        # clients without the codec get the bytes as stored
+        assert self.client.get('list') == 'a,b'
+        assert self.client.get('dict') == {'k': 1}
+
+class TestCompression(BaseTest):
+    def testThresholds(self):
+        """test that only values big and compressible enough get compressed"""
+        F = pymemc.serialization.F
+        client = pymemc.Client(HOST_STRINGS, compression='zlib', compress_min_size=100)
+        small, repetitive, noise = 'x' * 50, 'abcd' * 1000, os.urandom(4000)
+        assert client._serialize(small) == (0, small)
+        assert client._serialize(repetitive)[0] == F._zlib
+        assert client._serialize(noise) == (0, noise)
+        assert client._serialize({'a': repetitive})[0] == F._pickle | F._zlib
+
+        values = {'small': small, 'repetitive': repetitive, 'noise': noise, 'dict': {'a': repetitive}}
+        assert client.set_multi(values) == []
+        assert client.get_multi(values.keys()) == values
+        # any client can read values compressed with a built in compressor
+        assert self.client.get('repetitive') == repetitive
+
+    def testCompressFn(self):
+        """test that a custom compress_fn gets the same thresholds"""
+        client = pymemc.Client(HOST_STRINGS, compress_fn=lambda v: v[::-1] + 'z' * 10,
+                               decompress_fn=lambda v: v[:-10][::-1], compress_min_savings=-1)
+        assert client._serialize('short')[0] == 0
+        flags, val = client._serialize('long' * 300)
+        assert flags == pymemc.serialization.F._compressed and val.startswith('gnol')
+        assert client.set('custom', 'long' * 300) == True
+        assert client.get('custom') == 'long' * 300
+        self.assertRaises(ValueError, pymemc.Client, HOST_STRINGS, compression='rot13')
+
+class SlowPickle(object):
+    def __getstate__(self):
+        time.sleep(1)
+        return {}
+
+class TestEncodePool(BaseTest):
+    def check_set_multi(self, client):
+        sample_data = dict((self.random_str(), {'n': i, 's': 'v' * (i % 3000)}) for i in xrange(1000))
+        sample_data['raw'] = bytearray('raw bytes')
+        sample_data['too_large'] = os.urandom(2 * 1024 * 1024)
+        assert client.set_multi(sample_data) == ['too_large']
+        del sample_data['too_large']
+        sample_data['raw'] = 'raw bytes'
+        assert self.client.get_multi(sample_data.keys()) == sample_data
+        assert sorted(client.add_multi(sample_data)) == sorted(sample_data)
+
+    def testThreads(self):
+        """test multisets with values encoded on worker threads"""
+        client = pymemc.Client(HOST_STRINGS, encode_workers=4, compression='zlib')
+        self.check_set_multi(client)
+        client.close()
+
+    def testProcesses(self):
+        """test multisets with values encoded in worker processes"""
+        client = pymemc.Client(HOST_STRINGS, encode_workers=2, encode_processes=True, compression='zlib')
+        try:
+            self.check_set_multi(client)
+        finally:
+            client.close()
+        assert client.set_multi({'after_close': 1}) == []
+
+    def testSlowEncode(self):
+        """test that waiting on the encode pool is bounded by io_timeout_seconds"""
+        client = pymemc.Client(HOST_STRINGS, encode_workers=1, io_timeout_seconds=0.2)
+        try:
+            start = time.time()
+            self.assertRaises(pymemc.MemcachedTimeoutError, client.set_multi, {'slow': SlowPickle()})
+            assert time.time() - start < 0.9
+            assert client.set_multi({'slow': SlowPickle()}, timeout=0.1) == ['slow']
+        finally:
+            client.close()
+
+    def testCloseUnreachable(self):
+        """test that close shuts the process pool down even if quit fails"""
+        client = pymemc.Client(['localhost:11299'], encode_workers=1, encode_processes=True,
+                               max_retries=0)
+        self.assertRaises(socket.error, client.close)
+        assert client.encode_pool is None
+
+class TestRawValues(BaseTest):
+    def testBufferValues(self):
+        """test that buffer objects are stored as raw bytes"""
+        blob = os.urandom(300000)
+        values = {
+            'bytearray': bytearray(blob),
+            'memoryview': memoryview(bytearray(blob))[1000:],
+            'buffer': buffer(blob, 5),
+            'small': bytearray('tiny'),
+        }
+        for key, val in values.iteritems():
+            assert self.client.set(key, val) == True
+        assert self.client.get('bytearray') == blob
+        assert self.client.get('memoryview') == blob[1000:]
+        assert self.client.get('buffer') == blob[5:]
+        assert self.client.get('small') == 'tiny'
+
+    def testRawGets(self):
+        """test that raw gets return memoryviews of the stored bytes"""
+        blob = os.urandom(300000)
+        sample_data = dict((self.random_str(), bytearray(blob[i:])) for i in xrange(20))
+        assert self.client.set_multi(sample_data) == []
+        rdata = self.client.get_multi(sample_data.keys(), raw=True)
+        assert sorted(rdata) == sorted(sample_data)
+        for key, view in rdata.iteritems():
+            assert isinstance(view, memoryview)
+            assert view.tobytes() == sample_data[key]
+
+        key = sample_data.keys()[0]
+        view = self.client.get(key, raw=True)
+        assert isinstance(view, memoryview) and view.tobytes() == sample_data[key]
+        # the view is the caller's to keep; later reads don't touch it
+        self.client.get_multi(sample_data.keys(), raw=True)
+        assert view.tobytes() == sample_data[key]
+        assert self.client.get(self.random_str(), raw=True) is None
+        assert self.client.set('num', 5) == True
+        assert self.client.get('num', raw=True).tobytes() == '5'
+
+class TestChunkedValues(BaseTest):
+    def setUp(self):
+        super(TestChunkedValues, self).setUp()
+        self.cclient = pymemc.Client(HOST_STRINGS, chunk_large_values=True, max_value_size=100000)
+
+    def tearDown(self):
+        self.cclient.close()
+        super(TestChunkedValues, self).tearDown()
+
+    def read_manifest(self, key):
+        """the manifest stored under `key`, read over a plain socket"""
+        sock = socket.create_connection(self.client.hash.get_node(key).address)
+        try:
+            sock.sendall(struct.pack('!BBHBBHLLQ', 0x80, 0x00, len(key), 0, 0, 0, len(key), 0, 0) + key)
+            response = sock.makefile('rb')
+            _, _, _, extlen, _, status, bodylen, _, _ = struct.unpack('!BBHBBHLLQ', response.read(24))
+            body = response.read(bodylen)
+        finally:
+            sock.close()
+        assert status == 0
+        assert struct.unpack('!L', body[:4])[0] & pymemc.serialization.F._chunked
+        return internals.CHUNK_MANIFEST.unpack(body[extlen:])
+
+    def item_count(self):
+        return sum(int(stats['curr_items']) for stats in self.client.stats().itervalues())
+
+    def testGetSet(self):
+        """test that oversize values are stored in parts and read back whole"""
+        blob = os.urandom(1000000)
+        assert self.client.set('blob', blob + 'x') == True
+        assert self.cclient.set('blob', blob) == True
+        assert self.cclient.get('blob') == blob
+        assert self.cclient.get('blob', raw=True).tobytes() == blob
+        assert self.cclient.get('blob', cas=True)[0] == blob
+        assert self.cclient.set('obj', {'blob': blob}) == True
+        assert self.cclient.get('obj') == {'blob': blob}
+
+    def testMulti(self):
+        """test chunked values in multisets and multigets"""
+        sample_data = dict((self.random_str(), os.urandom(50000 * i)) for i in xrange(1, 8))
+        sample_data['small'] = 'small'
+        assert self.cclient.set_multi(sample_data) == []
+        assert self.cclient.get_multi(sample_data.keys()) == sample_data
+        assert dict(self.cclient.iter_multi(sample_data.keys())) == sample_data
+        assert self.cclient.set_multi(sample_data, hashkey='h') == []
+        assert self.cclient.get_multi(sample_data.keys(), hashkey='h') == sample_data
+
+    def testMissingParts(self):
+        """test that values with evicted or damaged parts read as missing"""
+        blob = os.urandom(300000)
+        assert self.cclient.set('evicted', blob) == True
+        assert self.cclient.set('damaged', blob) == True
+        tokens = dict((key, self.read_manifest(key)[0]) for key in ('evicted', 'damaged'))
+        assert self.client.delete(self.cclient._chunk_key('evicted', tokens['evicted'], 1)) == True
+        assert self.client.set(self.cclient._chunk_key('damaged', tokens['damaged'], 0), 'x' * 99000) == True
+        assert self.cclient.get('evicted') is None
+        assert self.cclient.get_multi(['evicted', 'damaged']) == {}
+
+    def testUnstoredParts(self):
+        """test that the parts of values that were not stored are deleted"""
+        blob = os.urandom(300000)
+        assert self.cclient.set('exists', 'small') == True
+        count = self.item_count()
+        assert self.cclient.add('exists', blob) == False
+        assert self.cclient.replace('missing', blob) == False
+        assert self.cclient.set('exists', blob, cas=12345) == False
+        assert self.cclient.add_multi({'exists': blob, 'added': blob}) == ['exists']
+        assert self.cclient.replace_multi({'missing': blob}) == ['missing']
+        # just 'added': its manifest and four parts
+        assert self.item_count() == count + 5
+        assert self.cclient.get('exists') == 'small'
+
+    def testAsyncClientsMiss(self):
+        """test that clients that don't reassemble chunked values read them as missing"""
+        blob = os.urandom(300000)
+        assert self.cclient.set_multi({'blob': blob, 'small': 'small'}) == []
+        aclient = pymemc.AsyncClient(HOST_STRINGS)
+        try:
+            assert aclient.get('blob').result() is None
+            assert aclient.get('blob', cas=True).result() is None
+            assert aclient.get_multi(['blob', 'small']).result() == {'small': 'small'}
+        finally:
+            aclient.close()
+        mclient = pymemc.MultiplexedClient(HOST_STRINGS)
+        try:
+            assert mclient.get('blob') is None
+            assert mclient.get_multi(['blob', 'small']) == {'small': 'small'}
+        finally:
+            mclient.close()
+
+    def testUnchunkedLimit(self):
+        """test that oversize values are only refused without chunking"""
+        client = pymemc.Client(HOST_STRINGS, max_value_size=100000)
+        assert client.set('big', 'x' * 99999) == True
+        assert client.set('big', 'x' * 100001) == False
+        assert client.set_multi({'big': 'x' * 100001, 'ok': 'x'}) == ['big']
+        client.close()
+
 class TestIncrementDecrement(BaseTest):
     def testIncrement(self):
         """test basic increment"""
@@ -204,6 +468,18 @@ class TestIncrementDecrement(BaseTest):
             assert self.client.decr(key) == intval-1
             assert self.client.decr(key, delta=random_delta) == intval-1-random_delta
 
+    def testIncrDecrMulti(self):
+        """test pipelined multi increments and decrements"""
+        counters = dict((self.random_str(), random.randint(1, 10)) for i in xrange(200))
+        assert self.client.incr_multi(counters, initial=5) == dict.fromkeys(counters, 5)
+        assert self.client.incr_multi(counters) == dict((k, 5 + d) for k, d in counters.iteritems())
+        assert self.client.decr_multi(counters) == dict.fromkeys(counters, 5)
+        assert self.client.decr_multi(dict.fromkeys(counters, 100)) == dict.fromkeys(counters, 0)
+        assert self.client.set('text', 'not a number') == True
+        assert self.client.incr_multi({'text': 1, 'num': 1}) == {'num': 0}
+        for key in counters:
+            assert self.client.get(key) == '0'
+
 class TestMultiGetSetDelete(BaseTest):
     def testSetMulti(self):
         """test simple multisets"""
@@ -232,6 +508,90 @@ class TestMultiGetSetDelete(BaseTest):
         for key in sample_data.iterkeys():
             assert sample_data[key] == self.client.get(key) == rdata[key]
 
+    def testGetSetMultiLargeValues(self):
+        """test pipelined multigets and multisets that overflow the socket buffers"""
+        keys = (self.random_str(5) for i in xrange(200))
+        vals = (self.random_str(100000) for i in xrange(200))
+        sample_data = dict(zip(keys, vals))
+        assert self.client.set_multi(sample_data) == []
+        rdata = self.client.get_multi(sample_data.iterkeys())
+        assert rdata == sample_data
+
+    def testIterMulti(self):
+        """test streaming multigets"""
+        sample_data = self.get_sample_data(length=2000)
+        assert self.client.set_multi(sample_data) == []
+        keys = sample_data.keys() + [self.random_str() for i in xrange(100)]
+        pairs = list(self.client.iter_multi(iter(keys), batch_size=150, max_pending=10))
+        assert len(pairs) == len(sample_data)
+        assert dict(pairs) == sample_data
+        assert list(self.client.iter_multi([])) == []
+
+    def testIterMultiEarlyExit(self):
+        """test using the client inside, and leaving, an iter_multi loop"""
+        sample_data = self.get_sample_data(length=1000)
+        assert self.client.set_multi(sample_data) == []
+        seen = 0
+        for key, val in self.client.iter_multi(sample_data.keys(), batch_size=100, max_pending=5):
+            assert self.client.get(key) == val == sample_data[key]
+            seen += 1
+            if seen == 50:
+                break
+        assert self.client.get_multi(sample_data.keys()) == sample_data
+
+    def testGetsCasMulti(self):
+        """test multigets with cas tokens and multi compare-and-sets"""
+        sample_data = self.get_sample_data(length=200)
+        assert self.client.set_multi(sample_data) == []
+        found = self.client.gets_multi(sample_data.keys() + [self.random_str()])
+        assert sorted(found) == sorted(sample_data)
+        for key, (val, cas) in found.iteritems():
+            assert val == sample_data[key]
+            assert self.client.get(key, cas=True) == (val, cas)
+
+        changed = sample_data.keys()[:10]
+        assert self.client.set_multi(dict((key, 'changed') for key in changed)) == []
+        self.client.delete(sample_data.keys()[10])
+        updates = dict((key, (val[::-1], cas)) for key, (val, cas) in found.iteritems())
+        assert sorted(self.client.cas_multi(updates)) == sorted(sample_data.keys()[:11])
+        rdata = self.client.get_multi(sample_data.keys())
+        for key in sample_data.keys()[11:]:
+            assert rdata[key] == sample_data[key][::-1]
+        assert [rdata[key] for key in changed] == ['changed'] * 10
+
+    def testTouchGatMulti(self):
+        """test multitouches and multi get-and-touches"""
+        sample_data = self.get_sample_data(length=200)
+        assert self.client.set_multi(sample_data, expire=1) == []
+        keys = sample_data.keys()
+        missing = self.random_str()
+        assert self.client.touch_multi(keys[:100] + [missing], 60) == [missing]
+        assert self.client.gat_multi(keys[100:] + [missing], 60) == dict((k, sample_data[k]) for k in keys[100:])
+        time.sleep(1.5)
+        assert self.client.get_multi(keys) == sample_data
+
+    def testGetMultiThreaded(self):
+        """test multigets from several threads sharing one client"""
+        sample_data = self.get_sample_data(length=1000)
+        assert self.client.set_multi(sample_data) == []
+        results = []
+        def worker():
+            for i in xrange(10):
+                results.append(self.client.get_multi(sample_data.iterkeys()) == sample_data)
+        threads = [threading.Thread(target=worker) for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [True] * 80
+
+    def testMultiErrorsRaised(self):
+        """test that errors in per-host multi-op tasks reach the caller"""
+        client = pymemc.Client(['localhost:11299'])
+        self.assertRaises(socket.error, client.get_multi, ['a', 'b'])
+        self.assertRaises(socket.error, client.set_multi, {'a': 1})
+        self.assertRaises(socket.error, client.delete_multi, ['a'])
+
     def testGetMultiMissing(self):
         """test multigets with missing values"""
         sample_data = self.get_sample_data(length=100)
@@ -344,6 +704,642 @@ class TestMultiAddReplace(BaseTest):
         assert self.client.add_multi(sample_data) == []
         assert set(self.client.add_multi(sample_data)) == set(sample_data.iterkeys())
 
+class TestAsyncClient(BaseTest):
+    def setUp(self):
+        super(TestAsyncClient, self).setUp()
+        self.aclient = pymemc.AsyncClient(HOST_STRINGS)
+
+    def tearDown(self):
+        self.aclient.close()
+        super(TestAsyncClient, self).tearDown()
+
+    def testGetSet(self):
+        """test async gets and sets, many in flight at once"""
+        sample_data = self.get_sample_data(length=100)
+
+        futures = [self.aclient.set(key, val) for key, val in sample_data.iteritems()]
+        assert [f.result() for f in futures] == [True] * len(futures)
+
+        futures = dict((key, self.aclient.get(key)) for key in sample_data.iterkeys())
+        for key, future in futures.iteritems():
+            assert future.result() == sample_data[key] == self.client.get(key)
+
+        assert self.aclient.get(self.random_str()).result() == None
+
+    def testGetSetMulti(self):
+        """test async multigets, multisets and multideletes"""
+        sample_data = self.get_sample_data(length=1000)
+        assert self.aclient.set_multi(sample_data).result() == []
+        assert self.aclient.get_multi(sample_data.iterkeys()).result() == sample_data
+        assert self.aclient.delete_multi(sample_data.iterkeys()).result() == []
+        assert self.aclient.get_multi(sample_data.iterkeys()).result() == {}
+
+    def testIncrStats(self):
+        """test async incr, decr and stats"""
+        assert self.aclient.incr('counter', initial=10).result() == 10
+        assert self.aclient.incr('counter', delta=5).result() == 15
+        assert self.aclient.decr('counter').result() == 14
+        assert len(self.aclient.stats().result()) == len(HOST_STRINGS)
+
+    def testDeadServer(self):
+        """test that requests to a dead server fail instead of hanging"""
+        aclient = pymemc.AsyncClient(['localhost:11299'])
+        try:
+            self.assertRaises(socket.error, aclient.get('foo').result, 5)
+        finally:
+            aclient.close()
+
+    def testMisbehavingServer(self):
+        """test that a server breaking the protocol fails its connection, not the event loop"""
+        listener = socket.socket()
+        # a fixed receive buffer, so the write can't finish into it at once
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+        listener.bind(('localhost', 0))
+        listener.listen(5)
+
+        def serve():
+            # answer the first request on each connection, then send a
+            # response nobody asked for
+            while True:
+                try:
+                    conn, _ = listener.accept()
+                except socket.error:
+                    return
+                opaque, = struct.unpack_from('!L', conn.recv(4096), 12)
+                conn.sendall(struct.pack('!BBHBBHLLQ', 0x81, 0x00, 0, 0, 0, 1, 0, opaque, 0) +
+                             struct.pack('!BBHBBHLLQ', 0x81, 0x0A, 0, 0, 0, 0, 0, 0, 0))
+                conn.recv(4096)
+                conn.close()
+
+        server = threading.Thread(target=serve)
+        server.daemon = True
+        server.start()
+        aclient = pymemc.AsyncClient(['localhost:%d' % listener.getsockname()[1]])
+        conn = aclient.hash.all_nodes()[0].connections[0]
+        try:
+            for i in xrange(3):
+                assert aclient.get('foo').result(5) == None
+                # the stray response drops the connection
+                for j in xrange(500):
+                    if conn.sock is None:
+                        break
+                    time.sleep(0.01)
+                assert conn.sock is None
+            assert aclient.loop.is_alive()
+        finally:
+            aclient.close()
+            listener.close()
+        self.assertRaises(pymemc.MemcachedConnectionClosedError, aclient.get, 'foo')
+
+class TestMultiplexedClient(BaseTest):
+    def setUp(self):
+        super(TestMultiplexedClient, self).setUp()
+        self.mclient = pymemc.MultiplexedClient(HOST_STRINGS, connections_per_server=2)
+
+    def tearDown(self):
+        self.mclient.close()
+        super(TestMultiplexedClient, self).tearDown()
+
+    def testGetSet(self):
+        """test that the multiplexed client answers like Client"""
+        sample_data = self.get_sample_data(length=100)
+        assert self.mclient.set_multi(sample_data) == []
+        assert self.mclient.get_multi(sample_data.iterkeys()) == sample_data
+        for key, val in sample_data.iteritems():
+            assert self.mclient.get(key) == self.client.get(key) == val
+        assert self.mclient.add(sample_data.keys()[0], 'x') == False
+        assert self.mclient.delete(sample_data.keys()[0]) == True
+        assert self.mclient.incr('counter', initial=3) == 3
+        assert self.mclient.version().keys() == self.client.version().keys()
+
+    def testTouchGat(self):
+        """test multiplexed touch and get-and-touch"""
+        sample_data = self.get_sample_data(length=10)
+        assert self.mclient.set_multi(sample_data) == []
+        key = sample_data.keys()[0]
+        assert self.mclient.touch(key, 60) == True
+        assert self.mclient.touch(self.random_str(), 60) == False
+        assert self.mclient.gat(key, 60) == sample_data[key]
+        assert self.mclient.gat_multi(sample_data.keys(), 60) == sample_data
+
+    def testSharedConnections(self):
+        """test that many threads share a couple of sockets per server"""
+        sample_data = self.get_sample_data(length=2000)
+        assert self.mclient.set_multi(sample_data) == []
+        keys = sample_data.keys()
+        errors = []
+
+        def worker(offset):
+            try:
+                for key in keys[offset::16]:
+                    assert self.mclient.get(key) == sample_data[key]
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in xrange(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+        for server in self.mclient.hash.all_nodes():
+            assert len(server.connections) == 2
+            assert all(conn.pending() == 0 for conn in server.connections)
+
+    def testTimeouts(self):
+        """test that calls give up at their deadline or once the event loop stops"""
+        hole = socket.socket()
+        hole.bind(('localhost', 0))
+        hole.listen(5)
+        mclient = pymemc.MultiplexedClient(['localhost:%d' % hole.getsockname()[1]],
+                                           timeout=0.2, connect_timeout_seconds=5)
+        try:
+            start = time.time()
+            self.assertRaises(pymemc.MemcachedTimeoutError, mclient.get, 'foo')
+            self.assertRaises(pymemc.MemcachedTimeoutError, mclient.set, 'foo', 'bar', timeout=0.1)
+            assert time.time() - start < 1
+        finally:
+            mclient.close()
+            hole.close()
+        self.assertRaises(pymemc.MemcachedConnectionClosedError, mclient.get, 'foo')
+        # a result that can no longer come
+        self.assertRaises(pymemc.MemcachedConnectionClosedError, mclient._wait,
+                          pymemc.threadpool.Future())
+
+    def testSlowWrites(self):
+        """test that a long write making progress is not taken for a dead server"""
+        listener = socket.socket()
+        # a fixed receive buffer, so the write can't finish into it at once
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+        listener.bind(('localhost', 0))
+        listener.listen(5)
+
+        def serve():
+            # read slowly, and answer the noop closing each pipeline
+            conn, _ = listener.accept()
+            buf = ''
+            while True:
+                data = conn.recv(262144)
+                if not data:
+                    return
+                buf += data
+                while len(buf) >= 24:
+                    _, opcode, _, _, _, _, bodylen, opaque, _ = struct.unpack_from('!BBHBBHLLQ', buf)
+                    if len(buf) < 24 + bodylen:
+                        break
+                    buf = buf[24 + bodylen:]
+                    if opcode == 0x0A:
+                        conn.sendall(struct.pack('!BBHBBHLLQ', 0x81, 0x0A, 0, 0, 0, 0, 0, opaque, 0))
+                time.sleep(0.005)
+
+        server = threading.Thread(target=serve)
+        server.daemon = True
+        server.start()
+        mclient = pymemc.MultiplexedClient(['localhost:%d' % listener.getsockname()[1]],
+                                           connect_timeout_seconds=0.3)
+        try:
+            start = time.time()
+            values = dict(('big%d' % i, 'x' * 500000) for i in xrange(32))
+            assert mclient.set_multi(values) == []
+            assert time.time() - start > 0.3
+        finally:
+            mclient.close()
+            listener.close()
+
+class TestNearCache(BaseTest):
+    def setUp(self):
+        super(TestNearCache, self).setUp()
+        self.nclient = pymemc.Client(HOST_STRINGS, near_cache_size=50, near_cache_ttl=0.5)
+
+    def testHitsAndInvalidation(self):
+        """test that cached values are served until this client writes"""
+        assert self.nclient.set('flag', 'on') == True
+        assert self.nclient.get('flag') == 'on'
+        # another client's write goes unnoticed while the entry is fresh
+        assert self.client.set('flag', 'off') == True
+        assert self.nclient.get('flag') == 'on'
+        assert self.nclient.near_cache.stats()['hits'] == 1
+        # our own write does not
+        assert self.nclient.set('flag', 'off2') == True
+        assert self.nclient.get('flag') == 'off2'
+        assert self.nclient.incr('count', initial=5) == 5
+        assert self.nclient.get('count') == '5'
+        assert self.nclient.incr('count') == 6
+        assert self.nclient.get('count') == '6'
+        assert self.nclient.delete_multi(iter(['flag', 'count'])) == []
+        assert self.nclient.get('flag') is None
+
+    def testGetMulti(self):
+        """test that get_multi only fetches the keys it has not cached"""
+        sample_data = self.get_sample_data(length=20)
+        assert self.nclient.set_multi(sample_data) == []
+        keys = sample_data.keys()
+        assert self.nclient.get_multi(keys[:10]) == dict((k, sample_data[k]) for k in keys[:10])
+        self.client.set_multi(dict((k, 'changed') for k in keys))
+        result = self.nclient.get_multi(keys)
+        assert [result[k] for k in keys[:10]] == [sample_data[k] for k in keys[:10]]
+        assert [result[k] for k in keys[10:]] == ['changed'] * 10
+        stats = self.nclient.near_cache.stats()
+        assert (stats['hits'], stats['misses'], stats['size']) == (10, 20, 20)
+
+    def testEvictionAndExpiry(self):
+        """test that the near cache stays bounded and entries expire"""
+        sample_data = self.get_sample_data(length=80)
+        assert self.nclient.set_multi(sample_data) == []
+        assert self.nclient.get_multi(sample_data.keys()) == sample_data
+        assert len(self.nclient.near_cache) == 50
+        assert self.nclient.near_cache.stats()['evictions'] == 30
+
+        key = [k for k in sample_data if self.nclient.near_cache.get(k)[0]][0]
+        self.client.set(key, 'changed')
+        assert self.nclient.get(key) == sample_data[key]
+        time.sleep(0.6)
+        assert self.nclient.get(key) == 'changed'
+
+    def testConcurrentWrites(self):
+        """test that a write only drops in-flight fills of the keys it wrote"""
+        cache = pymemc.nearcache.NearCache(100, 60)
+        generation = cache.generation()
+        cache.invalidate(['other'])
+        cache.invalidate(['written'])
+        cache.fill([('written', 1), ('fetched', 2)], generation)
+        assert cache.get('written') == (False, None)
+        assert cache.get('fetched') == (True, 2)
+        generation = cache.generation()
+        cache.clear()
+        cache.fill([('fetched', 3)], generation)
+        assert cache.get('fetched') == (False, None)
+
+class TestConnectionPool(BaseTest):
+    def make_client(self, **kwargs):
+        client = pymemc.Client(HOST_STRINGS[:1], **kwargs)
+        self.addCleanup(client.close)
+        return client, client.hash.all_nodes()[0]
+
+    def testMaxConnections(self):
+        """test that callers wait for a connection at max_connections"""
+        client, pool = self.make_client(max_connections=1, pool_wait_timeout=0.2)
+        conn = pool.get()
+        self.assertRaises(pymemc.MemcachedTimeoutError, client.get, 'foo')
+        pool.put(conn)
+        assert client.set('foo', 'bar') == True
+        stats = pool.stats()
+        assert (stats['open'], stats['created'], stats['waits']) == (1, 1, 1)
+        assert stats['wait_time'] >= 0.2
+
+    def testPrewarmAndReuse(self):
+        """test that prewarmed connections are reused, and extras closed"""
+        client, pool = self.make_client(pool_size=2, prewarm_connections=2)
+        assert pool.stats()['idle'] == 2
+        assert client.get('foo') is None
+        conns = [pool.get() for i in xrange(3)]
+        for conn in conns:
+            pool.put(conn)
+        stats = pool.stats()
+        assert (stats['created'], stats['reused'], stats['discarded']) == (3, 3, 1)
+        assert (stats['open'], stats['idle']) == (2, 2)
+        self.assertRaises(socket.error, conns[-1].fileno)
+
+    def testConcurrentWarm(self):
+        """test that warming from several threads at once opens no extras"""
+        client, pool = self.make_client(pool_size=4)
+        threads = [threading.Thread(target=pool.warm, args=(3,)) for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = pool.stats()
+        assert (stats['created'], stats['open'], stats['idle']) == (3, 3, 3)
+
+    def testDiscardAfterError(self):
+        """test that connections are closed, not reused, after an exception"""
+        client, pool = self.make_client()
+        try:
+            with pymemc.connpool.pooled_connection(pool) as conn:
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertRaises(socket.error, conn.fileno)
+        assert (pool.stats()['discarded'], pool.stats()['open']) == (1, 0)
+
+    def testIdleReapingAndChecks(self):
+        """test that idle connections are closed or checked before reuse"""
+        client, pool = self.make_client(pool_idle_timeout=0.2)
+        assert client.set('foo', 'bar') == True
+        time.sleep(0.3)
+        assert client.get('foo') == 'bar'
+        assert (pool.stats()['reaped'], pool.stats()['created']) == (1, 2)
+
+        client, pool = self.make_client(pool_check_after=0)
+        conn = pool.get()
+        internals.socksend(conn, internals._qnsv(internals.M._quit))
+        internals.sockresponse(conn)
+        pool.put(conn)
+        assert client.get('foo') == 'bar'
+        assert pool.stats()['failed_checks'] == 1
+        assert client.get('foo') == 'bar'
+        stats = client.pool_stats()[pool.address]
+        assert (stats['created'], stats['reused'], stats['failed_checks']) == (2, 1, 1)
+
+class TestReconnect(BaseTest):
+    def setUp(self):
+        super(TestReconnect, self).setUp()
+        # a second server, to check that reconnecting to one leaves the
+        # other alone
+        self.mc2 = subprocess.Popen(['memcached', '-p', '11212'], stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+        for i in xrange(100):
+            try:
+                socket.create_connection(('localhost', 11212)).close()
+                break
+            except socket.error:
+                time.sleep(0.01)
+        self.rclient = pymemc.Client(['localhost:11211', 'localhost:11212'], prewarm_connections=2)
+        self.pools = dict((pool.address[1], pool) for pool in self.rclient.hash.all_nodes())
+
+    def tearDown(self):
+        try:
+            self.rclient.flush_all()
+            self.rclient.close()
+        finally:
+            self.mc2.kill()
+        super(TestReconnect, self).tearDown()
+
+    def break_connections(self, pool):
+        """have the server close every idle connection in the pool"""
+        conns = [pool.get() for i in xrange(pool.stats()['idle'])]
+        for conn in conns:
+            internals.socksend(conn, internals._qnsv(internals.M._quit))
+            internals.sockresponse(conn)
+            pool.put(conn)
+
+    def key_on(self, port):
+        return [key for key in ('k%d' % i for i in xrange(100))
+                if self.rclient.hash.get_node(key) is self.pools[port]][0]
+
+    def testTargetedReconnect(self):
+        """test that a connection error only drops that server's connections"""
+        key = self.key_on(11211)
+        self.break_connections(self.pools[11211])
+        assert self.rclient.set(key, 'val') == True
+        assert self.pools[11211].stats()['discarded'] == 2
+        assert self.pools[11212].stats()['discarded'] == 0
+        assert self.pools[11212].stats()['idle'] == 2
+
+    def testNonIdempotentNotRetried(self):
+        """test that incr and append are only retried when asked to"""
+        key = self.key_on(11212)
+        assert self.rclient.set(key, '1') == True
+        self.break_connections(self.pools[11212])
+        self.assertRaises(pymemc.MemcachedConnectionClosedError, self.rclient.incr, key)
+        assert self.rclient.incr(key) == 2
+        self.break_connections(self.pools[11212])
+        self.assertRaises(pymemc.MemcachedConnectionClosedError, self.rclient.append, key, '0')
+        assert self.rclient.get(key) == '2'
+
+        self.rclient.retry_non_idempotent = True
+        self.break_connections(self.pools[11212])
+        assert self.rclient.incr_multi({key: 1}) == {key: 3}
+        self.break_connections(self.pools[11212])
+        assert self.rclient.append(key, '0') == True
+        assert self.rclient.get(key) == '30'
+
+class TestDeadlines(BaseTest):
+    def setUp(self):
+        super(TestDeadlines, self).setUp()
+        # a server that accepts connections but never answers
+        self.hole = socket.socket()
+        self.hole.bind(('localhost', 0))
+        self.hole.listen(50)
+        self.hole_host = 'localhost:%d' % self.hole.getsockname()[1]
+        self.dclient = pymemc.Client([HOST_STRINGS[0], self.hole_host], connect_timeout_seconds=5)
+        self.pools = dict((str(pool), pool) for pool in self.dclient.hash.all_nodes())
+
+    def tearDown(self):
+        self.dclient.remove_server(self.hole_host)
+        self.dclient.close()
+        self.hole.close()
+        super(TestDeadlines, self).tearDown()
+
+    def split_keys(self, keys):
+        live = [key for key in keys if str(self.dclient.hash.get_node(key)) != self.hole_host]
+        return live, [key for key in keys if key not in live]
+
+    def testSingleKey(self):
+        """test that single key calls raise once their deadline passes"""
+        live, dead = self.split_keys(['k%d' % i for i in xrange(100)])
+        start = time.time()
+        self.assertRaises(pymemc.MemcachedTimeoutError, self.dclient.get, dead[0], timeout=0.2)
+        self.assertRaises(pymemc.MemcachedTimeoutError, self.dclient.incr, dead[0], timeout=0.2)
+        assert time.time() - start < 1
+        assert self.dclient.set(live[0], 'val', timeout=0.2) == True
+        assert self.pools[self.hole_host].failures == 0
+
+    def testPartialResults(self):
+        """test that multi-key calls return what answered before the deadline"""
+        sample_data = self.get_sample_data(length=200)
+        live, dead = self.split_keys(sample_data.keys())
+        start = time.time()
+        assert sorted(self.dclient.set_multi(sample_data, timeout=0.3)) == sorted(dead)
+        assert self.dclient.get_multi(sample_data.keys(), timeout=0.3) == \
+            dict((key, sample_data[key]) for key in live)
+        assert sorted(self.dclient.delete_multi(live + dead, timeout=0.3)) == sorted(dead)
+        assert time.time() - start < 2
+        assert self.dclient.get_multi(live, timeout=0.3) == {}
+
+    def testIterMulti(self):
+        """test that iter_multi stops at its deadline"""
+        sample_data = self.get_sample_data(length=200)
+        live, dead = self.split_keys(sample_data.keys())
+        assert self.client.set_multi(dict((key, sample_data[key]) for key in live)) == []
+        start = time.time()
+        assert dict(self.dclient.iter_multi(sample_data.keys(), timeout=0.3)) == \
+            dict((key, sample_data[key]) for key in live)
+        assert time.time() - start < 1
+
+    def testExpiredBeforeConnecting(self):
+        """test that calls already past their deadline time out without connecting"""
+        pool = self.pools[HOST_STRINGS[0]]
+        pool.clear_pool()
+        live, dead = self.split_keys(['k%d' % i for i in xrange(100)])
+        self.assertRaises(pymemc.MemcachedTimeoutError, self.dclient.get, live[0], timeout=0)
+        assert self.dclient.get_multi(live, timeout=0) == {}
+        assert sorted(self.dclient.set_multi(dict.fromkeys(live, 'v'), timeout=0)) == sorted(live)
+        assert pool.failures == 0
+        assert pool.stats()['created'] == 0
+        assert self.dclient.hash.down_nodes() == []
+
+class TestInstrumentation(BaseTest):
+    def testStats(self):
+        """test that an observing client records calls, servers and phases"""
+        stats = pymemc.instrument.Stats()
+        client = pymemc.Client(HOST_STRINGS, observer=stats)
+        sample_data = self.get_sample_data(length=100)
+        assert client.set_multi(sample_data) == []
+        assert client.get_multi(sample_data.keys() + ['missing']) == sample_data
+        assert client.get('missing') is None
+        client.close()
+
+        exported = stats.to_dict()
+        assert sorted(exported['ops']) == ['get', 'get_multi', 'set_multi']
+        assert exported['ops']['get_multi']['count'] == 1
+        assert (exported['hits'], exported['misses'], exported['retries']) == (100, 2, 0)
+        assert exported['phases']['serialize']['count'] == 100
+        assert exported['phases']['deserialize']['count'] == 100
+        assert len(exported['servers']) == len(HOST_STRINGS)
+        for server in exported['servers'].itervalues():
+            assert server['bytes_sent'] > 100 * 100 / len(HOST_STRINGS)
+            assert server['bytes_received'] > 0
+            assert server['latency']['count'] == server['pool_wait']['count'] > 0
+            assert sum(server['latency']['counts']) == server['latency']['count']
+        assert self.client.observer is None
+
+    def testHistogram(self):
+        """test histogram buckets and percentiles"""
+        histogram = pymemc.instrument.Histogram()
+        for i in xrange(99):
+            histogram.record(0.00015)
+        histogram.record(100)
+        assert histogram.percentile(50) == 0.0002
+        assert histogram.percentile(100) == histogram.max == 100
+        assert histogram.counts[-1] == 1
+
+class TestConsistentHash(unittest.TestCase):
+    nodes = ['10.0.1.%d:11211' % i for i in xrange(1, 6)]
+    keys = ['key%d' % i for i in xrange(1000)]
+
+    def make_ring(self, nodes, **kwargs):
+        ring = pymemc.chash.ConsistentHash(replicas=160, **kwargs)
+        for node in nodes:
+            ring.add_node(node)
+        return ring
+
+    def testPlacementIsStable(self):
+        """test that rings built from the same node names agree"""
+        for kwargs in ({}, {'ketama': True}, {'hash_fn': pymemc.chash.crc32_hash}):
+            ring1 = self.make_ring(self.nodes, **kwargs)
+            ring2 = self.make_ring(self.nodes, **kwargs)
+            assert ring1.get_nodes(self.keys) == ring2.get_nodes(self.keys)
+
+    def testKetamaCompatible(self):
+        """test that ketama rings place keys where libketama does"""
+        # from libketama itself, with these servers equally weighted
+        expected = {
+            'key0': '10.0.1.4:11211', 'key53': '10.0.1.1:11211',
+            'key106': '10.0.1.2:11211', 'key159': '10.0.1.1:11211',
+            'key212': '10.0.1.5:11211', 'key265': '10.0.1.4:11211',
+            'key318': '10.0.1.5:11211', 'key371': '10.0.1.2:11211',
+            'key424': '10.0.1.3:11211', 'key477': '10.0.1.5:11211',
+            'key530': '10.0.1.3:11211', 'key583': '10.0.1.4:11211',
+            'key636': '10.0.1.2:11211', 'key689': '10.0.1.2:11211',
+            'key742': '10.0.1.1:11211', 'key795': '10.0.1.4:11211',
+            'key848': '10.0.1.5:11211', 'key901': '10.0.1.1:11211',
+            'key954': '10.0.1.5:11211',
+        }
+        ring = pymemc.chash.ConsistentHash(ketama=True)
+        for node in self.nodes:
+            ring.add_node(node)
+        assert ring.replicas == 160
+        for key, node in expected.iteritems():
+            assert ring.get_node(key) == node
+        # no connections are made until the client is used
+        assert pymemc.Client(self.nodes, ch_ketama=True).hash.replicas == 160
+
+    def testBatchRouting(self):
+        """test that batch routing matches single key routing"""
+        ring = self.make_ring(self.nodes, ketama=True)
+        nodes = ring.get_nodes(self.keys)
+        assert nodes == [ring.get_node(key) for key in self.keys]
+        assert set(ring.all_nodes()) == set(self.nodes)
+        for node, keys in ring.group_keys(self.keys).iteritems():
+            assert all(ring.get_node(key) == node for key in keys)
+
+    def testAddNodeMovesFewKeys(self):
+        """test that adding a node only moves keys onto the new node"""
+        before = self.make_ring(self.nodes).get_nodes(self.keys)
+        after = self.make_ring(self.nodes + ['10.0.1.6:11211']).get_nodes(self.keys)
+        for old, new in zip(before, after):
+            assert old == new or new == '10.0.1.6:11211'
+
+    def testRemoveNodeMovesFewKeys(self):
+        """test that removing or marking down a node only moves its keys"""
+        ring = self.make_ring(self.nodes)
+        before = ring.get_nodes(self.keys)
+        ring.mark_down(self.nodes[0], 60)
+        assert ring.down_nodes() == [self.nodes[0]]
+        after = ring.get_nodes(self.keys)
+        for old, new in zip(before, after):
+            assert old == new or old == self.nodes[0]
+        ring.mark_up(self.nodes[0])
+        assert ring.get_nodes(self.keys) == before
+        ring.remove_node(self.nodes[0])
+        assert ring.get_nodes(self.keys) == after
+
+    def testMarkDownExpires(self):
+        """test that marked down nodes rejoin the ring after the retry interval"""
+        ring = self.make_ring(self.nodes)
+        before = ring.get_nodes(self.keys)
+        ring.mark_down(self.nodes[0], 0)
+        assert ring.get_nodes(self.keys) == before
+        assert ring.down_nodes() == []
+
+    def testLastNodeStaysUp(self):
+        """test that the last live node is never marked down"""
+        ring = self.make_ring(self.nodes[:1])
+        assert ring.mark_down(self.nodes[0], 60) == False
+        assert ring.get_node('foo') == self.nodes[0]
+
+class TestServerEjection(BaseTest):
+    DEAD_HOST = 'localhost:11299'
+
+    def setUp(self):
+        super(TestServerEjection, self).setUp()
+        self.client.close()
+        self.client = pymemc.Client(HOST_STRINGS + [self.DEAD_HOST],
+                                    failure_threshold=1, dead_retry=60)
+
+    def testEjectDeadServer(self):
+        """test that a dead server is ejected and its keys served elsewhere"""
+        sample_data = self.get_sample_data(length=100)
+
+        for key, val in sample_data.iteritems():
+            assert self.client.set(key, val) == True
+
+        assert [str(pool) for pool in self.client.hash.down_nodes()] == ['localhost:11299']
+
+        for key, val in sample_data.iteritems():
+            assert self.client.get(key) == val
+
+        assert self.client.get_multi(sample_data.iterkeys()) == sample_data
+
+    def testMultiOpsRemapKeys(self):
+        """test that a multi-op's keys move off a server ejected during the call"""
+        sample_data = self.get_sample_data(length=100)
+
+        assert self.client.set_multi(sample_data) == []
+        assert [str(pool) for pool in self.client.hash.down_nodes()] == ['localhost:11299']
+        assert self.client.get_multi(sample_data.keys()) == sample_data
+
+        for method, args in (('get_multi', ()), ('touch_multi', (60,)), ('delete_multi', ())):
+            self.client.hash.mark_up(self.client.hash.down_nodes()[0])
+            result = getattr(self.client, method)(sample_data.keys(), *args)
+            assert result == (sample_data if method == 'get_multi' else [])
+            assert len(self.client.hash.down_nodes()) == 1
+
+        assert self.client.set_multi(sample_data) == []
+        self.client.hash.mark_up(self.client.hash.down_nodes()[0])
+        assert dict(self.client.iter_multi(sample_data.keys())) == sample_data
+
+    def testRemoveServer(self):
+        """test removing and re-adding a server at runtime"""
+        self.client.remove_server(self.DEAD_HOST)
+        assert len(self.client.hash.all_nodes()) == len(HOST_STRINGS)
+
+        sample_data = self.get_sample_data(length=100)
+        assert self.client.set_multi(sample_data) == []
+        assert self.client.hash.down_nodes() == []
+
+        self.client.add_server(self.DEAD_HOST)
+        assert len(self.client.hash.all_nodes()) == len(HOST_STRINGS) + 1
 
 # test complex objects
 # test set_many with 10000 things